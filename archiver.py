@@ -0,0 +1,50 @@
+import asyncio
+import contextlib
+import logging
+from datetime import timedelta
+
+from storage import Storage
+
+
+# Фоновый перенос закрытых обращений в архив (см. Storage.archive_reports), чтобы рабочая
+# таблица reports и ее индексы не росли бесконечно. Переносит небольшими пачками с паузой
+# между ними, чтобы не занимать писателя надолго, затем ждет interval секунд до следующего прохода
+class ReportArchiver:
+    def __init__(self, storage: Storage, older_than: timedelta = timedelta(days=30), batch_size: int = 100,
+                 interval: float = 3600, pause: float = 0.5):
+        self.storage = storage
+        self.older_than = older_than
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self._task = None
+
+    # Один проход: пачки переносятся, пока есть что переносить; возвращает число перенесенных обращений
+    async def archive_once(self) -> int:
+        archived = 0
+        while True:
+            count = await self.storage.archive_reports(self.older_than, self.batch_size)
+            archived += count
+            if count < self.batch_size:
+                return archived
+            await asyncio.sleep(self.pause)
+
+    async def run(self):
+        while True:
+            try:
+                archived = await self.archive_once()
+                if archived:
+                    logging.info(f"Перенесено в архив обращений: {archived}")
+            except Exception as e:
+                logging.error(f"Ошибка переноса обращений в архив: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
@@ -0,0 +1,438 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Optional
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("METRICS_PORT", "")
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import main as bot
+from fake_bot_api import FakeBotApi, FakeBotApiServer
+from notifications import Notifier
+from storage import MemoryStorage
+
+# Нагрузочный прогон бота без сети: настоящее приложение из main.py с настоящими
+# обработчиками и БД, но запросы к Bot API обслуживает заглушка в памяти.
+# Пользователи параллельно проходят /report целиком, модераторы одобряют обращения
+# по пришедшим им карточкам, госслужащие меняют статус. Пример:
+#   python benchmark.py --users 2000 --moderators 5 --officials 10 --json bench.json
+# С --http запросы идут по HTTP на локальный fake_bot_api.py, где можно задать
+# задержку, лимиты Telegram и искусственные 429
+
+TOKEN = "123456:BENCHMARK"
+
+MODERATOR_BASE_ID = 100000
+OFFICIAL_BASE_ID = 200000
+USER_BASE_ID = 1000000
+
+# Границы Казахстана для случайных координат и точки, вокруг которых создаются дубликаты
+KZ_LATITUDE = (41.0, 55.0)
+KZ_LONGITUDE = (47.0, 87.0)
+HOTSPOTS = [(43.238 + i * 0.1, 76.945 + i * 0.1) for i in range(20)]
+
+DESCRIPTIONS = [
+    "Свалка строительного мусора у дороги",
+    "Сброс сточных вод в реку",
+    "Горит сухая трава возле поселка",
+    "Вырубка деревьев в лесополосе",
+    "Выброс бытовых отходов в овраг",
+]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+
+# HTTP-клиент бота, передающий запросы в FakeBotApi напрямую, без сети
+class StubRequest(BaseRequest):
+    def __init__(self, api: FakeBotApi):
+        self.api = api
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        status, response = await self.api.call(url.rsplit('/', 1)[-1],
+                                               request_data.parameters if request_data else {})
+        return status.value, json.dumps(response).encode()
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.app = None
+        self.api = FakeBotApi(
+            latency=args.api_latency / 1000,
+            retry_after_rate=args.retry_after_rate,
+            per_chat_rate=args.per_chat_rate,
+            global_rate=args.global_rate,
+            on_message=self.on_bot_message
+        )
+        self.latencies = defaultdict(list)
+        self.db_ops = Counter()
+        self.errors = Counter()
+        self.reports = 0
+
+        self._db_lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+
+        # Карточки обращений, отправленные ботом модераторам и госслужащим
+        self.inbox = asyncio.Queue()
+        self.actors = set()
+        self._locks = defaultdict(asyncio.Lock)
+        self._moderated = set()
+        self._handled = set()
+
+    # Учет SQL-выражений (вызывается из потоков пула хранилища)
+    def count_db_op(self, statement: str):
+        kind = statement.split(None, 1)[0].upper() if statement.strip() else ''
+        with self._db_lock:
+            self.db_ops[kind] += 1
+
+    async def on_error(self, update, context):
+        self.errors[type(context.error).__name__] += 1
+        logging.error(f"Ошибка обработчика: {context.error!r}")
+
+    # Карточки обращений с кнопками, отправленные ботом, достаются модераторам и госслужащим
+    def on_bot_message(self, chat_id: int, message: dict):
+        if message.get('photo') and 'reply_markup' in message:
+            self.inbox.put_nowait((chat_id, message))
+
+    # Входящие обновления
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}", 'username': f"user{user_id}"}
+
+    def message_update(self, user_id: int, **content) -> Update:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            **content
+        }
+        text = content.get('text', '')
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': next(self._update_ids), 'message': message}, self.app.bot)
+
+    def callback_update(self, user_id: int, data: str, message: dict) -> Update:
+        return Update.de_json({
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(next(self._update_ids)),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': message
+            }
+        }, self.app.bot)
+
+    async def step(self, name: str, update: Update):
+        start = time.perf_counter()
+        await self.app.process_update(update)
+        self.latencies[name].append(time.perf_counter() - start)
+
+    async def think(self):
+        if self.args.think:
+            await asyncio.sleep(random.uniform(0, self.args.think))
+
+    # Сценарии участников
+
+    async def user_session(self, user_id: int, limit: asyncio.Semaphore):
+        if random.random() < self.args.duplicates:
+            latitude, longitude = random.choice(HOTSPOTS)
+            latitude += random.uniform(-0.0002, 0.0002)
+            longitude += random.uniform(-0.0002, 0.0002)
+        else:
+            latitude = random.uniform(*KZ_LATITUDE)
+            longitude = random.uniform(*KZ_LONGITUDE)
+
+        # Часть пользователей присылает одно из уже известных фото
+        if random.random() < self.args.photo_duplicates:
+            photo_id = f"photo-common-{random.randrange(10)}"
+        else:
+            photo_id = f"photo-{user_id}"
+
+        async with limit:
+            await self.step('start', self.message_update(user_id, text='/start'))
+            await self.think()
+            await self.step('report', self.message_update(user_id, text='/report'))
+            await self.think()
+            await self.step('category', self.callback_update(
+                user_id, f"cat_{random.choice(bot.VIOLATION_CATEGORIES)}",
+                self.api.bot_message(user_id, text="Выберите категорию нарушения:")
+            ))
+            await self.think()
+            await self.step('description', self.message_update(user_id, text=random.choice(DESCRIPTIONS)))
+            await self.think()
+            await self.step('location', self.message_update(
+                user_id, location={'latitude': latitude, 'longitude': longitude}
+            ))
+            await self.think()
+            await self.step('photo', self.message_update(user_id, photo=[{
+                'file_id': photo_id, 'file_unique_id': photo_id, 'width': 1280, 'height': 960
+            }]))
+            await self.think()
+            await self.step('confirm', self.callback_update(
+                user_id, 'confirm_yes', self.api.bot_message(user_id, photo=True, caption="Всё верно?")
+            ))
+            self.reports += 1
+
+    # Реакция модератора или госслужащего на карточку обращения; один участник
+    # обрабатывает свои карточки по очереди, как живой человек
+    async def handle_card(self, chat_id: int, message: dict):
+        buttons = [
+            button['callback_data']
+            for row in message['reply_markup']['inline_keyboard'] for button in row
+            if 'callback_data' in button
+        ]
+
+        async with self._locks[chat_id]:
+            for data in buttons:
+                if data.startswith('mod_approve_'):
+                    report_id = int(data.rsplit('_', 1)[1])
+                    if report_id in self._moderated:
+                        return
+                    self._moderated.add(report_id)
+                    await self.think()
+                    await self.step('moderate', self.callback_update(chat_id, data, message))
+                    return
+
+                if data.startswith('change_status_'):
+                    report_id = int(data.rsplit('_', 1)[1])
+                    if report_id in self._handled:
+                        return
+                    self._handled.add(report_id)
+                    await self.think()
+                    await self.step('change_status', self.callback_update(chat_id, data, message))
+                    await self.step('status', self.callback_update(chat_id, f"status_{report_id}_Решено", message))
+                    await self.step('comment', self.message_update(chat_id, text="Нарушение устранено"))
+                    return
+
+    async def dispatch(self):
+        while True:
+            chat_id, message = await self.inbox.get()
+            task = asyncio.create_task(self.handle_card(chat_id, message))
+            self.actors.add(task)
+            task.add_done_callback(self.actors.discard)
+
+    # Ожидание, пока не будут доставлены все оповещения и обработаны все карточки.
+    # Очередь оповещений файловой БД проверяется отдельным соединением, чтобы не искажать счетчики;
+    # к БД в памяти доступ есть только через хранилище бота
+    async def wait_idle(self, db_path: Optional[str], timeout: float) -> bool:
+        conn = sqlite3.connect(db_path) if db_path else None
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                if conn is not None:
+                    backlog = conn.execute(
+                        "SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending')"
+                    ).fetchone()[0]
+                else:
+                    depth = await bot.storage.get_outbox_depth()
+                    backlog = depth.get('pending', 0) + depth.get('sending', 0)
+                if not backlog and self.inbox.empty() and not self.actors:
+                    return True
+                await asyncio.sleep(0.1)
+            return False
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def results(self, elapsed: float) -> dict:
+        updates = sum(len(values) for values in self.latencies.values())
+        return {
+            'users': self.args.users,
+            'reports': self.reports,
+            'elapsed_s': elapsed,
+            'updates_per_s': updates / elapsed,
+            'reports_per_s': self.reports / elapsed,
+            'handlers': {
+                name: {
+                    'count': len(values),
+                    'p50_ms': percentile(values, 0.50) * 1000,
+                    'p95_ms': percentile(values, 0.95) * 1000,
+                    'p99_ms': percentile(values, 0.99) * 1000,
+                    'max_ms': max(values) * 1000,
+                }
+                for name, values in self.latencies.items()
+            },
+            'db_ops': dict(self.db_ops),
+            'db_ops_per_report': sum(self.db_ops.values()) / max(self.reports, 1),
+            'api_calls': dict(self.api.calls),
+            'api_rejected': dict(self.api.rejected),
+            'errors': dict(self.errors),
+        }
+
+
+def print_results(results: dict):
+    print(f"Пользователей: {results['users']}, обращений: {results['reports']}, "
+          f"время: {results['elapsed_s']:.2f} с")
+    print(f"Пропускная способность: {results['updates_per_s']:.1f} обновлений/с, "
+          f"{results['reports_per_s']:.1f} обращений/с\n")
+
+    print(f"{'обработчик':<15}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, stats in results['handlers'].items():
+        print(f"{name:<15}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+
+    print(f"\nОпераций с БД: {sum(results['db_ops'].values())} "
+          f"({results['db_ops_per_report']:.1f} на обращение)")
+    for kind, count in sorted(results['db_ops'].items(), key=lambda item: -item[1]):
+        print(f"  {kind:<12}{count:>8}")
+
+    print("\nВызовов Bot API:")
+    for method, count in sorted(results['api_calls'].items(), key=lambda item: -item[1]):
+        print(f"  {method:<22}{count:>8}")
+    if results['api_rejected']:
+        print(f"Отказов 429: {results['api_rejected']}")
+
+    if results['errors']:
+        print(f"\nОшибки обработчиков: {results['errors']}")
+
+
+async def run(args) -> dict:
+    db_dir = tempfile.mkdtemp(prefix='signal-kz-bench-')
+    db_path = os.path.join(db_dir, 'bench.db')
+    bench = Benchmark(args)
+
+    # Приложение из main.py на временной БД (или БД в памяти с --memory); лимиты Telegram
+    # в заглушке не нужны, если только их влияние не замеряется отдельно (--telegram-limits).
+    # Модераторы и госслужащие прогона работают намного быстрее людей, поэтому ограничение
+    # частоты запросов включается только с --throttle
+    if args.memory:
+        db_path = None
+        bot.storage = MemoryStorage()
+        bot.outbox_worker.storage = bot.storage
+        bot.photo_hasher.storage = bot.storage
+        bot.report_archiver.storage = bot.storage
+        bot.user_throttle.storage = bot.storage
+    else:
+        bot.storage.path = db_path
+    bot.storage.setup()
+    bot.storage.set_trace_callback(bench.count_db_op)
+    if not args.telegram_limits:
+        bot.outbox_worker.notifier = Notifier(global_rate=1e9, per_chat_rate=1e9)
+    if not args.throttle:
+        bot.user_throttle.limits = {}
+
+    builder = Application.builder().token(TOKEN)
+    server = None
+    if args.http:
+        server = FakeBotApiServer(bench.api, port=0)
+        await server.start()
+        builder = builder.base_url(f"{server.url}/bot").base_file_url(f"{server.url}/file/bot")
+    else:
+        builder = builder.request(StubRequest(bench.api)).get_updates_request(StubRequest(bench.api))
+
+        async def fetch_photo(file_id):
+            return bench.api.photo(file_id)
+
+        bot.photo_hasher.fetcher = fetch_photo
+
+    application = bot.build_application(builder)
+    application.add_error_handler(bench.on_error)
+    bench.app = application
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    dispatcher = asyncio.create_task(bench.dispatch())
+    try:
+        # Модераторы и госслужащие
+        for i in range(args.moderators):
+            await bench.step('start', bench.message_update(MODERATOR_BASE_ID + i, text='/start'))
+            await bot.storage.set_role(MODERATOR_BASE_ID + i, 'moderator')
+        for i in range(args.officials):
+            await bench.step('start', bench.message_update(OFFICIAL_BASE_ID + i, text='/start'))
+            await bot.storage.set_role(OFFICIAL_BASE_ID + i, 'official')
+
+        limit = asyncio.Semaphore(args.concurrency or args.users)
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            bench.user_session(USER_BASE_ID + i, limit) for i in range(args.users)
+        ))
+        if not await bench.wait_idle(db_path, args.timeout):
+            logging.error("Не дождались доставки всех оповещений")
+        elapsed = time.perf_counter() - started
+    finally:
+        dispatcher.cancel()
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        if server is not None:
+            await server.stop()
+
+        if args.keep_db and db_path:
+            print(f"БД прогона: {db_path}")
+        else:
+            shutil.rmtree(db_dir, ignore_errors=True)
+
+    return bench.results(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота Signal KZ без сети")
+    parser.add_argument('--users', type=int, default=1000, help="количество пользователей, подающих обращения")
+    parser.add_argument('--moderators', type=int, default=5)
+    parser.add_argument('--officials', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help="сколько пользователей одновременно проходят сценарий (0 - все)")
+    parser.add_argument('--think', type=float, default=0.0, help="максимальная пауза между шагами, с")
+    parser.add_argument('--duplicates', type=float, default=0.1, help="доля обращений о уже известных нарушениях")
+    parser.add_argument('--photo-duplicates', type=float, default=0.05,
+                        help="доля обращений с уже присланным кем-то фото")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument('--retry-after-rate', type=float, default=0.0,
+                        help="доля отправок, на которые Bot API отвечает 429")
+    parser.add_argument('--per-chat-rate', type=float, help="лимит Bot API на сообщения в чат в секунду")
+    parser.add_argument('--global-rate', type=float, help="лимит Bot API на сообщения бота в секунду")
+    parser.add_argument('--http', action='store_true', help="обращаться к fake_bot_api.py по HTTP, а не в памяти")
+    parser.add_argument('--telegram-limits', action='store_true', help="соблюдать лимиты Telegram при рассылке")
+    parser.add_argument('--throttle', action='store_true', help="ограничивать частоту запросов пользователей")
+    parser.add_argument('--timeout', type=float, default=300, help="время ожидания доставки оповещений, с")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="сохранить результаты в JSON-файл для сравнения прогонов")
+    parser.add_argument('--keep-db', action='store_true', help="не удалять БД прогона")
+    parser.add_argument('--memory', action='store_true', help="БД в памяти вместо файла SQLite")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    random.seed(args.seed)
+
+    results = asyncio.run(run(args))
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import re
+from datetime import timedelta
+from typing import FrozenSet, Iterable, Optional
+
+from geo import haversine
+
+# Обращение считается дубликатом открытого обращения той же категории, если оно подано
+# в пределах DUPLICATE_WINDOW и DUPLICATE_RADIUS_M от него и описания похожи
+# (коэффициент Жаккара по шинглам не ниже DUPLICATE_TEXT_SIMILARITY).
+# Для точек ближе DUPLICATE_SAME_SPOT_M похожесть описаний не требуется
+DUPLICATE_RADIUS_M = 300
+DUPLICATE_SAME_SPOT_M = 50
+DUPLICATE_WINDOW = timedelta(hours=48)
+DUPLICATE_TEXT_SIMILARITY = 0.3
+
+SHINGLE_SIZE = 3
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+# Множество символьных шинглов нормализованного текста
+def shingles(text: Optional[str], size: int = SHINGLE_SIZE) -> FrozenSet[str]:
+    normalized = _NON_WORD.sub(' ', (text or '').lower()).strip()
+    if len(normalized) <= size:
+        return frozenset([normalized]) if normalized else frozenset()
+    return frozenset(normalized[i:i + size] for i in range(len(normalized) - size + 1))
+
+
+# Коэффициент Жаккара двух множеств шинглов
+def similarity(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+# Выбор обращения, к которому следует присоединить новое. candidates - строки с полями
+# report_id, description, latitude, longitude (уже отобранные по категории, времени и области).
+# Возвращает report_id ближайшего подходящего обращения или None
+def find_duplicate(description: str, latitude: float, longitude: float, candidates: Iterable) -> Optional[int]:
+    text = shingles(description)
+    best_id = None
+    best_distance = None
+
+    for candidate in candidates:
+        distance = haversine(latitude, longitude, candidate['latitude'], candidate['longitude'])
+        if distance > DUPLICATE_RADIUS_M:
+            continue
+
+        if distance > DUPLICATE_SAME_SPOT_M and \
+                similarity(text, shingles(candidate['description'])) < DUPLICATE_TEXT_SIMILARITY:
+            continue
+
+        if best_distance is None or distance < best_distance:
+            best_id = candidate['report_id']
+            best_distance = distance
+
+    return best_id
@@ -0,0 +1,69 @@
+import csv
+import gzip
+import io
+import json
+
+EXPORT_FORMATS = ('csv', 'geojson')
+
+# Уровень сжатия gzip: 9 (по умолчанию) в несколько раз медленнее при почти том же размере
+EXPORT_COMPRESS_LEVEL = 6
+
+# Поля обращения в выгрузке. Строки, передаваемые в ReportExport.write, должны содержать
+# их именно в этом порядке (как их возвращает Storage.iter_reports)
+EXPORT_COLUMNS = ['report_id', 'created_at', 'updated_at', 'category', 'status', 'description',
+                  'latitude', 'longitude', 'cluster_id', 'photo_id']
+LATITUDE = EXPORT_COLUMNS.index('latitude')
+LONGITUDE = EXPORT_COLUMNS.index('longitude')
+PROPERTIES = [(index, column) for index, column in enumerate(EXPORT_COLUMNS)
+              if index not in (LATITUDE, LONGITUDE)]
+
+
+# Выгрузка обращений в сжатый gzip файл. Обращения поступают пачками и сразу форматируются
+# и сжимаются в файл, поэтому занимаемая память не зависит от размера выгрузки.
+# write и close выполняют сжатие и запись на диск, их стоит вызывать вне event loop
+class ReportExport:
+    def __init__(self, export_format: str, fileobj):
+        self.export_format = export_format
+        self.count = 0
+        self._gzip = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=EXPORT_COMPRESS_LEVEL)
+        # utf-8-sig - чтобы Excel правильно открывал кириллицу в CSV
+        self._text = io.TextIOWrapper(self._gzip, encoding='utf-8-sig' if export_format == 'csv' else 'utf-8',
+                                      newline='')
+
+        if export_format == 'csv':
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(EXPORT_COLUMNS)
+        else:
+            self._json = json.JSONEncoder(ensure_ascii=False, default=str)
+            self._text.write('{"type": "FeatureCollection", "features": [\n')
+
+    @property
+    def filename(self) -> str:
+        return f"reports.{self.export_format}.gz"
+
+    def write(self, rows: list):
+        if self.export_format == 'csv':
+            self._csv.writerows(rows)
+        else:
+            self._text.write(',\n'.join(self._features(rows, first=self.count == 0)))
+        self.count += len(rows)
+
+    # GeoJSON-объекты пачки обращений (точка в координатах [долгота, широта])
+    def _features(self, rows, first: bool):
+        if not first:
+            yield ''
+        for row in rows:
+            geometry = None
+            if row[LATITUDE] is not None and row[LONGITUDE] is not None:
+                geometry = {'type': 'Point', 'coordinates': [row[LONGITUDE], row[LATITUDE]]}
+            yield self._json.encode({
+                'type': 'Feature',
+                'geometry': geometry,
+                'properties': {column: row[index] for index, column in PROPERTIES},
+            })
+
+    def close(self):
+        if self.export_format == 'geojson':
+            self._text.write('\n]}\n')
+        # Закрывает и gzip-поток; сам fileobj остается открытым
+        self._text.close()
@@ -0,0 +1,432 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import logging
+import random
+import time
+from collections import Counter
+from http import HTTPStatus
+from typing import Callable, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+from PIL import Image
+
+# Локальная замена Telegram Bot API для нагрузочных прогонов без сети.
+# Бот подключается к ней через base_url (переменная BOT_API_URL в main.py):
+#   python fake_bot_api.py --port 8081 --latency 50 --per-chat-rate 1 --global-rate 30
+#   BOT_API_URL=http://127.0.0.1:8081 python main.py
+# Входящие обновления для getUpdates добавляются через POST /fake/updates,
+# счетчики вызовов и отказов доступны на GET /fake/stats. Файлы фото (/file/bot<token>/...)
+# генерируются по file_id: одинаковый file_id - одинаковая картинка.
+# После setWebhook обновления не ждут getUpdates, а отправляются POST-запросом на адрес
+# webhook с заголовком X-Telegram-Bot-Api-Secret-Token, как это делает Telegram
+
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Signal KZ', 'username': 'signal_kz_bot'}
+
+# Методы отправки, на которые действуют лимиты Telegram
+SEND_METHODS = ('sendMessage', 'sendPhoto', 'sendMediaGroup')
+
+MAX_BODY_SIZE = 10 * 1024 * 1024
+KEEP_ALIVE_TIMEOUT = 75
+
+# Попытки доставки обновления на webhook и пауза между ними, с
+WEBHOOK_ATTEMPTS = 5
+WEBHOOK_RETRY_DELAY = 1.0
+
+
+# Неблокирующий token bucket: take возвращает None, если токен взят, иначе через сколько секунд он появится
+class _Bucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, amount: float = 1) -> Optional[float]:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return None
+        return (amount - self.tokens) / self.rate
+
+
+# Поведение Bot API: ответы на методы, задержка, лимиты и искусственные 429.
+# on_message(chat_id, message) вызывается для каждого отправленного ботом сообщения
+class FakeBotApi:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, retry_after_rate: float = 0.0,
+                 retry_after: int = 1, per_chat_rate: Optional[float] = None, global_rate: Optional[float] = None,
+                 on_message: Optional[Callable] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.per_chat_rate = per_chat_rate
+        self.on_message = on_message
+
+        self.calls = Counter()
+        self.rejected = Counter()
+
+        self._global_bucket = _Bucket(global_rate, global_rate) if global_rate else None
+        self._chat_buckets = {}
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates = []
+        self._new_updates = asyncio.Event()
+
+        # Адрес и секретный токен из setWebhook; ответы webhook по HTTP-статусам
+        self.webhook: Optional[dict] = None
+        self.webhook_responses = Counter()
+        self._deliveries = set()
+
+    def stats(self) -> dict:
+        return {'calls': dict(self.calls), 'rejected': dict(self.rejected), 'pending_updates': len(self._updates),
+                'webhook_responses': dict(self.webhook_responses)}
+
+    def bot_message(self, chat_id: int, photo: bool = False, **content) -> dict:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            **content
+        }
+        if photo:
+            message['photo'] = [{'file_id': 'photo', 'file_unique_id': 'photo', 'width': 1280, 'height': 960}]
+        return message
+
+    # Картинка, соответствующая file_id: размытый случайный шум, зависящий только от file_id
+    def photo(self, file_id: str) -> bytes:
+        rng = random.Random(file_id)
+        image = Image.new('L', (8, 8))
+        image.putdata([rng.randrange(256) for _ in range(64)])
+        output = io.BytesIO()
+        image.resize((320, 240), Image.BILINEAR).convert('RGB').save(output, 'JPEG', quality=85)
+        return output.getvalue()
+
+    # Входящее обновление (update_id назначается, если не задан): отправляется на webhook,
+    # если он задан, иначе ждет getUpdates
+    def push_update(self, update: dict):
+        update.setdefault('update_id', next(self._update_ids))
+        if self.webhook is not None:
+            task = asyncio.create_task(self._deliver(self.webhook, update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+            return
+        self._updates.append(update)
+        self._new_updates.set()
+
+    # Доставка обновления на webhook; при ошибке соединения или ответе не 2xx повторяется
+    async def _deliver(self, webhook: dict, update: dict):
+        url = urlsplit(webhook['url'])
+        body = json.dumps(update, ensure_ascii=False).encode()
+        headers = (
+            f"POST {url.path or '/'} HTTP/1.1\r\n"
+            f"Host: {url.netloc}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n"
+        )
+        if webhook.get('secret_token'):
+            headers += f"X-Telegram-Bot-Api-Secret-Token: {webhook['secret_token']}\r\n"
+
+        for attempt in range(WEBHOOK_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(WEBHOOK_RETRY_DELAY)
+            try:
+                reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+                try:
+                    writer.write(f"{headers}\r\n".encode('latin-1') + body)
+                    await writer.drain()
+                    status = int((await reader.readline()).split()[1])
+                finally:
+                    writer.close()
+                    with contextlib.suppress(ConnectionError):
+                        await writer.wait_closed()
+            except (OSError, ValueError, IndexError) as e:
+                self.webhook_responses['error'] += 1
+                logging.warning(f"Не удалось доставить обновление на webhook: {e}")
+                continue
+
+            self.webhook_responses[status] += 1
+            if 200 <= status < 300:
+                return
+
+    # Ожидание завершения доставки уже отправленных на webhook обновлений
+    async def drain_webhook(self):
+        while self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+
+        # offset подтверждает получение всех обновлений с меньшим update_id
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+        return self._updates[:limit]
+
+    def _too_many_requests(self, method: str, retry_after: float):
+        self.rejected[method] += 1
+        retry_after = max(1, round(retry_after))
+        return HTTPStatus.TOO_MANY_REQUESTS, {
+            'ok': False,
+            'error_code': 429,
+            'description': f"Too Many Requests: retry after {retry_after}",
+            'parameters': {'retry_after': retry_after}
+        }
+
+    def _check_limits(self, method: str, params: dict):
+        if method not in SEND_METHODS:
+            return None
+
+        if self.retry_after_rate and random.random() < self.retry_after_rate:
+            return self._too_many_requests(method, self.retry_after)
+
+        amount = len(params['media']) if method == 'sendMediaGroup' else 1
+        if self.per_chat_rate:
+            bucket = self._chat_buckets.get(params['chat_id'])
+            if bucket is None:
+                bucket = self._chat_buckets[params['chat_id']] = _Bucket(self.per_chat_rate, max(1, amount))
+            wait = bucket.take(amount)
+            if wait is not None:
+                return self._too_many_requests(method, wait)
+
+        if self._global_bucket is not None:
+            wait = self._global_bucket.take(amount)
+            if wait is not None:
+                return self._too_many_requests(method, wait)
+
+        return None
+
+    # Выполнение метода: возвращает HTTP-статус и тело ответа Bot API
+    async def call(self, method: str, params: dict):
+        self.calls[method] += 1
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        rejection = self._check_limits(method, params)
+        if rejection is not None:
+            return rejection
+
+        if method == 'getUpdates':
+            if self.webhook is not None:
+                return HTTPStatus.CONFLICT, {
+                    'ok': False, 'error_code': 409,
+                    'description': "Conflict: can't use getUpdates method while webhook is active"
+                }
+            return HTTPStatus.OK, {'ok': True, 'result': await self._get_updates(params)}
+
+        return HTTPStatus.OK, {'ok': True, 'result': self._result(method, params)}
+
+    def _result(self, method: str, params: dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'setWebhook':
+            self.webhook = {'url': params['url'], 'secret_token': params.get('secret_token')}
+            return True
+        if method == 'deleteWebhook':
+            self.webhook = None
+            return True
+        if method == 'getWebhookInfo':
+            return {'url': self.webhook['url'] if self.webhook else '', 'has_custom_certificate': False,
+                    'pending_update_count': len(self._updates)}
+        if method == 'getFile':
+            return {'file_id': params['file_id'], 'file_unique_id': params['file_id'],
+                    'file_path': f"photos/{params['file_id']}.jpg"}
+        if method == 'sendMediaGroup':
+            return [
+                self.bot_message(params['chat_id'], photo=True, caption=media.get('caption', ''))
+                for media in params['media']
+            ]
+        if method not in ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption'):
+            return True
+
+        content = {}
+        for field in ('text', 'caption'):
+            if field in params:
+                content[field] = params[field]
+        markup = params.get('reply_markup')
+        if markup and 'inline_keyboard' in markup:
+            content['reply_markup'] = markup
+
+        message = self.bot_message(params['chat_id'], photo=method in ('sendPhoto', 'editMessageCaption'), **content)
+        if method in SEND_METHODS and self.on_message is not None:
+            self.on_message(params['chat_id'], message)
+        return message
+
+
+# Значения параметров приходят JSON-строками (числа, объекты) или обычным текстом
+def _decode_params(pairs) -> dict:
+    params = {}
+    for name, value in pairs:
+        if name in ('text', 'caption'):
+            params[name] = value
+            continue
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+
+# HTTP-сервер с адресами Bot API: /bot<token>/<method>
+class FakeBotApiServer:
+    def __init__(self, api: FakeBotApi, listen: str = '127.0.0.1', port: int = 8081):
+        self.api = api
+        self.listen = listen
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"Fake Bot API слушает http://{self.listen}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.listen}:{self.port}"
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                if not request_line:
+                    break
+
+                method, target, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                        {'ok': False, 'description': 'Request Entity Too Large'}, False)
+                    break
+
+                body = await reader.readexactly(length) if length else b''
+                status, response = await self._route(method, target, headers, body)
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def _route(self, method: str, target: str, headers: dict, body: bytes):
+        path, _, query = target.partition('?')
+
+        if path == '/fake/stats' and method == 'GET':
+            return HTTPStatus.OK, self.api.stats()
+
+        if path == '/fake/updates' and method == 'POST':
+            updates = json.loads(body)
+            for update in updates if isinstance(updates, list) else [updates]:
+                self.api.push_update(update)
+            return HTTPStatus.OK, {'ok': True}
+
+        if path.startswith('/file/bot') and method == 'GET':
+            file_id = path.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+            return HTTPStatus.OK, self.api.photo(file_id)
+
+        parts = path.strip('/').split('/')
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            return HTTPStatus.NOT_FOUND, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('multipart/'):
+            return HTTPStatus.BAD_REQUEST, {
+                'ok': False, 'error_code': 400, 'description': 'Bad Request: file uploads are not supported'
+            }
+
+        params = _decode_params(parse_qsl(query))
+        if content_type.startswith('application/json'):
+            params.update(json.loads(body or b'{}'))
+        else:
+            params.update(_decode_params(parse_qsl(body.decode())))
+
+        try:
+            return await self.api.call(parts[1], params)
+        except KeyError as e:
+            return HTTPStatus.BAD_REQUEST, {
+                'ok': False, 'error_code': 400, 'description': f"Bad Request: parameter {e} is required"
+            }
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: HTTPStatus, response,
+                       keep_alive: bool = True):
+        if isinstance(response, bytes):
+            body, content_type = response, 'image/jpeg'
+        else:
+            body, content_type = json.dumps(response, ensure_ascii=False).encode(), 'application/json'
+        writer.write(
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+
+
+async def serve(args):
+    api = FakeBotApi(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        retry_after_rate=args.retry_after_rate,
+        retry_after=args.retry_after,
+        per_chat_rate=args.per_chat_rate,
+        global_rate=args.global_rate
+    )
+    server = FakeBotApiServer(api, args.listen, args.port)
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API для нагрузочных прогонов")
+    parser.add_argument('--listen', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа, мс")
+    parser.add_argument('--jitter', type=float, default=0.0, help="случайная добавка к задержке, мс")
+    parser.add_argument('--retry-after-rate', type=float, default=0.0,
+                        help="доля запросов на отправку, получающих 429 без причины")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after для искусственных 429, с")
+    parser.add_argument('--per-chat-rate', type=float, help="лимит сообщений в секунду на чат (429 при превышении)")
+    parser.add_argument('--global-rate', type=float, help="лимит сообщений в секунду на бота (429 при превышении)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import math
+from typing import Tuple
+
+EARTH_RADIUS_M = 6371008.8
+
+
+# Расстояние между двумя точками по формуле гаверсинусов, в метрах
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+# Ограничивающий прямоугольник (min_lat, max_lat, min_lon, max_lon) вокруг точки,
+# гарантированно содержащий круг радиуса radius_m
+def bounding_box(lat: float, lon: float, radius_m: float) -> Tuple[float, float, float, float]:
+    d_lat = math.degrees(radius_m / EARTH_RADIUS_M)
+    min_lat = max(-90.0, lat - d_lat)
+    max_lat = min(90.0, lat + d_lat)
+
+    # У полюсов прямоугольник охватывает все долготы
+    if max_lat >= 90.0 or min_lat <= -90.0:
+        return min_lat, max_lat, -180.0, 180.0
+
+    d_lon = math.degrees(radius_m / (EARTH_RADIUS_M * math.cos(math.radians(max(abs(min_lat), abs(max_lat))))))
+    return min_lat, max_lat, max(-180.0, lon - d_lon), min(180.0, lon + d_lon)
+
+
+# Ссылка на точку в Google Maps
+def map_url(latitude: float, longitude: float) -> str:
+    return f"https://www.google.com/maps/search/?api=1&query={latitude},{longitude}"
@@ -4,18 +4,82 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes, ConversationHandler
-import sqlite3
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InputMediaPhoto
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes, ConversationHandler, TypeHandler
+from telegram.request import HTTPXRequest
+import asyncio
+import json
 import logging
-from datetime import datetime
+import re
+import tempfile
+from datetime import datetime, timedelta
+
+from archiver import ReportArchiver
+from export import EXPORT_FORMATS, ReportExport
+from metrics import Gauge, InstrumentedRequest, MetricsServer, instrument_handlers
+from notifications import Notifier
+from outbox import OutboxWorker
+from persistence import SQLitePersistence
+from photo_hasher import PhotoHasher
+from report_cards import CONFIRM_KEYBOARD, ReportCards, confirm_caption, status_keyboard
+from storage import DB_PATH, open_storage
+from throttling import DEFAULT_LIMITS, UserThrottle, parse_limits
+from webhook import run_webhook
 
 application = Application.builder().token(os.getenv("BOT_TOKEN")).build()
 
+# Хранилище данных (пул соединений с SQLite): файл БД из DB_PATH или ":memory:" для БД в памяти
+storage = open_storage(os.getenv("DB_PATH", DB_PATH))
+
+# Рассылка оповещений модераторам и госслужащим с учетом лимитов Telegram
+notifier = Notifier()
+
+# Кэш готовых карточек обращений (подписи и клавиатуры)
+report_cards = ReportCards()
+
 
 # Состояния для ConversationHandler
 CATEGORY, DESCRIPTION, LOCATION, PHOTO, CONFIRM = range(5)
 COMMENT = 0  # Для ввода комментария при изменении статуса
+NEARBY_LOCATION = 0  # Для ожидания геолокации в /nearby
+SUBSCRIBE_CATEGORY, SUBSCRIBE_AREA, SUBSCRIBE_RADIUS = range(3)  # Для настройки подписки /subscribe
+
+# Количество обращений на одной странице /myreports и длина описания в списке
+MY_REPORTS_PAGE_SIZE = 5
+MY_REPORTS_DESCRIPTION_LIMIT = 200
+
+# Количество обращений на странице /pending_reports и /all_reports (не больше 10 - размер альбома Telegram)
+REPORTS_PAGE_SIZE = 10
+
+# Радиус поиска /nearby по умолчанию (км), максимальный радиус и количество результатов
+NEARBY_DEFAULT_RADIUS_KM = 5
+NEARBY_MAX_RADIUS_KM = 100
+NEARBY_LIMIT = 10
+
+# Сколько секунд при подтверждении обращения ждать хеш фото для поиска дубликатов
+PHOTO_HASH_TIMEOUT = 2
+
+# Максимальный радиус района подписки госслужащего (км) и текст кнопки подписки на всю страну
+SUBSCRIBE_MAX_RADIUS_KM = 500
+SUBSCRIBE_EVERYWHERE = "Вся страна"
+
+# Статусы для фильтров /export и /search, максимальный размер документа (лимит Bot API - 50 МБ)
+# и таймаут его загрузки в Telegram (секунды)
+REPORT_STATUSES = ["На модерации", "Новое", "В обработке", "Проверка", "Подтверждено", "Решено", "Отклонено",
+                   "Отклонено модератором"]
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+EXPORT_UPLOAD_TIMEOUT = 300
+EXPORT_USAGE = (
+    "Использование: /export csv|geojson [status=СТАТУС] [category=КАТЕГОРИЯ] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]\n\n"
+    "Например: /export geojson category=Незаконная свалка from=2024-01-01"
+)
+
+# Количество результатов на странице /search
+SEARCH_PAGE_SIZE = 5
+SEARCH_USAGE = (
+    "Использование: /search ТЕКСТ [status=СТАТУС] [category=КАТЕГОРИЯ]\n\n"
+    "Например: /search свалка у реки status=Новое"
+)
 
 # Категории нарушений
 VIOLATION_CATEGORIES = [
@@ -30,78 +94,26 @@ VIOLATION_CATEGORIES = [
     "Другое"
 ]
 
-
-# Создание базы данных
-def setup_database():
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    # Таблица пользователей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            role TEXT DEFAULT 'user',
-            reg_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Таблица обращений
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS reports (
-            report_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            category TEXT,
-            description TEXT,
-            latitude REAL,
-            longitude REAL,
-            photo_id TEXT,
-            status TEXT DEFAULT 'На модерации',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    ''')
-
-    # Таблица обновлений статуса
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS status_updates (
-            update_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            report_id INTEGER,
-            official_id INTEGER,
-            status TEXT,
-            comment TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (report_id) REFERENCES reports(report_id),
-            FOREIGN KEY (official_id) REFERENCES users(user_id)
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
+# Клавиатуры выбора категории (для /report и /subscribe) не зависят от пользователя и создаются один раз
+CATEGORY_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(category, callback_data=f"cat_{category}")] for category in VIOLATION_CATEGORIES
+])
+SUBSCRIBE_CATEGORY_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("Все категории", callback_data="subcat_all")]] +
+    [[InlineKeyboardButton(category, callback_data=f"subcat_{index}")]
+     for index, category in enumerate(VIOLATION_CATEGORIES)]
+)
 
 
 # Регистрация пользователя
-def register_user(update: Update):
+async def register_user(update: Update):
     user = update.effective_user
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-                   INSERT
-                   OR IGNORE INTO users (user_id, username, first_name, last_name, role, reg_date)
-    VALUES (?, ?, ?, ?, ?, ?)
-                   ''', (user.id, user.username, user.first_name, user.last_name, 'user', datetime.now()))
-
-    conn.commit()
-    conn.close()
+    await storage.register_user(user.id, user.username, user.first_name, user.last_name)
 
 
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    register_user(update)
+    await register_user(update)
 
     await update.message.reply_text(
         f"Добро пожаловать в бот Signal KZ!\n\n"
@@ -114,18 +126,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Начало создания обращения
 async def start_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    register_user(update)
-
-    # Создаем клавиатуру с категориями
-    keyboard = []
-    for category in VIOLATION_CATEGORIES:
-        keyboard.append([InlineKeyboardButton(category, callback_data=f"cat_{category}")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    await register_user(update)
 
     await update.message.reply_text(
         "Выберите категорию нарушения:",
-        reply_markup=reply_markup
+        reply_markup=CATEGORY_KEYBOARD
     )
 
 
@@ -192,20 +197,14 @@ async def get_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     photo_id = photo_file.file_id
     context.user_data['photo_id'] = photo_id
 
+    # Загружаем фото и считаем его хеш, пока пользователь проверяет данные
+    photo_hasher.submit(photo_id)
+
     # Отображаем данные для подтверждения
     await update.message.reply_photo(
         photo=photo_id,
-        caption=f"Проверьте данные обращения:\n\n"
-                f"Категория: {context.user_data['category']}\n"
-                f"Описание: {context.user_data['description']}\n"
-                f"Координаты: {context.user_data['latitude']}, {context.user_data['longitude']}\n\n"
-                f"Всё верно?",
-        reply_markup=InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("Да, отправить", callback_data="confirm_yes"),
-                InlineKeyboardButton("Отменить", callback_data="confirm_no")
-            ]
-        ])
+        caption=confirm_caption(context.user_data),
+        reply_markup=CONFIRM_KEYBOARD
     )
 
     return CONFIRM
@@ -218,38 +217,44 @@ async def confirm_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if query.data == "confirm_yes":
         user_id = update.effective_user.id
-
-        # Сохраняем обращение в БД
-        conn = sqlite3.connect('signal_kz.db')
-        cursor = conn.cursor()
-
-        cursor.execute('''
-                       INSERT INTO reports
-                       (user_id, category, description, latitude, longitude, photo_id, status, created_at, updated_at)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                       ''', (
-                           user_id,
-                           context.user_data['category'],
-                           context.user_data['description'],
-                           context.user_data['latitude'],
-                           context.user_data['longitude'],
-                           context.user_data['photo_id'],
-                           'На модерации',
-                           datetime.now(),
-                           datetime.now()
-                       ))
-
-        report_id = cursor.lastrowid
-        conn.commit()
-        await notify_moderators(context, report_id, context.user_data)
-        conn.close()
-
-        # Оповещаем пользователя
-        await query.edit_message_caption(
-            caption=f"Ваше обращение №{report_id} успешно отправлено на модерацию!\n\n"
-                    f"Вы можете отслеживать его статус с помощью команды /myreports"
+        photo_id = context.user_data['photo_id']
+        photo_hash = await photo_hasher.get(photo_id, PHOTO_HASH_TIMEOUT)
+
+        # Сохраняем обращение в БД (дубликат открытого обращения присоединяется к нему)
+        report_id, cluster_id = await storage.create_report(
+            user_id,
+            context.user_data['category'],
+            context.user_data['description'],
+            context.user_data['latitude'],
+            context.user_data['longitude'],
+            photo_id,
+            photo_hash
         )
 
+        # Хеш не успел вычислиться - сохраним его позже для поиска следующих дубликатов
+        if photo_hash is None:
+            photo_hasher.index_later(report_id, photo_id)
+
+        if cluster_id is None:
+            # Оповещения модераторам записаны в outbox вместе с обращением и уходят в фоне
+            outbox_worker.wake()
+
+            # Оповещаем пользователя
+            await query.edit_message_caption(
+                caption=f"Ваше обращение №{report_id} успешно отправлено на модерацию!\n\n"
+                        f"Вы можете отслеживать его статус с помощью команды /myreports"
+            )
+        else:
+            # У основного обращения изменилось число дубликатов
+            report_cards.invalidate(cluster_id)
+
+            await query.edit_message_caption(
+                caption=f"Ваше обращение №{report_id} принято!\n\n"
+                        f"Об этом нарушении уже сообщили (обращение №{cluster_id}), "
+                        f"поэтому ваше обращение объединено с ним и получит тот же статус.\n"
+                        f"Вы можете отслеживать его статус с помощью команды /myreports"
+            )
+
         # Очищаем данные
         context.user_data.clear()
 
@@ -263,45 +268,15 @@ async def confirm_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-# Оповещение модераторов о новом обращении
-async def notify_moderators(context, report_id, report_data):
-    print(report_data)
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    # Получаем список всех модераторов
-    cursor.execute('''
-    SELECT user_id FROM users WHERE role = "moderator"
-    ''')
-    moderators = cursor.fetchall()
-    print(moderators)
-    conn.close()
-
-    # Отправляем уведомление каждому модератору
-    for moderator in moderators:
-        moderator_id = moderator[0]
-        print(moderator_id)
-        try:
-            await context.bot.send_photo(
-                chat_id=moderator_id,
-                photo=report_data['photo_id'],
-                caption=f"🚨 НОВОЕ ОБРАЩЕНИЕ НА МОДЕРАЦИИ №{report_id} 🚨\n\n"
-                        f"Категория: {report_data['category']}\n"
-                        f"Описание: {report_data['description']}\n"
-                        f"Координаты: {report_data['latitude']}, {report_data['longitude']}\n\n",
-                reply_markup=InlineKeyboardMarkup([
-                    [
-                        InlineKeyboardButton("Одобрить", callback_data=f"mod_approve_{report_id}"),
-                        InlineKeyboardButton("Отклонить", callback_data=f"mod_reject_{report_id}")
-                    ],
-                    [InlineKeyboardButton(
-                        "Открыть на карте",
-                        url=f"https://www.google.com/maps/search/?api=1&query={report_data['latitude']},{report_data['longitude']}"
-                    )]
-                ])
-            )
-        except Exception as e:
-            logging.error(f"Ошибка при отправке уведомления модератору {moderator_id}: {e}")
+# Оповещение модератора о новом обращении
+async def notify_moderator(bot, moderator_id, report_data):
+    caption, reply_markup = report_cards.moderation(report_data)
+    await bot.send_photo(
+        chat_id=moderator_id,
+        photo=report_data['photo_id'],
+        caption=caption,
+        reply_markup=reply_markup
+    )
 
 
 # Обработка решения модератора
@@ -313,152 +288,163 @@ async def moderator_decision(update: Update, context: ContextTypes.DEFAULT_TYPE)
     action = data[1]  # approve или reject
     report_id = int(data[2])
 
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
     # Получаем информацию об обращении
-    cursor.execute('SELECT * FROM reports WHERE report_id = ?', (report_id,))
-    report = cursor.fetchone()
+    report = await storage.get_report(report_id)
 
     if not report:
         await query.edit_message_text("Обращение не найдено.")
-        conn.close()
         return
 
     if action == "approve":
-        # Обновляем статус на "Новое"
-        cursor.execute('UPDATE reports SET status = "Новое", updated_at = ? WHERE report_id = ?',
-                       (datetime.now(), report_id))
-        conn.commit()
-
-        # Получаем данные для оповещения госорганов
-        cursor.execute('''
-                       SELECT r.category, r.description, r.latitude, r.longitude, r.photo_id, r.user_id
-                       FROM reports r
-                       WHERE r.report_id = ?
-                       ''', (report_id,))
-        report_data = cursor.fetchone()
-
-        report_info = {
-            'category': report_data[0],
-            'description': report_data[1],
-            'latitude': report_data[2],
-            'longitude': report_data[3],
-            'photo_id': report_data[4],
-            'user_id': report_data[5]
-        }
-
-        # Оповещаем всех госслужащих
-        await notify_officials(context, report_id, report_info)
-
-        # Оповещаем пользователя об одобрении
-        try:
-            await context.bot.send_message(
-                chat_id=report_info['user_id'],
-                text=f"✅ Ваше обращение №{report_id} одобрено модератором и передано в работу!"
-            )
-        except Exception as e:
-            logging.error(f"Ошибка при оповещении пользователя: {e}")
+        # Обновляем статус на "Новое"; оповещения госслужащим и пользователю
+        # ставятся в очередь в той же транзакции
+        await storage.approve_report(report_id)
+        report_cards.invalidate(report_id)
+        outbox_worker.wake()
+        result = f"✅ Обращение №{report_id} одобрено и передано госорганам."
 
-        await query.edit_message_caption(
-            caption=f"✅ Обращение №{report_id} одобрено и передано госорганам."
+    else:  # reject
+        # Обновляем статус на "Отклонено модератором" и ставим в очередь оповещение пользователя
+        await storage.reject_report(report_id)
+        report_cards.invalidate(report_id)
+        outbox_worker.wake()
+        result = f"❌ Обращение №{report_id} отклонено."
+
+    if query.message.photo:
+        await query.edit_message_caption(caption=result)
+    else:
+        # Решение из сводного списка /pending_reports: отмечаем его и убираем кнопки этого обращения
+        await query.edit_message_text(
+            f"{query.message.text}\n{result}",
+            reply_markup=remove_item_buttons(query.message.reply_markup, report_id, REPORT_ACTION_PREFIXES)
         )
 
-    else:  # reject
-        # Обновляем статус на "Отклонено модератором"
-        cursor.execute('UPDATE reports SET status = "Отклонено модератором", updated_at = ? WHERE report_id = ?',
-                       (datetime.now(), report_id))
-        conn.commit()
 
-        # Получаем user_id для оповещения
-        cursor.execute('SELECT user_id FROM reports WHERE report_id = ?', (report_id,))
-        user_id = cursor.fetchone()[0]
+# Оповещение госслужащего о новом одобренном обращении
+async def notify_official(bot, official_id, report_data):
+    caption, reply_markup = report_cards.official(report_data)
+    await bot.send_photo(
+        chat_id=official_id,
+        photo=report_data['photo_id'],
+        caption=caption,
+        reply_markup=reply_markup
+    )
 
-        # Оповещаем пользователя об отклонении
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"❌ Ваше обращение №{report_id} отклонено модератором."
-            )
-        except Exception as e:
-            logging.error(f"Ошибка при оповещении пользователя: {e}")
 
-        await query.edit_message_caption(
-            caption=f"❌ Обращение №{report_id} отклонено."
+# Доставка одного сообщения из очереди оповещений (outbox)
+async def deliver_outbox_message(bot, message):
+    kind = message['kind']
+    chat_id = message['chat_id']
+    report_id = message['report_id']
+
+    if kind == "moderation":
+        await notify_moderator(bot, chat_id, message)
+    elif kind == "official":
+        await notify_official(bot, chat_id, message)
+    elif kind == "approved":
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"✅ Ваше обращение №{report_id} одобрено модератором и передано в работу!"
         )
-
-    conn.close()
+    elif kind == "rejected":
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"❌ Ваше обращение №{report_id} отклонено модератором."
+        )
+    elif kind == "status":
+        payload = json.loads(message['payload'])
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"📣 Обновление статуса обращения №{report_id}\n\n"
+                 f"Новый статус: {payload['status']}\n"
+                 f"Комментарий: {payload['comment']}"
+        )
+    else:
+        logging.error(f"Неизвестный тип оповещения: {kind}")
 
 
-# Оповещение госслужащих о новом одобренном обращении
-async def notify_officials(context, report_id, report_data):
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
+# Очередь оповещений: сообщения пишутся в БД вместе с изменением обращения
+# и доставляются фоновой задачей, поэтому не теряются при перезапуске
+outbox_worker = OutboxWorker(storage, notifier, deliver_outbox_message)
 
-    # Получаем список всех госслужащих
-    cursor.execute('SELECT user_id FROM users WHERE role = "official"')
-    officials = cursor.fetchall()
-    conn.close()
+# Перцептивные хеши фото обращений для поиска повторно присланных фото
+photo_hasher = PhotoHasher(storage)
 
-    # Отправляем уведомление каждому госслужащему
-    for official in officials:
-        official_id = official[0]
+# Перенос закрытых обращений в архив через ARCHIVE_AFTER_DAYS дней после последнего изменения
+# (0 отключает архивацию)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+report_archiver = ReportArchiver(storage, timedelta(days=ARCHIVE_AFTER_DAYS))
 
-        try:
-            await context.bot.send_photo(
-                chat_id=official_id,
-                photo=report_data['photo_id'],
-                caption=f"🚨 НОВОЕ ОБРАЩЕНИЕ №{report_id} 🚨\n\n"
-                        f"Категория: {report_data['category']}\n"
-                        f"Описание: {report_data['description']}\n"
-                        f"Координаты: {report_data['latitude']}, {report_data['longitude']}\n\n"
-                        f"Для изменения статуса используйте команду /update_status {report_id}",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(
-                        "Открыть на карте",
-                        url=f"https://www.google.com/maps/search/?api=1&query={report_data['latitude']},{report_data['longitude']}"
-                    )],
-                    [InlineKeyboardButton("Изменить статус", callback_data=f"change_status_{report_id}")]
-                ])
-            )
-        except Exception as e:
-            logging.error(f"Ошибка при отправке уведомления госслужащему {official_id}: {e}")
+# Ограничение частоты запросов одного пользователя; лимиты ролей можно переопределить
+# в THROTTLE_LIMITS, например "user=0.5/12,moderator=5/60"
+user_throttle = UserThrottle(storage, {**DEFAULT_LIMITS, **parse_limits(os.getenv("THROTTLE_LIMITS", ""))})
 
 
-# Просмотр своих обращений
+# Просмотр своих обращений: одно сообщение со страницей обращений и кнопками листания
 async def my_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
+    reports, has_newer, has_older = await storage.get_user_reports_page(user_id, MY_REPORTS_PAGE_SIZE)
 
-    cursor.execute('''
-                   SELECT report_id, category, description, status, created_at
-                   FROM reports
-                   WHERE user_id = ?
-                   ORDER BY created_at DESC
-                   ''', (user_id,))
+    if not reports:
+        await update.message.reply_text("У вас пока нет обращений.")
+        return
 
-    reports = cursor.fetchall()
-    conn.close()
+    text, reply_markup = render_my_reports_page(reports, has_newer, has_older)
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
+
+# Листание списка своих обращений (редактирует то же сообщение)
+async def my_reports_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    data = query.data.split("_")
+    direction = data[1]  # older или newer
+    anchor_id = int(data[2])
+    user_id = update.effective_user.id
+
+    if direction == "older":
+        page = await storage.get_user_reports_page(user_id, MY_REPORTS_PAGE_SIZE, older_than=anchor_id)
+    else:
+        page = await storage.get_user_reports_page(user_id, MY_REPORTS_PAGE_SIZE, newer_than=anchor_id)
+
+    reports, has_newer, has_older = page
     if not reports:
-        await update.message.reply_text("У вас пока нет обращений.")
         return
 
+    text, reply_markup = render_my_reports_page(reports, has_newer, has_older)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+
+# Текст и клавиатура страницы списка обращений
+def render_my_reports_page(reports, has_newer, has_older):
+    text = "Ваши обращения:\n\n"
+    keyboard = []
+
     for report in reports:
         report_id, category, description, status, created_at = report
+        if len(description) > MY_REPORTS_DESCRIPTION_LIMIT:
+            description = description[:MY_REPORTS_DESCRIPTION_LIMIT] + "…"
 
-        await update.message.reply_text(
+        text += (
             f"Обращение №{report_id}\n"
             f"Категория: {category}\n"
             f"Описание: {description}\n"
             f"Статус: {status}\n"
-            f"Дата создания: {created_at}\n",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"Подробнее о №{report_id}", callback_data=f"view_{report_id}")]
-            ])
+            f"Дата создания: {created_at}\n\n"
         )
+        keyboard.append([InlineKeyboardButton(f"Подробнее о №{report_id}", callback_data=f"view_{report_id}")])
+
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton("« Новее", callback_data=f"myreports_newer_{reports[0][0]}"))
+    if has_older:
+        navigation.append(InlineKeyboardButton("Старше »", callback_data=f"myreports_older_{reports[-1][0]}"))
+    if navigation:
+        keyboard.append(navigation)
+
+    return text, InlineKeyboardMarkup(keyboard)
 
 
 # Обработчик кнопки "Изменить статус"
@@ -471,29 +457,26 @@ async def change_status_callback(update: Update, context: ContextTypes.DEFAULT_T
 
     # Проверяем, является ли пользователь госслужащим
     user_id = update.effective_user.id
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-    role = cursor.fetchone()[0]
-    conn.close()
+    role = await storage.get_role(user_id)
 
     if role != "official":
         await query.edit_message_text("Эта функция доступна только для представителей госорганов.")
         return
 
     # Предлагаем выбрать новый статус
-    statuses = ["В обработке", "Проверка", "Подтверждено", "Решено", "Отклонено"]
-    keyboard = []
-    for status in statuses:
-        keyboard.append([InlineKeyboardButton(status, callback_data=f"status_{report_id}_{status}")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = status_keyboard(report_id)
 
-    await query.edit_message_caption(
-        caption=f"Выберите новый статус для обращения №{report_id}:",
-        reply_markup=reply_markup
-    )
+    if query.message.photo:
+        await query.edit_message_caption(
+            caption=f"Выберите новый статус для обращения №{report_id}:",
+            reply_markup=reply_markup
+        )
+    else:
+        # Сводное сообщение со списком обращений оставляем как есть
+        await query.message.reply_text(
+            f"Выберите новый статус для обращения №{report_id}:",
+            reply_markup=reply_markup
+        )
 
 
 # Обработка выбора нового статуса
@@ -533,40 +516,17 @@ async def process_status_comment(update: Update, context: ContextTypes.DEFAULT_T
     new_status = context.user_data['pending_status_update']['new_status']
     official_id = update.effective_user.id
 
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
+    # Обновляем статус обращения, добавляем запись в историю обновлений статуса
+    # и ставим в очередь уведомление пользователю, создавшему обращение
+    user_id = await storage.update_report_status(report_id, official_id, new_status, comment)
 
-    # Обновляем статус обращения
-    cursor.execute('''
-                   UPDATE reports
-                   SET status     = ?,
-                       updated_at = ?
-                   WHERE report_id = ?
-                   ''', (new_status, datetime.now(), report_id))
-
-    # Добавляем запись в историю обновлений статуса
-    cursor.execute('''
-                   INSERT INTO status_updates (report_id, official_id, status, comment, created_at)
-                   VALUES (?, ?, ?, ?, ?)
-                   ''', (report_id, official_id, new_status, comment, datetime.now()))
-
-    # Получаем информацию о пользователе, создавшем обращение
-    cursor.execute('SELECT user_id FROM reports WHERE report_id = ?', (report_id,))
-    user_id = cursor.fetchone()[0]
-
-    conn.commit()
-    conn.close()
+    if user_id is None:
+        await update.message.reply_text(f"Обращение №{report_id} не найдено.")
+        context.user_data.pop('pending_status_update', None)
+        return ConversationHandler.END
 
-    # Отправляем уведомление пользователю
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"📣 Обновление статуса обращения №{report_id}\n\n"
-                 f"Новый статус: {new_status}\n"
-                 f"Комментарий: {comment}"
-        )
-    except Exception as e:
-        logging.error(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
+    report_cards.invalidate(report_id)
+    outbox_worker.wake()
 
     await update.message.reply_text(
         f"✅ Статус обращения №{report_id} успешно обновлен на '{new_status}'."
@@ -583,12 +543,7 @@ async def update_status_command(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = update.effective_user.id
 
     # Проверяем, является ли пользователь госслужащим
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-    role = cursor.fetchone()[0]
-    conn.close()
+    role = await storage.get_role(user_id)
 
     if role != "official":
         await update.message.reply_text("Эта команда доступна только для представителей госорганов.")
@@ -602,28 +557,16 @@ async def update_status_command(update: Update, context: ContextTypes.DEFAULT_TY
     report_id = int(context.args[0])
 
     # Получаем информацию об обращении
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT * FROM reports WHERE report_id = ?', (report_id,))
-    report = cursor.fetchone()
-    conn.close()
+    report = await storage.get_report(report_id)
 
     if not report:
         await update.message.reply_text(f"Обращение №{report_id} не найдено.")
         return
 
     # Предлагаем выбрать новый статус
-    statuses = ["В обработке", "Проверка", "Подтверждено", "Решено", "Отклонено"]
-    keyboard = []
-    for status in statuses:
-        keyboard.append([InlineKeyboardButton(status, callback_data=f"status_{report_id}_{status}")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await update.message.reply_text(
         f"Выберите новый статус для обращения №{report_id}:",
-        reply_markup=reply_markup
+        reply_markup=status_keyboard(report_id)
     )
 
 
@@ -632,13 +575,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     # Проверяем роль пользователя
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    role = result[0] if result else "user"
-    conn.close()
+    role = await storage.get_role(user_id) or "user"
 
     # Базовая помощь для всех
     help_text = (
@@ -646,6 +583,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/start - Начать работу с ботом\n"
         "/report - Отправить новое обращение о нарушении\n"
         "/myreports - Просмотреть свои обращения\n"
+        "/nearby - Обращения рядом с вами\n"
         "/help - Показать эту справку\n\n"
     )
 
@@ -654,6 +592,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         help_text += (
             "Для модераторов:\n"
             "/pending_reports - Просмотреть обращения на модерации\n"
+            "/search ТЕКСТ - Поиск обращений по тексту\n"
         )
 
     # Дополнительные команды для госслужащих
@@ -662,6 +601,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Для госслужащих:\n"
             "/update_status ID - Обновить статус обращения\n"
             "/all_reports - Просмотреть все активные обращения\n"
+            "/export csv|geojson - Выгрузка обращений с фильтрами\n"
+            "/search ТЕКСТ - Поиск обращений по тексту\n"
+            "/subscribe - Подписаться на категорию и район\n"
+            "/subscriptions - Мои подписки\n"
         )
 
     # Команды для администраторов
@@ -671,6 +614,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/set_role ID ROLE - Назначить роль пользователю (user, moderator, official, admin)\n"
             "/register_official - Регистрация госслужащего\n"
             "/register_moderator - Регистрация модератора\n"
+            "/stats - Статистика обращений\n"
         )
 
     await update.message.reply_text(help_text)
@@ -681,21 +625,15 @@ async def set_role(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_id = update.effective_user.id
 
     # Проверяем, является ли пользователь админом
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT role FROM users WHERE user_id = ?', (admin_id,))
-    role = cursor.fetchone()[0]
+    role = await storage.get_role(admin_id)
 
     if role != "admin":
         await update.message.reply_text("Эта команда доступна только для администраторов.")
-        conn.close()
         return
 
     # Проверяем аргументы
     if len(context.args) != 2:
         await update.message.reply_text("Использование: /set_role USER_ID ROLE")
-        conn.close()
         return
 
     try:
@@ -703,42 +641,74 @@ async def set_role(update: Update, context: ContextTypes.DEFAULT_TYPE):
         new_role = context.args[1]
     except ValueError:
         await update.message.reply_text("Неверный формат ID пользователя.")
-        conn.close()
-        return
-
-    # Проверяем, существует ли пользователь
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-
-    if not user:
-        await update.message.reply_text(f"Пользователь с ID {user_id} не найден.")
-        conn.close()
         return
 
     # Проверяем, является ли роль допустимой
     if new_role not in ["user", "moderator", "official", "admin"]:
         await update.message.reply_text("Допустимые роли: user, moderator, official, admin")
-        conn.close()
         return
 
-    # Обновляем роль
-    cursor.execute('UPDATE users SET role = ? WHERE user_id = ?', (new_role, user_id))
-    conn.commit()
-    conn.close()
+    # Обновляем роль (заодно проверяем, существует ли пользователь)
+    if not await storage.set_role(user_id, new_role):
+        await update.message.reply_text(f"Пользователь с ID {user_id} не найден.")
+        return
 
     await update.message.reply_text(f"Роль пользователя с ID {user_id} изменена на {new_role}.")
 
 
+# Статистика по обращениям (для админов)
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+
+    role = await storage.get_role(user_id)
+
+    if role != "admin":
+        await update.message.reply_text("Эта команда доступна только для администраторов.")
+        return
+
+    report_stats = await storage.get_stats()
+
+    by_status = {}
+    by_category = {}
+    for (category, status), count in report_stats['totals'].items():
+        by_status[status] = by_status.get(status, 0) + count
+        by_category[category] = by_category.get(category, 0) + count
+
+    closed = by_status.get("Решено", 0) + by_status.get("Отклонено", 0) + by_status.get("Отклонено модератором", 0)
+    moderation = by_status.get("На модерации", 0)
+    total = sum(by_status.values())
+
+    message = (
+        "📊 Статистика обращений\n\n"
+        f"Всего: {total}\n"
+        f"На модерации: {moderation}\n"
+        f"В работе: {total - closed - moderation}\n"
+        f"Решено: {by_status.get('Решено', 0)}\n"
+        f"Отклонено: {by_status.get('Отклонено', 0) + by_status.get('Отклонено модератором', 0)}\n"
+    )
+
+    hours = report_stats['median_resolution_hours']
+    if hours is not None:
+        message += f"Медианное время решения: {hours} ч\n" if hours < 48 else f"Медианное время решения: {hours // 24} дн.\n"
+
+    if by_category:
+        message += "\nПо категориям:\n"
+        for category, count in sorted(by_category.items(), key=lambda item: -item[1]):
+            message += f"{category}: {count}\n"
+
+    if report_stats['daily']:
+        message += "\nНовые обращения за 7 дней:\n"
+        for day, count in report_stats['daily']:
+            message += f"{day}: {count}\n"
+
+    await update.message.reply_text(message)
+
+
 # Регистрация госслужащего
 async def register_official(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    cursor.execute('UPDATE users SET role = "official" WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    await storage.set_role(user_id, "official")
 
     await update.message.reply_text(
         "Вы успешно зарегистрированы как представитель госоргана.\n"
@@ -750,12 +720,7 @@ async def register_official(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def register_moderator(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    cursor.execute('UPDATE users SET role = "moderator" WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    await storage.set_role(user_id, "moderator")
 
     await update.message.reply_text(
         "Вы успешно зарегистрированы как модератор.\n"
@@ -768,134 +733,521 @@ async def pending_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     # Проверяем, является ли пользователь модератором
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-    role = cursor.fetchone()[0]
+    role = await storage.get_role(user_id)
 
     if role != "moderator" and role != "admin":
         await update.message.reply_text("Эта команда доступна только для модераторов.")
-        conn.close()
         return
 
-    ## Просмотр ожидающих модерации обращений
-async def pending_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    await send_pending_reports_page(update.message)
 
-    # Проверяем, является ли пользователь модератором
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
 
-    cursor.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-    role = cursor.fetchone()[0]
+# Следующая страница обращений на модерации
+async def pending_reports_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
 
+    role = await storage.get_role(update.effective_user.id)
     if role != "moderator" and role != "admin":
-        await update.message.reply_text("Эта команда доступна только для модераторов.")
-        conn.close()
         return
 
-    # Получаем список обращений на модерации
-    cursor.execute('''
-    SELECT report_id, category, description, created_at FROM reports 
-    WHERE status = 'На модерации'
-    ORDER BY created_at DESC
-    ''')
+    await remove_next_page_button(query, "pending_")
+    await send_pending_reports_page(query.message, older_than=int(query.data.split("_")[1]))
+
 
-    reports = cursor.fetchall()
-    conn.close()
+async def send_pending_reports_page(message, older_than=None):
+    # Получаем страницу обращений на модерации вместе с фото и координатами
+    reports, has_more = await storage.get_pending_reports(REPORTS_PAGE_SIZE, older_than)
 
     if not reports:
-        await update.message.reply_text("На данный момент нет обращений, ожидающих модерации.")
+        await message.reply_text("На данный момент нет обращений, ожидающих модерации.")
         return
 
-    for report in reports:
-        report_id, category, description, created_at = report
-
-        # Получаем фото и другие данные для отображения
-        conn = sqlite3.connect('signal_kz.db')
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT photo_id, latitude, longitude FROM reports WHERE report_id = ?', (report_id,))
-        photo_id, latitude, longitude = cursor.fetchone()
-        conn.close()
-
-        await update.message.reply_photo(
-            photo=photo_id,
-            caption=f"Обращение №{report_id}\n"
-                   f"Категория: {category}\n"
-                   f"Описание: {description}\n"
-                   f"Дата создания: {created_at}\n"
-                   f"Координаты: {latitude}, {longitude}",
-            reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("Одобрить", callback_data=f"mod_approve_{report_id}"),
-                    InlineKeyboardButton("Отклонить", callback_data=f"mod_reject_{report_id}")
-                ],
-                [InlineKeyboardButton(
-                    "Открыть на карте",
-                    url=f"https://www.google.com/maps/search/?api=1&query={latitude},{longitude}"
-                )]
-            ])
-        )
+    await send_reports_page(message, reports, "Обращения на модерации", "pending",
+                            f"pending_{reports[-1]['report_id']}" if has_more else None)
+
 
 # Просмотр всех активных обращений (для госслужащих)
 async def all_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     # Проверяем, является ли пользователь госслужащим
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
+    role = await storage.get_role(user_id)
+
+    if role != "official" and role != "admin":
+        await update.message.reply_text("Эта команда доступна только для представителей госорганов.")
+        return
+
+    await send_active_reports_page(update.message)
 
-    cursor.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-    role = cursor.fetchone()[0]
+
+# Следующая страница активных обращений
+async def all_reports_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    role = await storage.get_role(update.effective_user.id)
+    if role != "official" and role != "admin":
+        return
+
+    await remove_next_page_button(query, "allreports_")
+    await send_active_reports_page(query.message, older_than=int(query.data.split("_")[1]))
+
+
+async def send_active_reports_page(message, older_than=None):
+    # Получаем страницу активных обращений вместе с фото и координатами
+    reports, has_more = await storage.get_active_reports(REPORTS_PAGE_SIZE, older_than)
+
+    if not reports:
+        await message.reply_text("На данный момент нет активных обращений.")
+        return
+
+    await send_reports_page(message, reports, "Активные обращения", "active",
+                            f"allreports_{reports[-1]['report_id']}" if has_more else None)
+
+
+# Разбор фильтров обращений вида ключ=значение (значение может содержать пробелы) из текста команды.
+# Возвращает (текст перед фильтрами, фильтры для storage) или бросает ValueError с текстом ошибки
+def parse_report_filters(text, usage, keys=("status", "category", "from", "to")):
+    match = re.search(r'(?:^|\s)\w+=', text)
+    if not match:
+        return text.strip(), {}
+
+    filters = {}
+    for key, value in re.findall(r'(\w+)=(.*?)(?=\s+\w+=|$)', text[match.start():]):
+        value = value.strip()
+        key = key.lower()
+        if key not in keys:
+            raise ValueError(usage)
+
+        if key == "status":
+            status = next((s for s in REPORT_STATUSES if s.lower() == value.lower()), None)
+            if status is None:
+                raise ValueError("Допустимые статусы: " + ", ".join(REPORT_STATUSES))
+            filters['status'] = status
+        elif key == "category":
+            category = next((c for c in VIOLATION_CATEGORIES if c.lower() == value.lower()), None)
+            if category is None:
+                raise ValueError("Допустимые категории: " + ", ".join(VIOLATION_CATEGORIES))
+            filters['category'] = category
+        else:
+            try:
+                day = datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                raise ValueError("Дата указывается в формате ГГГГ-ММ-ДД")
+            # Дата "to" включается целиком
+            if key == "from":
+                filters['since'] = day
+            else:
+                filters['until'] = day + timedelta(days=1)
+
+    return text[:match.start()].strip(), filters
+
+
+# Разбор аргументов /export: формат и фильтры
+def parse_export_args(args):
+    if not args or args[0].lower() not in EXPORT_FORMATS:
+        raise ValueError(EXPORT_USAGE)
+
+    rest, filters = parse_report_filters(" ".join(args[1:]), EXPORT_USAGE)
+    if rest:
+        raise ValueError(EXPORT_USAGE)
+
+    return args[0].lower(), filters
+
+
+# Выгрузка обращений в CSV или GeoJSON (для госслужащих). Обращения читаются из БД пачками
+# и сразу сжимаются во временный файл, который отправляется одним документом
+async def export_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+
+    role = await storage.get_role(user_id)
 
     if role != "official" and role != "admin":
         await update.message.reply_text("Эта команда доступна только для представителей госорганов.")
-        conn.close()
         return
 
-    # Получаем список активных обращений
-    cursor.execute('''
-    SELECT report_id, category, description, status, created_at FROM reports 
-    WHERE status != 'На модерации' AND status != 'Отклонено модератором' AND status != 'Решено'
-    ORDER BY created_at DESC LIMIT 10
-    ''')
+    try:
+        export_format, filters = parse_export_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+
+    await update.message.reply_text("Готовим выгрузку, это может занять некоторое время...")
+
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryFile() as file:
+        export = ReportExport(export_format, file)
+        try:
+            async for rows in storage.iter_reports(**filters):
+                await loop.run_in_executor(None, export.write, rows)
+        finally:
+            await loop.run_in_executor(None, export.close)
+
+        if export.count == 0:
+            await update.message.reply_text("Нет обращений, подходящих под условия выгрузки.")
+            return
+
+        if file.tell() > EXPORT_MAX_BYTES:
+            await update.message.reply_text(
+                "Выгрузка получилась слишком большой для отправки в Telegram. Сузьте фильтры по дате."
+            )
+            return
+
+        file.seek(0)
+        await update.message.reply_document(
+            document=file,
+            filename=export.filename,
+            caption=f"Выгрузка обращений: {export.count}",
+            write_timeout=EXPORT_UPLOAD_TIMEOUT
+        )
+
+
+# Полнотекстовый поиск обращений (для модераторов и госслужащих): /search текст [status=...] [category=...]
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    role = await storage.get_role(update.effective_user.id)
+
+    if role not in ("moderator", "official", "admin"):
+        await update.message.reply_text("Эта команда доступна только для модераторов и представителей госорганов.")
+        return
+
+    try:
+        text, filters = parse_report_filters(" ".join(context.args), SEARCH_USAGE, keys=("status", "category"))
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+
+    if not text:
+        await update.message.reply_text(SEARCH_USAGE)
+        return
+
+    # Запрос запоминаем для листания страниц результатов
+    context.user_data['search'] = {'text': text, **filters}
+
+    reports, has_more = await storage.search_reports(text, SEARCH_PAGE_SIZE, **filters)
+
+    if not reports:
+        await update.message.reply_text("По вашему запросу ничего не найдено.")
+        return
+
+    message, reply_markup = render_search_page(text, reports, 0, has_more)
+    await update.message.reply_text(message, reply_markup=reply_markup)
+
+
+# Листание результатов поиска (редактирует то же сообщение)
+async def search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    role = await storage.get_role(update.effective_user.id)
+    search_query = context.user_data.get('search')
+    if role not in ("moderator", "official", "admin") or not search_query:
+        return
 
-    reports = cursor.fetchall()
-    conn.close()
+    offset = int(query.data.split("_")[1])
+    filters = dict(search_query)
+    text = filters.pop('text')
 
+    reports, has_more = await storage.search_reports(text, SEARCH_PAGE_SIZE, offset, **filters)
     if not reports:
-        await update.message.reply_text("На данный момент нет активных обращений.")
         return
 
+    message, reply_markup = render_search_page(text, reports, offset, has_more)
+    await query.edit_message_text(message, reply_markup=reply_markup)
+
+
+# Текст и клавиатура страницы результатов поиска
+def render_search_page(text, reports, offset, has_more):
+    message = f"Результаты поиска «{text}»:\n\n"
+    keyboard = []
+
     for report in reports:
-        report_id, category, description, status, created_at = report
+        report_id = report['report_id']
+        message += (
+            f"Обращение №{report_id}\n"
+            f"Категория: {report['category']}\n"
+            f"Статус: {report['status']}\n"
+            f"Дата создания: {report['created_at']}\n"
+            f"…{report['snippet']}\n\n"
+        )
+        keyboard.append([InlineKeyboardButton(f"Подробнее о №{report_id}", callback_data=f"view_{report_id}")])
+
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton("« Назад", callback_data=f"search_{max(0, offset - SEARCH_PAGE_SIZE)}"))
+    if has_more:
+        navigation.append(InlineKeyboardButton("Далее »", callback_data=f"search_{offset + SEARCH_PAGE_SIZE}"))
+    if navigation:
+        keyboard.append(navigation)
+
+    return message, InlineKeyboardMarkup(keyboard)
+
+
+# Отправка страницы обращений: фото одним альбомом и одно сводное сообщение с кнопками действий.
+# audience - 'pending' (модерация) или 'active' (изменение статуса)
+async def send_reports_page(message, reports, title, audience, next_page_callback):
+    media = []
+    keyboard = []
+    summary = f"{title}:\n\n"
+
+    for report in reports:
+        caption, buttons = report_cards.page_item(report, audience)
+        media.append(InputMediaPhoto(report['photo_id'], caption=caption))
+        keyboard.append(buttons)
+
+        summary += f"№{report['report_id']} - {report['category']} ({report['created_at']})"
+        if report['duplicates']:
+            summary += f", похожих: {report['duplicates']}"
+        summary += "\n"
+
+    if next_page_callback:
+        keyboard.append([InlineKeyboardButton("Следующие »", callback_data=next_page_callback)])
+
+    # Альбом - от 2 фото, одно фото отправляется отдельно
+    if len(media) == 1:
+        await message.reply_photo(media[0].media, caption=media[0].caption)
+    else:
+        await message.reply_media_group(media)
+    await message.reply_text(summary, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+# Кнопки действий с обращением в сводном сообщении страницы
+REPORT_ACTION_PREFIXES = ("mod_approve_", "mod_reject_", "change_status_")
+
+
+# Убираем кнопку "Следующие" (callback_data с префиксом prefix) у уже показанной страницы,
+# чтобы она не открывалась повторно
+async def remove_next_page_button(query, prefix):
+    keyboard = [
+        row for row in query.message.reply_markup.inline_keyboard
+        if not any(button.callback_data and button.callback_data.startswith(prefix) for button in row)
+    ]
+    await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+# Убираем из сообщения кнопки, относящиеся к обращению (или подписке) item_id:
+# кнопки с callback_data вида "<префикс><item_id>" для каждого из prefixes
+def remove_item_buttons(reply_markup, item_id, prefixes):
+    callbacks = {f"{prefix}{item_id}" for prefix in prefixes}
+    return InlineKeyboardMarkup([
+        row for row in reply_markup.inline_keyboard
+        if not any(button.callback_data in callbacks for button in row)
+    ])
+
+
+# Поиск обращений рядом: /nearby [радиус в км]
+async def nearby(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    radius_km = NEARBY_DEFAULT_RADIUS_KM
+    if context.args:
+        try:
+            radius_km = float(context.args[0].replace(",", "."))
+        except ValueError:
+            await update.message.reply_text("Использование: /nearby [радиус в км]")
+            return ConversationHandler.END
+
+    if not 0 < radius_km <= NEARBY_MAX_RADIUS_KM:
+        await update.message.reply_text(f"Радиус должен быть от 0 до {NEARBY_MAX_RADIUS_KM} км.")
+        return ConversationHandler.END
+
+    context.user_data['nearby_radius_km'] = radius_km
+
+    location_button = KeyboardButton(
+        "Отправить геолокацию",
+        request_location=True
+    )
+    reply_markup = ReplyKeyboardMarkup(
+        [[location_button]],
+        one_time_keyboard=True,
+        resize_keyboard=True
+    )
+
+    await update.message.reply_text(
+        f"Отправьте геолокацию, чтобы найти обращения в радиусе {radius_km:g} км.",
+        reply_markup=reply_markup
+    )
+
+    return NEARBY_LOCATION
+
+
+# Вывод обращений рядом с присланной геолокацией
+async def nearby_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    location = update.message.location
+    radius_km = context.user_data.pop('nearby_radius_km', NEARBY_DEFAULT_RADIUS_KM)
+
+    # Обращения, не прошедшие модерацию, не показываем
+    found = await storage.find_reports_within(
+        location.latitude,
+        location.longitude,
+        radius_km * 1000,
+        limit=NEARBY_LIMIT,
+        exclude_statuses=["На модерации", "Отклонено модератором"]
+    )
+
+    if not found:
+        await update.message.reply_text(
+            f"В радиусе {radius_km:g} км обращений не найдено.",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        return ConversationHandler.END
+
+    text = f"Обращения в радиусе {radius_km:g} км:\n\n"
+    keyboard = []
+    for report, distance in found:
+        report_id = report['report_id']
+        text += f"№{report_id} - {report['category']} - {report['status']} ({distance / 1000:.1f} км)\n"
+        keyboard.append([InlineKeyboardButton(f"Подробнее о №{report_id}", callback_data=f"view_{report_id}")])
+
+    await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+    await update.message.reply_text("Выберите обращение:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+    return ConversationHandler.END
+
+
+# Подписка госслужащего на категорию и район: /subscribe
+async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    role = await storage.get_role(update.effective_user.id)
+
+    if role != "official":
+        await update.message.reply_text("Эта команда доступна только для представителей госорганов.")
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        "Выберите категорию обращений, о которых хотите получать уведомления:",
+        reply_markup=SUBSCRIBE_CATEGORY_KEYBOARD
+    )
+
+    return SUBSCRIBE_CATEGORY
+
+
+# Выбор категории подписки
+async def subscribe_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    value = query.data.replace("subcat_", "")
+    category = None if value == "all" else VIOLATION_CATEGORIES[int(value)]
+    context.user_data['subscription_category'] = category
+
+    await query.edit_message_text(f"Категория: {category or 'все категории'}")
+
+    location_button = KeyboardButton(
+        "Отправить геолокацию",
+        request_location=True
+    )
+    reply_markup = ReplyKeyboardMarkup(
+        [[location_button], [KeyboardButton(SUBSCRIBE_EVERYWHERE)]],
+        one_time_keyboard=True,
+        resize_keyboard=True
+    )
+
+    await query.message.reply_text(
+        "Отправьте геолокацию центра района, за который вы отвечаете, "
+        f"или нажмите «{SUBSCRIBE_EVERYWHERE}».",
+        reply_markup=reply_markup
+    )
+
+    return SUBSCRIBE_AREA
 
-        # Получаем фото и координаты
-        conn = sqlite3.connect('signal_kz.db')
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT photo_id, latitude, longitude FROM reports WHERE report_id = ?', (report_id,))
-        photo_id, latitude, longitude = cursor.fetchone()
-        conn.close()
-
-        await update.message.reply_photo(
-            photo=photo_id,
-            caption=f"Обращение №{report_id}\n"
-                   f"Категория: {category}\n"
-                   f"Описание: {description}\n"
-                   f"Статус: {status}\n"
-                   f"Дата создания: {created_at}\n"
-                   f"Координаты: {latitude}, {longitude}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Изменить статус", callback_data=f"change_status_{report_id}")],
-                [InlineKeyboardButton(
-                    "Открыть на карте",
-                    url=f"https://www.google.com/maps/search/?api=1&query={latitude},{longitude}"
-                )]
-            ])
+
+# Подписка без ограничения по району
+async def subscribe_everywhere(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await save_subscription(update, context, None, None, None)
+
+
+# Центр района подписки
+async def subscribe_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    location = update.message.location
+    context.user_data['subscription_location'] = (location.latitude, location.longitude)
+
+    await update.message.reply_text(
+        f"Укажите радиус района в километрах (до {SUBSCRIBE_MAX_RADIUS_KM}).",
+        reply_markup=ReplyKeyboardRemove()
+    )
+
+    return SUBSCRIBE_RADIUS
+
+
+# Радиус района подписки
+async def subscribe_radius(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        radius_km = float(update.message.text.replace(",", "."))
+    except ValueError:
+        radius_km = 0
+
+    if not 0 < radius_km <= SUBSCRIBE_MAX_RADIUS_KM:
+        await update.message.reply_text(f"Введите число от 0 до {SUBSCRIBE_MAX_RADIUS_KM}.")
+        return SUBSCRIBE_RADIUS
+
+    latitude, longitude = context.user_data.pop('subscription_location')
+    return await save_subscription(update, context, latitude, longitude, radius_km * 1000)
+
+
+async def save_subscription(update, context, latitude, longitude, radius_m):
+    category = context.user_data.pop('subscription_category', None)
+    await storage.add_subscription(update.effective_user.id, category, latitude, longitude, radius_m)
+
+    await update.message.reply_text(
+        "✅ Подписка сохранена. Теперь вы будете получать только подходящие обращения.\n"
+        "Список подписок: /subscriptions",
+        reply_markup=ReplyKeyboardRemove()
+    )
+
+    return ConversationHandler.END
+
+
+# Описание подписки для списка
+def describe_subscription(subscription):
+    text = subscription.category or "Все категории"
+    if subscription.radius_m is None:
+        return f"{text}, {SUBSCRIBE_EVERYWHERE.lower()}"
+    return f"{text}, {subscription.radius_m / 1000:g} км от {subscription.latitude:.4f}, {subscription.longitude:.4f}"
+
+
+# Список подписок госслужащего с кнопками удаления
+async def subscriptions_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    role = await storage.get_role(user_id)
+
+    if role != "official":
+        await update.message.reply_text("Эта команда доступна только для представителей госорганов.")
+        return
+
+    subscriptions = storage.get_subscriptions(user_id)
+    if not subscriptions:
+        await update.message.reply_text(
+            "У вас нет подписок, поэтому вы получаете все одобренные обращения.\n"
+            "Настроить подписку: /subscribe"
         )
+        return
+
+    text = "Ваши подписки:\n\n"
+    keyboard = []
+    for subscription in subscriptions:
+        text += f"• {describe_subscription(subscription)}\n"
+        keyboard.append([InlineKeyboardButton(
+            f"Удалить: {describe_subscription(subscription)}",
+            callback_data=f"unsub_{subscription.subscription_id}"
+        )])
+
+    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+# Удаление подписки
+async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    user_id = update.effective_user.id
+    subscription_id = int(query.data.split("_")[1])
+
+    if not await storage.delete_subscription(user_id, subscription_id):
+        return
+
+    await query.edit_message_reply_markup(
+        reply_markup=remove_item_buttons(query.message.reply_markup, subscription_id, ("unsub_",))
+    )
+    await query.message.reply_text("Подписка удалена.")
+
 
 # Подробная информация об обращении
 async def view_report_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -904,68 +1256,51 @@ async def view_report_details(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     report_id = int(query.data.split("_")[1])
 
-    conn = sqlite3.connect('signal_kz.db')
-    cursor = conn.cursor()
-
     # Получаем информацию об обращении
-    cursor.execute('''
-    SELECT category, description, latitude, longitude, photo_id, status, created_at, updated_at
-    FROM reports WHERE report_id = ?
-    ''', (report_id,))
-
-    report = cursor.fetchone()
+    report = await storage.get_report(report_id)
 
     if not report:
         await query.edit_message_text("Обращение не найдено.")
-        conn.close()
         return
 
-    category, description, latitude, longitude, photo_id, status, created_at, updated_at = report
-
-    # Получаем историю изменений статуса
-    cursor.execute('''
-    SELECT s.status, s.comment, s.created_at, u.first_name, u.last_name
-    FROM status_updates s
-    JOIN users u ON s.official_id = u.user_id
-    WHERE s.report_id = ?
-    ORDER BY s.created_at DESC
-    ''', (report_id,))
-
-    status_history = cursor.fetchall()
-    conn.close()
-
-    # Формируем сообщение с деталями
-    details = f"Обращение №{report_id}\n\n"
-    details += f"Категория: {category}\n"
-    details += f"Описание: {description}\n"
-    details += f"Статус: {status}\n"
-    details += f"Дата создания: {created_at}\n"
-    details += f"Последнее обновление: {updated_at}\n"
-    details += f"Координаты: {latitude}, {longitude}\n\n"
-
-    if status_history:
-        details += "История изменений статуса:\n"
-        for sh in status_history[:3]:  # Показываем только 3 последних изменения
-            status, comment, date, first_name, last_name = sh
-            official_name = f"{first_name} {last_name}" if first_name and last_name else "Госслужащий"
-            details += f"• {date}: {status} ({official_name})\n"
-            if comment:
-                details += f"  Комментарий: {comment}\n"
+    # Карточка с историей изменений статуса (история загружается, только если карточки нет в кэше)
+    details, reply_markup = await report_cards.details(report, storage.get_status_history)
 
     # Отправляем фото с подробной информацией
     await query.message.reply_photo(
-        photo=photo_id,
+        photo=report['photo_id'],
         caption=details,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton(
-                "Открыть на карте",
-                url=f"https://www.google.com/maps/search/?api=1&query={latitude},{longitude}"
-            )]
-        ])
+        reply_markup=reply_markup
     )
 
 
+# Эндпоинт метрик в формате Prometheus (пустой METRICS_PORT отключает его)
+METRICS_PORT = os.getenv("METRICS_PORT", "9100")
+metrics_server = MetricsServer(os.getenv("METRICS_LISTEN", "127.0.0.1"), int(METRICS_PORT or 0))
+
 
+# Запуск фоновой доставки оповещений, хеширования фото, архивации и эндпоинта метрик
+# после инициализации бота
+async def start_background_tasks(application: Application):
+    outbox_worker.start(application.bot)
+    photo_hasher.start(application.bot)
+    if ARCHIVE_AFTER_DAYS > 0:
+        report_archiver.start()
+
+    if METRICS_PORT:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            logging.error(f"Не удалось запустить эндпоинт метрик: {e}")
+
+
+# Остановка фоновых задач и закрытие соединений с БД при остановке бота
+async def stop_background_tasks(application: Application):
+    await metrics_server.stop()
+    await report_archiver.stop()
+    await photo_hasher.stop()
+    await outbox_worker.stop()
+    storage.close()
 
 
 # Отмена текущего действия
@@ -974,18 +1309,23 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Действие отменено.")
     return ConversationHandler.END
 
-def main():
-    # Настройка логирования
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
+# Создание приложения со всеми обработчиками. builder - Application.builder() с уже
+# заданным токеном (и, при необходимости, собственным request для тестовых прогонов)
+def build_application(builder) -> Application:
+    # Создание приложения (очередь обновлений ограничена, чтобы при всплеске нагрузки
+    # webhook-сервер отвечал Telegram отказом, а не копил обновления в памяти).
+    # Незавершенные диалоги и user_data сохраняются в БД и переживают перезапуск
+    application = (
+        builder
+        .update_queue(asyncio.Queue(maxsize=int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))))
+        .persistence(SQLitePersistence(storage))
+        .post_init(start_background_tasks)
+        .post_shutdown(stop_background_tasks)
+        .build()
     )
 
-    # Создание базы данных
-    setup_database()
-
-    # Создание приложения
-    application = Application.builder().token("8061380333:AAF8QAg0JDHVthZ8fLeATG1bYE4Y9FRLQ9c").build()
+    # Ограничение частоты обновлений от пользователя - раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, user_throttle.throttle), group=-1)
 
     # Добавление обработчиков команд
     application.add_handler(CommandHandler("start", start))
@@ -996,7 +1336,10 @@ def main():
     application.add_handler(CommandHandler("register_moderator", register_moderator))
     application.add_handler(CommandHandler("pending_reports", pending_reports))
     application.add_handler(CommandHandler("all_reports", all_reports))
+    application.add_handler(CommandHandler("export", export_reports))
+    application.add_handler(CommandHandler("search", search))
     application.add_handler(CommandHandler("set_role", set_role))
+    application.add_handler(CommandHandler("stats", stats))
 
     # Обработчик создания обращения
     report_conv_handler = ConversationHandler(
@@ -1008,7 +1351,9 @@ def main():
             PHOTO: [MessageHandler(filters.PHOTO, get_photo)],
             CONFIRM: [CallbackQueryHandler(confirm_report, pattern=r"^confirm_")]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="report",
+        persistent=True
     )
 
     application.add_handler(report_conv_handler)
@@ -1019,19 +1364,110 @@ def main():
         states={
             COMMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_status_comment)]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="status_update",
+        persistent=True
     )
 
     application.add_handler(status_update_handler)
 
+    # Обработчик поиска обращений рядом
+    nearby_handler = ConversationHandler(
+        entry_points=[CommandHandler("nearby", nearby)],
+        states={
+            NEARBY_LOCATION: [MessageHandler(filters.LOCATION, nearby_location)]
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="nearby",
+        persistent=True
+    )
+
+    application.add_handler(nearby_handler)
+
+    # Обработчик настройки подписки госслужащего
+    subscribe_handler = ConversationHandler(
+        entry_points=[CommandHandler("subscribe", subscribe)],
+        states={
+            SUBSCRIBE_CATEGORY: [CallbackQueryHandler(subscribe_category, pattern=r"^subcat_")],
+            SUBSCRIBE_AREA: [
+                MessageHandler(filters.LOCATION, subscribe_location),
+                MessageHandler(filters.Text([SUBSCRIBE_EVERYWHERE]), subscribe_everywhere)
+            ],
+            SUBSCRIBE_RADIUS: [MessageHandler(filters.TEXT & ~filters.COMMAND, subscribe_radius)]
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="subscribe",
+        persistent=True
+    )
+
+    application.add_handler(subscribe_handler)
+    application.add_handler(CommandHandler("subscriptions", subscriptions_list))
+
     # Обработчики колбэков
     application.add_handler(CallbackQueryHandler(moderator_decision, pattern=r"^mod_"))
     application.add_handler(CallbackQueryHandler(change_status_callback, pattern=r"^change_status_"))
     application.add_handler(CallbackQueryHandler(view_report_details, pattern=r"^view_"))
+    application.add_handler(CallbackQueryHandler(my_reports_page, pattern=r"^myreports_"))
+    application.add_handler(CallbackQueryHandler(pending_reports_page, pattern=r"^pending_"))
+    application.add_handler(CallbackQueryHandler(all_reports_page, pattern=r"^allreports_"))
+    application.add_handler(CallbackQueryHandler(unsubscribe, pattern=r"^unsub_"))
+    application.add_handler(CallbackQueryHandler(search_page, pattern=r"^search_"))
+
+    # Метрики: время работы всех обработчиков и показатели, вычисляемые при опросе
+    # (размер очереди оповещений обновляется раз в depth_log_interval)
+    instrument_handlers(application)
+    Gauge('signal_conversations_active', "Незавершенные диалоги", ['conversation'],
+          lambda: {(name,): count for name, count in application.persistence.active_conversations().items()})
+    Gauge('signal_outbox_messages', "Сообщения в очереди оповещений по статусам", ['status'],
+          lambda: {(status,): count for status, count in outbox_worker.depth.items()})
+    Gauge('signal_update_queue_size', "Обновления, ожидающие обработки", callback=application.update_queue.qsize)
+
+    return application
+
 
-    # Запуск бота
-    application.run_polling()
+def main():
+    # Настройка логирования
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    # Webhook без секретного токена принимал бы поддельные обновления от кого угодно
+    webhook_mode = os.getenv("BOT_MODE", "polling") == "webhook"
+    if webhook_mode and not os.getenv("WEBHOOK_SECRET"):
+        logging.error("BOT_MODE=webhook требует WEBHOOK_SECRET")
+        sys.exit(1)
+
+    # Создание базы данных и пула соединений
+    storage.setup()
+
+    # Запросы к Bot API проходят через обертку, замеряющую их время
+    builder = (
+        Application.builder()
+        .token("8061380333:AAF8QAg0JDHVthZ8fLeATG1bYE4Y9FRLQ9c")
+        .request(InstrumentedRequest(HTTPXRequest(connection_pool_size=256)))
+        .get_updates_request(InstrumentedRequest(HTTPXRequest()))
+    )
+
+    # Другой адрес Bot API, например локальный fake_bot_api.py для нагрузочных прогонов
+    api_url = os.getenv("BOT_API_URL")
+    if api_url:
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+
+    application = build_application(builder)
+
+    # Запуск бота: BOT_MODE=webhook - встроенный webhook-сервер, иначе long polling
+    if webhook_mode:
+        asyncio.run(run_webhook(
+            application,
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("PORT", "8443")),
+            path=os.getenv("WEBHOOK_PATH", "/telegram"),
+            webhook_url=os.getenv("WEBHOOK_URL"),
+            secret_token=os.getenv("WEBHOOK_SECRET")
+        ))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
+    main()
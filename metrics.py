@@ -0,0 +1,265 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import logging
+import re
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence
+
+from telegram.ext import Application, ApplicationHandlerStop, ConversationHandler
+from telegram.request import BaseRequest
+
+# Границы корзин гистограмм задержек, в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Зарегистрированные метрики по имени (повторная регистрация заменяет метрику)
+REGISTRY: Dict[str, 'Metric'] = {}
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        REGISTRY[name] = self
+
+    def samples(self):
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+# Счетчик. Может увеличиваться из потоков пула хранилища, поэтому под блокировкой
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, description, labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in values]
+
+
+# Гистограмма с фиксированными корзинами: observe - двоичный поиск корзины и пара сложений
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # Корзины, затем +Inf и сумма
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+
+        lines = []
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+# Показатель, значение которого вычисляется в момент опроса. callback возвращает
+# число (метрика без меток) или словарь {кортеж значений меток: число}
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = (),
+                 callback: Callable = None):
+        super().__init__(name, description, labelnames)
+        self.callback = callback
+
+    def samples(self):
+        try:
+            values = self.callback()
+        except Exception as e:
+            logging.error(f"Ошибка вычисления метрики {self.name}: {e}")
+            return []
+
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in values.items()]
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in REGISTRY.values()) + '\n'
+
+
+HANDLER_SECONDS = Histogram('signal_handler_seconds', "Время работы обработчиков обновлений", ['handler'])
+HANDLER_ERRORS = Counter('signal_handler_errors_total', "Исключения в обработчиках обновлений", ['handler'])
+DB_SECONDS = Histogram('signal_db_operation_seconds', "Время выполнения транзакций хранилища", ['operation'])
+DB_ERRORS = Counter('signal_db_errors_total', "Ошибки транзакций хранилища", ['operation'])
+DB_WRITE_BATCH = Histogram('signal_db_write_batch_size', "Число операций записи в одной транзакции",
+                           buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+BOT_API_SECONDS = Histogram('signal_bot_api_seconds', "Время запросов к Bot API", ['method'])
+BOT_API_ERRORS = Counter('signal_bot_api_errors_total', "Неуспешные запросы к Bot API", ['method'])
+THROTTLED_UPDATES = Counter('signal_throttled_updates_total', "Обновления, отброшенные ограничением частоты",
+                            ['role'])
+
+
+def _timed_handler(callback, name: str):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            # Штатная остановка обработки обновления (например, ограничением частоты)
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+
+    return wrapper
+
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        for nested in handler.entry_points + handler.fallbacks:
+            _instrument_handler(nested)
+        for handlers in handler.states.values():
+            for nested in handlers:
+                _instrument_handler(nested)
+    else:
+        handler.callback = _timed_handler(handler.callback, handler.callback.__name__)
+
+
+# Замер времени всех зарегистрированных обработчиков (включая шаги диалогов).
+# Вызывается после добавления обработчиков
+def instrument_handlers(application: Application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+# Имя метода Bot API (sendMessage, getFile, ...)
+API_METHOD = re.compile(r'[A-Za-z]+')
+
+
+# Обертка над HTTP-клиентом бота: время и ошибки каждого запроса к Bot API по методу
+class InstrumentedRequest(BaseRequest):
+    def __init__(self, request: BaseRequest):
+        self._request = request
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self._request.read_timeout
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    # Метка запроса: имя метода Bot API; загрузки файлов (/file/bot<токен>/<путь>) и прочие
+    # адреса получают постоянные метки, чтобы число рядов метрик не росло
+    @staticmethod
+    def _label(url: str) -> str:
+        if '/file/bot' in url:
+            return 'download_file'
+        tail = url.rsplit('/', 1)[-1]
+        return tail if API_METHOD.fullmatch(tail) else 'other'
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        api_method = self._label(url)
+        start = time.perf_counter()
+        try:
+            code, payload = await self._request.do_request(url, method, request_data, **timeouts)
+        except Exception:
+            BOT_API_ERRORS.inc(api_method)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - start, api_method)
+
+        if code >= 400:
+            BOT_API_ERRORS.inc(api_method)
+        return code, payload
+
+
+# HTTP-эндпоинт метрик в формате Prometheus: GET /metrics
+class MetricsServer:
+    def __init__(self, listen: str, port: int):
+        self.listen = listen
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        logging.info(f"Метрики доступны на http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?', 1)[0] == '/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4; charset=utf-8', render()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain; charset=utf-8', 'not found'
+
+            data = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode('latin-1') + data
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
@@ -0,0 +1,490 @@
+import logging
+import sqlite3
+
+RESOLUTION_HOURS_MAX = 24 * 365
+
+# Столбцы обращения, общие для reports и архива reports_archive
+REPORT_COLUMNS = ('report_id, user_id, category, description, latitude, longitude, photo_id, status, '
+                  'created_at, updated_at, cluster_id')
+
+# Условие триггеров на удаление из reports и status_updates: обращение не переносится в архив
+# (при переносе строка архива вставляется до удаления)
+NOT_ARCHIVED = 'NOT EXISTS (SELECT 1 FROM reports_archive WHERE report_id = old.report_id)'
+
+
+# Время решения обращения в целых часах (от создания до смены статуса), не больше года
+def _resolution_hours(row: str) -> str:
+    return (f"IFNULL(MAX(0, MIN(CAST((julianday({row}.updated_at) - julianday({row}.created_at)) * 24 "
+            f"AS INTEGER), {RESOLUTION_HOURS_MAX})), 0)")
+
+
+# Изменение счетчиков статистики на delta для строки reports old/new (тело триггера)
+def _stats_add(row: str, delta: int) -> str:
+    return f'''
+            INSERT INTO report_stats_daily (day, category, status, reports)
+            VALUES (IFNULL(date({row}.created_at), ''), IFNULL({row}.category, ''), IFNULL({row}.status, ''), {delta})
+            ON CONFLICT (day, category, status) DO UPDATE SET reports = reports + ({delta});
+            INSERT INTO report_stats_totals (category, status, reports)
+            VALUES (IFNULL({row}.category, ''), IFNULL({row}.status, ''), {delta})
+            ON CONFLICT (category, status) DO UPDATE SET reports = reports + ({delta});'''
+
+
+# Миграции схемы БД. Номер версии миграции = её индекс в списке + 1,
+# текущая версия схемы хранится в PRAGMA user_version.
+# Новые миграции добавляются только в конец списка.
+MIGRATIONS = [
+    # 1: исходная схема
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            role TEXT DEFAULT 'user',
+            reg_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS reports (
+            report_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            category TEXT,
+            description TEXT,
+            latitude REAL,
+            longitude REAL,
+            photo_id TEXT,
+            status TEXT DEFAULT 'На модерации',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS status_updates (
+            update_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id INTEGER,
+            official_id INTEGER,
+            status TEXT,
+            comment TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (report_id) REFERENCES reports(report_id),
+            FOREIGN KEY (official_id) REFERENCES users(user_id)
+        )
+        ''',
+    ],
+    # 2: индексы для частых запросов (my_reports, pending_reports, оповещения, история статусов)
+    [
+        'CREATE INDEX IF NOT EXISTS idx_reports_user_created ON reports (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_reports_status_created ON reports (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_users_role ON users (role)',
+        'CREATE INDEX IF NOT EXISTS idx_status_updates_report_created ON status_updates (report_id, created_at)',
+    ],
+    # 3: очередь исходящих оповещений (outbox), пишется в одной транзакции с изменением обращения
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            report_id INTEGER,
+            ref INTEGER NOT NULL DEFAULT 0,
+            payload TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            UNIQUE (kind, report_id, chat_id, ref)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox (status, next_attempt_at)',
+    ],
+    # 4: пространственный индекс R*Tree по координатам обращений, синхронизируется триггерами
+    [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS reports_rtree USING rtree (
+            report_id,
+            min_lat, max_lat,
+            min_lon, max_lon
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reports_rtree_insert AFTER INSERT ON reports
+        WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL
+        BEGIN
+            INSERT INTO reports_rtree VALUES (new.report_id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reports_rtree_update AFTER UPDATE OF latitude, longitude ON reports
+        BEGIN
+            DELETE FROM reports_rtree WHERE report_id = old.report_id;
+            INSERT INTO reports_rtree
+            SELECT new.report_id, new.latitude, new.latitude, new.longitude, new.longitude
+            WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reports_rtree_delete AFTER DELETE ON reports
+        BEGIN
+            DELETE FROM reports_rtree WHERE report_id = old.report_id;
+        END
+        ''',
+        '''
+        INSERT OR REPLACE INTO reports_rtree
+        SELECT report_id, latitude, latitude, longitude, longitude
+        FROM reports
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        ''',
+    ],
+    # 5: кластеры дубликатов - cluster_id указывает на первое (основное) обращение кластера
+    [
+        'ALTER TABLE reports ADD COLUMN cluster_id INTEGER REFERENCES reports(report_id)',
+        'CREATE INDEX IF NOT EXISTS idx_reports_cluster ON reports (cluster_id)',
+    ],
+    # 6: подписки госслужащих на категории и районы (NULL - без ограничения)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            subscription_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            official_id INTEGER NOT NULL,
+            category TEXT,
+            latitude REAL,
+            longitude REAL,
+            radius_m REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (official_id) REFERENCES users(user_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_official ON subscriptions (official_id)',
+    ],
+    # 7: сохраненные user_data и состояния диалогов (JSON), чтобы они переживали перезапуск бота
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS persisted_user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS persisted_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # 8: перцептивные хеши фото обращений (NULL - фото не удалось загрузить или разобрать)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS photo_hashes (
+            report_id INTEGER PRIMARY KEY REFERENCES reports(report_id),
+            hash INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ],
+    # 9: агрегаты статистики (категория x статус по дням создания, итоги, распределение времени
+    # решения по часам), поддерживаются триггерами, чтобы /stats не сканировал reports
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS report_stats_daily (
+            day TEXT NOT NULL,
+            category TEXT NOT NULL,
+            status TEXT NOT NULL,
+            reports INTEGER NOT NULL,
+            PRIMARY KEY (day, category, status)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS report_stats_totals (
+            category TEXT NOT NULL,
+            status TEXT NOT NULL,
+            reports INTEGER NOT NULL,
+            PRIMARY KEY (category, status)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS report_resolution_hours (
+            hours INTEGER PRIMARY KEY,
+            reports INTEGER NOT NULL
+        )
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS reports_stats_insert AFTER INSERT ON reports
+        BEGIN
+            {_stats_add('new', 1)}
+            INSERT INTO report_resolution_hours (hours, reports)
+            SELECT {_resolution_hours('new')}, 1 WHERE new.status = 'Решено'
+            ON CONFLICT (hours) DO UPDATE SET reports = reports + 1;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS reports_stats_update AFTER UPDATE OF category, status ON reports
+        WHEN old.category IS NOT new.category OR old.status IS NOT new.status
+        BEGIN
+            {_stats_add('old', -1)}
+            {_stats_add('new', 1)}
+            UPDATE report_resolution_hours SET reports = reports - 1
+            WHERE hours = {_resolution_hours('old')} AND old.status = 'Решено' AND new.status IS NOT 'Решено';
+            INSERT INTO report_resolution_hours (hours, reports)
+            SELECT {_resolution_hours('new')}, 1 WHERE new.status = 'Решено' AND old.status IS NOT 'Решено'
+            ON CONFLICT (hours) DO UPDATE SET reports = reports + 1;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS reports_stats_delete AFTER DELETE ON reports
+        BEGIN
+            {_stats_add('old', -1)}
+            UPDATE report_resolution_hours SET reports = reports - 1
+            WHERE hours = {_resolution_hours('old')} AND old.status = 'Решено';
+        END
+        ''',
+        '''
+        INSERT OR REPLACE INTO report_stats_daily (day, category, status, reports)
+        SELECT IFNULL(date(created_at), ''), IFNULL(category, ''), IFNULL(status, ''), COUNT(*)
+        FROM reports
+        GROUP BY 1, 2, 3
+        ''',
+        '''
+        INSERT OR REPLACE INTO report_stats_totals (category, status, reports)
+        SELECT IFNULL(category, ''), IFNULL(status, ''), COUNT(*)
+        FROM reports
+        GROUP BY 1, 2
+        ''',
+        f'''
+        INSERT OR REPLACE INTO report_resolution_hours (hours, reports)
+        SELECT {_resolution_hours('reports')}, COUNT(*)
+        FROM reports
+        WHERE status = 'Решено'
+        GROUP BY 1
+        ''',
+    ],
+    # 10: полнотекстовый индекс FTS5 по описаниям обращений и комментариям к смене статуса
+    # (rowid = report_id), синхронизируется триггерами
+    [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS reports_fts USING fts5 (
+            description,
+            comments,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reports_fts_insert AFTER INSERT ON reports
+        BEGIN
+            INSERT INTO reports_fts (rowid, description, comments) VALUES (new.report_id, new.description, '');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reports_fts_update AFTER UPDATE OF description ON reports
+        BEGIN
+            UPDATE reports_fts SET description = new.description WHERE rowid = new.report_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reports_fts_delete AFTER DELETE ON reports
+        BEGIN
+            DELETE FROM reports_fts WHERE rowid = old.report_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS status_updates_fts_insert AFTER INSERT ON status_updates
+        WHEN new.comment IS NOT NULL AND new.comment != ''
+        BEGIN
+            UPDATE reports_fts
+            SET comments = CASE WHEN comments = '' THEN new.comment ELSE comments || char(10) || new.comment END
+            WHERE rowid = new.report_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS status_updates_fts_delete AFTER DELETE ON status_updates
+        BEGIN
+            UPDATE reports_fts
+            SET comments = IFNULL((SELECT group_concat(comment, char(10)) FROM status_updates
+                                   WHERE report_id = old.report_id), '')
+            WHERE rowid = old.report_id;
+        END
+        ''',
+        '''
+        INSERT OR REPLACE INTO reports_fts (rowid, description, comments)
+        SELECT report_id, description,
+               IFNULL((SELECT group_concat(comment, char(10)) FROM status_updates s
+                       WHERE s.report_id = reports.report_id), '')
+        FROM reports
+        ''',
+    ],
+    # 11: архив закрытых обращений и их истории статусов. Перенос в архив - это удаление из reports
+    # и status_updates, поэтому триггеры статистики и полнотекстового индекса его пропускают:
+    # архивные обращения остаются в /stats и /search. Из reports_rtree они удаляются
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS reports_archive (
+            report_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            category TEXT,
+            description TEXT,
+            latitude REAL,
+            longitude REAL,
+            photo_id TEXT,
+            status TEXT,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP,
+            cluster_id INTEGER,
+            archived_at TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_reports_archive_user_created ON reports_archive (user_id, created_at)',
+        '''
+        CREATE TABLE IF NOT EXISTS status_updates_archive (
+            update_id INTEGER PRIMARY KEY,
+            report_id INTEGER,
+            official_id INTEGER,
+            status TEXT,
+            comment TEXT,
+            created_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_status_updates_archive_report_created
+        ON status_updates_archive (report_id, created_at)
+        ''',
+        # Все обращения, рабочие и архивные
+        f'''
+        CREATE VIEW IF NOT EXISTS reports_all AS
+        SELECT {REPORT_COLUMNS} FROM reports
+        UNION ALL
+        SELECT {REPORT_COLUMNS} FROM reports_archive
+        ''',
+        'DROP TRIGGER IF EXISTS reports_stats_delete',
+        f'''
+        CREATE TRIGGER reports_stats_delete AFTER DELETE ON reports
+        WHEN {NOT_ARCHIVED}
+        BEGIN
+            {_stats_add('old', -1)}
+            UPDATE report_resolution_hours SET reports = reports - 1
+            WHERE hours = {_resolution_hours('old')} AND old.status = 'Решено';
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS reports_fts_delete',
+        f'''
+        CREATE TRIGGER reports_fts_delete AFTER DELETE ON reports
+        WHEN {NOT_ARCHIVED}
+        BEGIN
+            DELETE FROM reports_fts WHERE rowid = old.report_id;
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS status_updates_fts_delete',
+        f'''
+        CREATE TRIGGER status_updates_fts_delete AFTER DELETE ON status_updates
+        WHEN {NOT_ARCHIVED}
+        BEGIN
+            UPDATE reports_fts
+            SET comments = IFNULL((SELECT group_concat(comment, char(10)) FROM status_updates
+                                   WHERE report_id = old.report_id), '')
+            WHERE rowid = old.report_id;
+        END
+        ''',
+    ],
+    # 12: открытое обращение с почти тем же фото, о котором предупреждается модератор,
+    # если новое обращение не присоединено к его кластеру
+    [
+        'ALTER TABLE reports ADD COLUMN similar_photo_id INTEGER REFERENCES reports(report_id)',
+    ],
+    # 13: корзина гистограммы времени решения, в которую посчитано решенное обращение (NULL, если
+    # обращение не решено). Корзина запоминается при переходе в "Решено", и при переоткрытии или
+    # удалении уменьшается именно она: повторная установка "Решено" меняет updated_at, но не
+    # статус, поэтому пересчитанная по updated_at корзина могла оказаться другой
+    [
+        'ALTER TABLE reports ADD COLUMN resolution_hours INTEGER',
+        f"UPDATE reports SET resolution_hours = {_resolution_hours('reports')} WHERE status = 'Решено'",
+        'DROP TRIGGER IF EXISTS reports_stats_insert',
+        f'''
+        CREATE TRIGGER reports_stats_insert AFTER INSERT ON reports
+        BEGIN
+            {_stats_add('new', 1)}
+            INSERT INTO report_resolution_hours (hours, reports)
+            SELECT {_resolution_hours('new')}, 1 WHERE new.status = 'Решено'
+            ON CONFLICT (hours) DO UPDATE SET reports = reports + 1;
+            UPDATE reports SET resolution_hours = {_resolution_hours('new')}
+            WHERE report_id = new.report_id AND new.status = 'Решено';
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS reports_stats_update',
+        f'''
+        CREATE TRIGGER reports_stats_update AFTER UPDATE OF category, status ON reports
+        WHEN old.category IS NOT new.category OR old.status IS NOT new.status
+        BEGIN
+            {_stats_add('old', -1)}
+            {_stats_add('new', 1)}
+            UPDATE report_resolution_hours SET reports = reports - 1
+            WHERE hours = old.resolution_hours AND new.status IS NOT 'Решено';
+            INSERT INTO report_resolution_hours (hours, reports)
+            SELECT {_resolution_hours('new')}, 1 WHERE new.status = 'Решено' AND old.resolution_hours IS NULL
+            ON CONFLICT (hours) DO UPDATE SET reports = reports + 1;
+            UPDATE reports SET resolution_hours = CASE WHEN new.status = 'Решено' THEN {_resolution_hours('new')} END
+            WHERE report_id = new.report_id AND (old.resolution_hours IS NULL) = (new.status IS 'Решено');
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS reports_stats_delete',
+        f'''
+        CREATE TRIGGER reports_stats_delete AFTER DELETE ON reports
+        WHEN {NOT_ARCHIVED}
+        BEGIN
+            {_stats_add('old', -1)}
+            UPDATE report_resolution_hours SET reports = reports - 1 WHERE hours = old.resolution_hours;
+        END
+        ''',
+        # Пересчет гистограммы: рабочие обращения - по сохраненной корзине, архивные - по updated_at
+        'DELETE FROM report_resolution_hours',
+        f'''
+        INSERT INTO report_resolution_hours (hours, reports)
+        SELECT hours, COUNT(*) FROM (
+            SELECT resolution_hours AS hours FROM reports WHERE resolution_hours IS NOT NULL
+            UNION ALL
+            SELECT {_resolution_hours('reports_archive')} FROM reports_archive WHERE status = 'Решено'
+        )
+        GROUP BY hours
+        ''',
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+# Применение недостающих миграций. Каждая миграция выполняется в отдельной
+# короткой транзакции вместе с повышением user_version, поэтому работающий
+# экземпляр бота лишь ненадолго ждёт блокировку, а прерванная миграция
+# безопасно повторяется при следующем запуске.
+def migrate(conn: sqlite3.Connection):
+    version = get_schema_version(conn)
+
+    # Схема актуальна - никаких DDL не выполняем
+    if version >= SCHEMA_VERSION:
+        return
+
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Версию перечитываем под блокировкой: миграцию мог уже применить другой процесс
+            if get_schema_version(conn) >= number:
+                conn.rollback()
+                continue
+
+            for statement in MIGRATIONS[number - 1]:
+                conn.execute(statement)
+
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        logging.info(f"Применена миграция БД №{number}")
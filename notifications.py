@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+# Ограничения Telegram Bot API: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+
+
+# Асинхронный token bucket: rate токенов в секунду, не больше capacity
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Списание токена без ожидания; False, если токенов нет
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self.tokens >= 1 and not self._lock.locked():
+            self.tokens -= 1
+            return True
+        return False
+
+    # Бакет полон и его можно безопасно удалить
+    def is_idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+
+# Итог рассылки: доставленные получатели и ошибки по каждому недоставленному
+class DeliveryReport:
+    def __init__(self):
+        self.sent = []
+        self.failed: Dict[Hashable, Exception] = {}
+
+    def __repr__(self):
+        return f"DeliveryReport(sent={len(self.sent)}, failed={len(self.failed)})"
+
+
+# Рассылка сообщений многим получателям с ограниченной параллельностью,
+# соблюдением лимитов Telegram и повторами при RetryAfter/сетевых ошибках
+class Notifier:
+    def __init__(self, concurrency: int = 10, global_rate: float = GLOBAL_RATE,
+                 per_chat_rate: float = PER_CHAT_RATE, max_retries: int = 3, max_idle_buckets: int = 1000):
+        self.concurrency = concurrency
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self.max_idle_buckets = max_idle_buckets
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._paused_until = 0.0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_idle_buckets:
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items() if not value.is_idle()
+                }
+            bucket = TokenBucket(self.per_chat_rate, 1)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    # Ожидание окончания flood-wait, объявленного Telegram для всего бота
+    async def _wait_pause(self):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def send(self, chat_id: int, send: Callable[[int], Awaitable]):
+        attempt = 0
+        while True:
+            await self._wait_pause()
+            await self._chat_bucket(chat_id).acquire()
+            await self._global_bucket.acquire()
+
+            try:
+                return await send(chat_id)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logging.warning(f"Flood control Telegram, пауза рассылки на {retry_after} с")
+            except (Forbidden, BadRequest):
+                # Бот заблокирован или чат недоступен - повтор не поможет
+                raise
+            except NetworkError:
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise RuntimeError(f"Превышено число попыток отправки в чат {chat_id}")
+
+    # Отправка каждому элементу items. По умолчанию элемент - это chat_id получателя,
+    # иначе chat_id извлекается функцией key. Элементы одного чата отправляются по порядку
+    # в одном слоте параллельности: ожидание лимита чата не занимает слоты других чатов
+    async def fan_out(self, items: Iterable[Hashable], send: Callable[[Hashable], Awaitable],
+                      key: Optional[Callable[[Hashable], int]] = None) -> DeliveryReport:
+        report = DeliveryReport()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        chats: Dict[int, List[Hashable]] = {}
+        for item in items:
+            chats.setdefault(key(item) if key else item, []).append(item)
+
+        async def deliver(chat_id, chat_items):
+            async with semaphore:
+                for item in chat_items:
+                    try:
+                        await self.send(chat_id, lambda _: send(item))
+                        report.sent.append(item)
+                    except Exception as e:
+                        report.failed[item] = e
+
+        await asyncio.gather(*(deliver(chat_id, chat_items) for chat_id, chat_items in chats.items()))
+        return report
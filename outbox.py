@@ -0,0 +1,101 @@
+import asyncio
+import contextlib
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict
+
+from telegram.error import BadRequest, Forbidden
+
+from notifications import Notifier
+from storage import Storage
+
+
+# Фоновый обработчик очереди оповещений (outbox): забирает готовые сообщения пачками,
+# отправляет их через Notifier и фиксирует результат. Неудачные попытки повторяются
+# с экспоненциальной задержкой, после max_attempts сообщение переходит в 'dead'
+class OutboxWorker:
+    def __init__(self, storage: Storage, notifier: Notifier, deliver: Callable[..., Awaitable],
+                 batch_size: int = 50, poll_interval: float = 5, lease: float = 120, max_attempts: int = 5,
+                 depth_log_interval: float = 60, keep_sent: timedelta = timedelta(days=1)):
+        self.storage = storage
+        self.notifier = notifier
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.depth_log_interval = depth_log_interval
+        self.keep_sent = keep_sent
+        self.depth: Dict[str, int] = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._last_depth_check = 0.0
+
+    # Сигнал о новых сообщениях в очереди, чтобы не ждать следующего опроса
+    def wake(self):
+        self._wakeup.set()
+
+    def _retry_at(self, message, error: Exception):
+        if isinstance(error, (Forbidden, BadRequest)) or message['attempts'] + 1 >= self.max_attempts:
+            return None
+        return datetime.now() + timedelta(seconds=min(5 * 2 ** message['attempts'], 3600))
+
+    # Одна пачка сообщений; возвращает количество обработанных
+    async def drain_once(self, bot) -> int:
+        messages = await self.storage.claim_outbox(self.batch_size, self.lease)
+        if not messages:
+            return 0
+
+        delivery = await self.notifier.fan_out(
+            messages,
+            lambda message: self.deliver(bot, message),
+            key=lambda message: message['chat_id']
+        )
+
+        failures = []
+        for message, error in delivery.failed.items():
+            retry_at = self._retry_at(message, error)
+            if retry_at is None:
+                logging.error(f"Оповещение {message['message_id']} для {message['chat_id']} не доставлено: {error}")
+            failures.append((message['message_id'], str(error), retry_at))
+
+        await self.storage.complete_outbox([message['message_id'] for message in delivery.sent], failures)
+        return len(messages)
+
+    async def _report_depth(self):
+        if time.monotonic() - self._last_depth_check < self.depth_log_interval:
+            return
+
+        self._last_depth_check = time.monotonic()
+        await self.storage.prune_outbox(self.keep_sent)
+        self.depth = await self.storage.get_outbox_depth()
+
+        backlog = self.depth.get('pending', 0) + self.depth.get('sending', 0)
+        if backlog or self.depth.get('dead'):
+            logging.info(f"Очередь оповещений: в ожидании {backlog}, недоставлено {self.depth.get('dead', 0)}")
+
+    async def run(self, bot):
+        while True:
+            self._wakeup.clear()
+            try:
+                processed = await self.drain_once(bot)
+                await self._report_depth()
+            except Exception as e:
+                logging.error(f"Ошибка обработки очереди оповещений: {e}")
+                processed = 0
+
+            # Полная пачка - сразу берем следующую, иначе ждем новых сообщений
+            if processed < self.batch_size:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+
+    def start(self, bot):
+        self._task = asyncio.create_task(self.run(bot))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
@@ -0,0 +1,149 @@
+import asyncio
+import contextlib
+import json
+import logging
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from storage import Storage
+
+
+# Хранение user_data и состояний ConversationHandler в нашей SQLite БД.
+# Изменения не пишутся сразу: они накапливаются в памяти и сбрасываются одной
+# транзакцией не чаще, чем раз в flush_delay секунд (и при остановке бота)
+class SQLitePersistence(BasePersistence):
+    def __init__(self, storage: Storage, update_interval: float = 5, flush_delay: float = 1):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.storage = storage
+        self.flush_delay = flush_delay
+        self._user_data: Optional[Dict[int, dict]] = None
+        self._conversations: Dict[str, dict] = {}
+        self._dirty_user_data: Dict[int, Optional[dict]] = {}
+        self._dirty_conversations: Dict[Tuple[str, str], Optional[object]] = {}
+        self._flush_task = None
+
+    def _schedule_flush(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        self._flush_task = None
+
+        try:
+            await self._write()
+        except Exception as e:
+            logging.error(f"Ошибка сохранения диалогов и данных пользователей: {e}")
+            self._schedule_flush()
+
+    async def _write(self):
+        if not self._dirty_user_data and not self._dirty_conversations:
+            return
+
+        # Сериализуем в event loop, пока данные не изменились, запись - в пуле потоков хранилища
+        user_data = {
+            user_id: None if data is None else json.dumps(data, ensure_ascii=False)
+            for user_id, data in self._dirty_user_data.items()
+        }
+        conversations = {
+            key: None if state is None else json.dumps(state)
+            for key, state in self._dirty_conversations.items()
+        }
+        dirty_user_data, self._dirty_user_data = self._dirty_user_data, {}
+        dirty_conversations, self._dirty_conversations = self._dirty_conversations, {}
+
+        try:
+            await self.storage.save_persisted_state(user_data, conversations)
+        except Exception:
+            # Возвращаем изменения в буфер (если за это время не появились более свежие)
+            for user_id, data in dirty_user_data.items():
+                self._dirty_user_data.setdefault(user_id, data)
+            for key, state in dirty_conversations.items():
+                self._dirty_conversations.setdefault(key, state)
+            raise
+
+    # Данные пользователей
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        if self._user_data is None:
+            rows = await self.storage.get_persisted_user_data()
+            self._user_data = {user_id: json.loads(data) for user_id, data in rows.items()}
+        return self._user_data
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._dirty_user_data[user_id] = data
+        self._schedule_flush()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        self._dirty_user_data[user_id] = None
+        self._schedule_flush()
+
+    # Состояния диалогов
+
+    async def get_conversations(self, name: str) -> dict:
+        if name not in self._conversations:
+            rows = await self.storage.get_persisted_conversations(name)
+            self._conversations[name] = {
+                tuple(json.loads(key)): json.loads(state) for key, state in rows.items()
+            }
+        return self._conversations[name]
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        conversations = self._conversations.setdefault(name, {})
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+
+        self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    # Количество незавершенных диалогов по имени ConversationHandler (для метрик)
+    def active_conversations(self) -> Dict[str, int]:
+        return {name: len(conversations) for name, conversations in self._conversations.items()}
+
+    # Данные чатов, бота и callback_data бот не использует
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    # Немедленная запись накопленных изменений (вызывается при остановке бота)
+    async def flush(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flush_task
+            self._flush_task = None
+
+        await self._write()
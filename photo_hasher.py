@@ -0,0 +1,124 @@
+import asyncio
+import contextlib
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from photo_index import dhash
+from storage import Storage
+
+# Результат _hash, когда фото не удалось загрузить (в отличие от None - фото не декодируется)
+NOT_FETCHED = object()
+
+
+# Загрузка фото через Bot API (getFile и скачивание файла)
+class TelegramPhotoFetcher:
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def __call__(self, file_id: str) -> bytes:
+        file = await self.bot.get_file(file_id)
+        return bytes(await file.download_as_bytearray())
+
+
+# Фоновое вычисление перцептивных хешей фото обращений. Фото начинает загружаться, как только
+# пользователь его прислал, и к подтверждению обращения хеш обычно уже готов.
+# fetcher(file_id) -> bytes можно заменить, например заглушкой в нагрузочных прогонах.
+# Обращения без хеша (созданные раньше или не дождавшиеся его) обрабатываются фоновой задачей
+class PhotoHasher:
+    def __init__(self, storage: Storage, fetcher: Optional[Callable[[str], Awaitable[bytes]]] = None,
+                 concurrency: int = 4, cache_size: int = 1000, backfill_batch: int = 50):
+        self.storage = storage
+        self.fetcher = fetcher
+        self.cache_size = cache_size
+        self.backfill_batch = backfill_batch
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = OrderedDict()
+        self._background = set()
+
+    # Хеш фото; None, если изображение не удалось декодировать (такой результат сохраняется
+    # и больше не пересчитывается), NOT_FETCHED - если не удалось загрузить фото (повторяется позже)
+    async def _hash(self, file_id: str):
+        async with self._semaphore:
+            try:
+                data = await self.fetcher(file_id)
+            except Exception as e:
+                logging.error(f"Не удалось загрузить фото {file_id}: {e}")
+                return NOT_FETCHED
+
+            try:
+                # Декодирование изображения - работа для процессора, выносим ее из event loop
+                return await asyncio.get_running_loop().run_in_executor(None, dhash, data)
+            except Exception as e:
+                logging.error(f"Не удалось вычислить хеш фото {file_id}: {e}")
+                return None
+
+    # Запуск загрузки и хеширования фото; для уже запрошенного file_id возвращает ту же задачу
+    def submit(self, file_id: str) -> asyncio.Task:
+        task = self._tasks.get(file_id)
+        if task is not None:
+            self._tasks.move_to_end(file_id)
+            return task
+
+        task = asyncio.create_task(self._hash(file_id))
+        task.add_done_callback(lambda done: self._forget_failed(file_id, done))
+        self._tasks[file_id] = task
+        while len(self._tasks) > self.cache_size:
+            self._tasks.popitem(last=False)
+        return task
+
+    # Неудачная загрузка не кэшируется: следующий запрос того же фото загрузит его заново
+    def _forget_failed(self, file_id: str, task: asyncio.Task):
+        if not task.cancelled() and task.result() is NOT_FETCHED and self._tasks.get(file_id) is task:
+            del self._tasks[file_id]
+
+    # Хеш фото, если он готов в течение timeout секунд, иначе None (вычисление продолжается в фоне)
+    async def get(self, file_id: str, timeout: float) -> Optional[int]:
+        try:
+            photo_hash = await asyncio.wait_for(asyncio.shield(self.submit(file_id)), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return None if photo_hash is NOT_FETCHED else photo_hash
+
+    # Сохранение хеша фото уже созданного обращения, когда он будет вычислен
+    def index_later(self, report_id: int, file_id: str):
+        self._spawn(self._index(report_id, self.submit(file_id)))
+
+    async def _index(self, report_id: int, task: asyncio.Task):
+        photo_hash = await task
+        if photo_hash is not NOT_FETCHED:
+            await self.storage.add_photo_hash(report_id, photo_hash)
+
+    # Один проход по обращениям без хеша. Обращения, фото которых не удалось загрузить,
+    # пропускаются и остаются без записи, поэтому следующий проход попробует их снова
+    async def backfill(self):
+        older_than = None
+        while True:
+            reports = await self.storage.get_reports_without_photo_hash(self.backfill_batch, older_than)
+            if not reports:
+                return
+
+            hashes = await asyncio.gather(*(self._hash(report['photo_id']) for report in reports))
+            for report, photo_hash in zip(reports, hashes):
+                if photo_hash is not NOT_FETCHED:
+                    await self.storage.add_photo_hash(report['report_id'], photo_hash)
+            older_than = reports[-1]['report_id']
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def start(self, bot):
+        if self.fetcher is None:
+            self.fetcher = TelegramPhotoFetcher(bot)
+        self._spawn(self.backfill())
+
+    async def stop(self):
+        tasks = list(self._background) + list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks.clear()
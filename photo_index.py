@@ -0,0 +1,106 @@
+import io
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from PIL import Image
+
+# Перцептивный хеш фото (dHash, 64 бита): сравнение яркости соседних пикселей уменьшенного
+# черно-белого изображения. Пересжатие, изменение размера и небольшие правки меняют лишь
+# несколько бит, поэтому фото считаются почти одинаковыми, если хеши отличаются
+# не более чем в PHOTO_DUPLICATE_DISTANCE битах
+HASH_SIZE = 8
+PHOTO_DUPLICATE_DISTANCE = 6
+
+# Однотонные и малоконтрастные фото (темнота, небо, вода) дают хеш из почти одних нулей
+# или единиц, и такие хеши совпадают у совершенно разных фото. Хеши, в которых единиц
+# меньше PHOTO_MIN_BITS или больше HASH_SIZE² - PHOTO_MIN_BITS, не индексируются и не ищутся
+PHOTO_MIN_BITS = 8
+
+
+def dhash(data: bytes) -> int:
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = list(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).getdata())
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+# Хеш достаточно информативен, чтобы сравнивать по нему фото
+def is_distinctive(photo_hash: int) -> bool:
+    return PHOTO_MIN_BITS <= bin(photo_hash).count('1') <= HASH_SIZE * HASH_SIZE - PHOTO_MIN_BITS
+
+
+# SQLite хранит только знаковые 64-битные целые
+def to_db(value: int) -> int:
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def from_db(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+# Сегменты хеша для поиска: если хеши отличаются не более чем в PHOTO_DUPLICATE_DISTANCE битах,
+# то хотя бы один из PHOTO_DUPLICATE_DISTANCE + 1 сегментов у них совпадает полностью
+def _segments(bits: int, count: int) -> List[Tuple[int, int]]:
+    segments = []
+    shift = 0
+    for i in range(count):
+        size = bits // count + (1 if i < bits % count else 0)
+        segments.append((shift, (1 << size) - 1))
+        shift += size
+    return segments
+
+
+SEGMENTS = _segments(HASH_SIZE * HASH_SIZE, PHOTO_DUPLICATE_DISTANCE + 1)
+
+
+# Индекс хешей фото для поиска почти одинаковых (multi-index hashing): по каждому сегменту хеша
+# хранится таблица значение сегмента -> хеши. Поиск проверяет расстояние только у хешей,
+# совпавших с искомым хотя бы в одном сегменте. Неинформативные хеши (см. is_distinctive)
+# в индекс не попадают. Используется только из event loop, поэтому блокировки не нужны
+class PhotoIndex:
+    def __init__(self):
+        self._reports: Dict[int, List[int]] = {}
+        self._tables = [defaultdict(set) for _ in SEGMENTS]
+
+    def __len__(self):
+        return len(self._reports)
+
+    def add(self, photo_hash: int, report_id: int):
+        if not is_distinctive(photo_hash):
+            return
+        report_ids = self._reports.setdefault(photo_hash, [])
+        if not report_ids:
+            for table, (shift, mask) in zip(self._tables, SEGMENTS):
+                table[(photo_hash >> shift) & mask].add(photo_hash)
+        report_ids.append(report_id)
+
+    def load(self, hashes):
+        self.__init__()
+        for photo_hash, report_id in hashes:
+            self.add(photo_hash, report_id)
+
+    # Обращения с почти одинаковыми фото: [(report_id, расстояние)] по возрастанию расстояния
+    def search(self, photo_hash: int) -> List[Tuple[int, int]]:
+        if not is_distinctive(photo_hash):
+            return []
+        candidates = set()
+        for table, (shift, mask) in zip(self._tables, SEGMENTS):
+            candidates.update(table.get((photo_hash >> shift) & mask, ()))
+
+        found = []
+        for candidate in candidates:
+            distance = hamming(photo_hash, candidate)
+            if distance <= PHOTO_DUPLICATE_DISTANCE:
+                found.extend((report_id, distance) for report_id in self._reports[candidate])
+
+        return sorted(found, key=lambda item: item[1])
@@ -0,0 +1,210 @@
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from geo import map_url
+
+# Статусы, которые госслужащий может установить обращению
+STATUS_CHOICES = ["В обработке", "Проверка", "Подтверждено", "Решено", "Отклонено"]
+
+# Длина описания в подписи к фото на страницах /pending_reports и /all_reports
+PAGE_DESCRIPTION_LIMIT = 500
+
+# Сколько последних изменений статуса показывать в подробной карточке
+DETAILS_HISTORY_LIMIT = 3
+
+# Подтверждение обращения перед отправкой (клавиатура одна для всех, создается один раз)
+CONFIRM_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Да, отправить", callback_data="confirm_yes"),
+        InlineKeyboardButton("Отменить", callback_data="confirm_no")
+    ]
+])
+
+Card = Tuple[str, Optional[InlineKeyboardMarkup]]
+
+
+# Выбор нового статуса обращения. Клавиатуры неизменяемы, поэтому одна и та же
+# клавиатура переиспользуется для повторных запросов по обращению
+@lru_cache(maxsize=1024)
+def status_keyboard(report_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(status, callback_data=f"status_{report_id}_{status}")] for status in STATUS_CHOICES
+    ])
+
+
+def map_button(report, text: str = "Открыть на карте") -> InlineKeyboardButton:
+    return InlineKeyboardButton(text, url=map_url(report['latitude'], report['longitude']))
+
+
+# Строка о количестве присоединенных дубликатов для карточки обращения
+def duplicates_line(duplicates) -> str:
+    return f"Похожих обращений: {duplicates}\n" if duplicates else ""
+
+
+# Предупреждение модератору о почти таком же фото в другом открытом обращении
+def similar_photo_line(similar_photo_id) -> str:
+    return f"⚠️ Похожее фото в обращении №{similar_photo_id}\n" if similar_photo_id else ""
+
+
+# Подпись к фото для проверки данных перед отправкой обращения
+def confirm_caption(data) -> str:
+    return (
+        f"Проверьте данные обращения:\n\n"
+        f"Категория: {data['category']}\n"
+        f"Описание: {data['description']}\n"
+        f"Координаты: {data['latitude']}, {data['longitude']}\n\n"
+        f"Всё верно?"
+    )
+
+
+# Оповещение модератора о новом обращении
+def _moderation_card(report) -> Card:
+    report_id = report['report_id']
+    caption = (
+        f"🚨 НОВОЕ ОБРАЩЕНИЕ НА МОДЕРАЦИИ №{report_id} 🚨\n\n"
+        f"Категория: {report['category']}\n"
+        f"Описание: {report['description']}\n"
+        f"Координаты: {report['latitude']}, {report['longitude']}\n"
+        f"{duplicates_line(report['duplicates'])}"
+        f"{similar_photo_line(report['similar_photo_id'])}\n"
+    )
+    return caption, InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("Одобрить", callback_data=f"mod_approve_{report_id}"),
+            InlineKeyboardButton("Отклонить", callback_data=f"mod_reject_{report_id}")
+        ],
+        [map_button(report)]
+    ])
+
+
+# Оповещение госслужащего о новом одобренном обращении
+def _official_card(report) -> Card:
+    report_id = report['report_id']
+    caption = (
+        f"🚨 НОВОЕ ОБРАЩЕНИЕ №{report_id} 🚨\n\n"
+        f"Категория: {report['category']}\n"
+        f"Описание: {report['description']}\n"
+        f"Координаты: {report['latitude']}, {report['longitude']}\n"
+        f"{duplicates_line(report['duplicates'])}\n"
+        f"Для изменения статуса используйте команду /update_status {report_id}"
+    )
+    return caption, InlineKeyboardMarkup([
+        [map_button(report)],
+        [InlineKeyboardButton("Изменить статус", callback_data=f"change_status_{report_id}")]
+    ])
+
+
+# Обращение на странице /pending_reports или /all_reports: подпись к фото в альбоме
+# и строка кнопок действий в сводном сообщении
+def _page_card(report, audience: str) -> Tuple[str, List[InlineKeyboardButton]]:
+    report_id = report['report_id']
+    description = report['description']
+    if len(description) > PAGE_DESCRIPTION_LIMIT:
+        description = description[:PAGE_DESCRIPTION_LIMIT] + "…"
+
+    caption = f"Обращение №{report_id}\n" \
+              f"Категория: {report['category']}\n" \
+              f"Описание: {description}\n"
+    if audience == 'active':
+        caption += f"Статус: {report['status']}\n"
+    else:
+        caption += similar_photo_line(report['similar_photo_id'])
+    caption += f"Дата создания: {report['created_at']}\n" \
+               f"Координаты: {report['latitude']}, {report['longitude']}"
+
+    if audience == 'pending':
+        buttons = [
+            InlineKeyboardButton(f"Одобрить №{report_id}", callback_data=f"mod_approve_{report_id}"),
+            InlineKeyboardButton(f"Отклонить №{report_id}", callback_data=f"mod_reject_{report_id}"),
+        ]
+    else:
+        buttons = [InlineKeyboardButton(f"Изменить статус №{report_id}", callback_data=f"change_status_{report_id}")]
+
+    return caption, buttons + [map_button(report, "Карта")]
+
+
+# Подробная карточка обращения с последними изменениями статуса
+def _details_card(report, status_history) -> Card:
+    details = f"Обращение №{report['report_id']}\n\n"
+    details += f"Категория: {report['category']}\n"
+    details += f"Описание: {report['description']}\n"
+    details += f"Статус: {report['status']}\n"
+    details += f"Дата создания: {report['created_at']}\n"
+    details += f"Последнее обновление: {report['updated_at']}\n"
+    details += f"Координаты: {report['latitude']}, {report['longitude']}\n"
+    if report['cluster_id']:
+        details += f"Объединено с обращением №{report['cluster_id']}\n"
+    details += "\n"
+
+    if status_history:
+        details += "История изменений статуса:\n"
+        for status, comment, date, first_name, last_name in status_history[:DETAILS_HISTORY_LIMIT]:
+            official_name = f"{first_name} {last_name}" if first_name and last_name else "Госслужащий"
+            details += f"• {date}: {status} ({official_name})\n"
+            if comment:
+                details += f"  Комментарий: {comment}\n"
+
+    return details, InlineKeyboardMarkup([[map_button(report)]])
+
+
+# Готовые карточки обращений (подпись и клавиатура) для разных получателей с LRU-кэшем.
+# Ключ - (report_id, updated_at, получатель): смена статуса меняет updated_at, поэтому
+# устаревшая карточка не будет показана; invalidate дополнительно удаляет карточки обращения
+# при изменениях, не затрагивающих updated_at (например, присоединении дубликата).
+# Используется только из event loop, поэтому блокировки не нужны
+class ReportCards:
+    def __init__(self, size: int = 2000):
+        self.size = size
+        self._cards = OrderedDict()
+        self._keys: Dict[int, Set[tuple]] = {}
+
+    def __len__(self):
+        return len(self._cards)
+
+    def _lookup(self, key: tuple):
+        card = self._cards.get(key)
+        if card is not None:
+            self._cards.move_to_end(key)
+        return card
+
+    def _store(self, key: tuple, card):
+        self._cards[key] = card
+        self._keys.setdefault(key[0], set()).add(key)
+
+        while len(self._cards) > self.size:
+            old_key, _ = self._cards.popitem(last=False)
+            keys = self._keys.get(old_key[0])
+            if keys is not None:
+                keys.discard(old_key)
+                if not keys:
+                    del self._keys[old_key[0]]
+        return card
+
+    def _cached(self, report, audience: str, render: Callable, *args):
+        key = (report['report_id'], report['updated_at'], audience)
+        return self._lookup(key) or self._store(key, render(report, *args))
+
+    def invalidate(self, report_id: int):
+        for key in self._keys.pop(report_id, ()):
+            self._cards.pop(key, None)
+
+    def moderation(self, report) -> Card:
+        return self._cached(report, 'moderation', _moderation_card)
+
+    def official(self, report) -> Card:
+        return self._cached(report, 'official', _official_card)
+
+    # audience - 'pending' (страница модератора) или 'active' (страница госслужащего)
+    def page_item(self, report, audience: str) -> Tuple[str, List[InlineKeyboardButton]]:
+        return self._cached(report, audience, _page_card, audience)
+
+    # История статусов загружается только если карточки нет в кэше
+    async def details(self, report, load_history: Callable[[int], Awaitable[list]]) -> Card:
+        key = (report['report_id'], report['updated_at'], 'details')
+        card = self._lookup(key)
+        if card is None:
+            card = self._store(key, _details_card(report, await load_history(report['report_id'])))
+        return card
@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional, Set
+
+# Маркер отсутствия записи в кэше (роль None означает "пользователь не зарегистрирован")
+MISSING = object()
+
+
+# Кэш ролей пользователей: ограниченный LRU с временем жизни записей
+# и индекс "роль -> множество user_id" для рассылки оповещений.
+# Используется только из event loop, поэтому блокировки не нужны.
+class RoleCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._roles = OrderedDict()  # user_id -> (role, expires_at)
+        self._members = {}  # role -> (set(user_id), expires_at)
+
+    def get(self, user_id: int):
+        entry = self._roles.get(user_id)
+        if entry is None:
+            return MISSING
+
+        role, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._roles[user_id]
+            return MISSING
+
+        self._roles.move_to_end(user_id)
+        return role
+
+    def set(self, user_id: int, role: Optional[str]):
+        self._roles[user_id] = (role, time.monotonic() + self.ttl)
+        self._roles.move_to_end(user_id)
+
+        while len(self._roles) > self.maxsize:
+            self._roles.popitem(last=False)
+
+        # Переносим пользователя в нужное множество индекса
+        for members_role, (members, _) in self._members.items():
+            if members_role == role:
+                members.add(user_id)
+            else:
+                members.discard(user_id)
+
+    def invalidate(self, user_id: int):
+        self._roles.pop(user_id, None)
+        for members, _ in self._members.values():
+            members.discard(user_id)
+
+    def members(self, role: str) -> Optional[Set[int]]:
+        entry = self._members.get(role)
+        if entry is None:
+            return None
+
+        members, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._members[role]
+            return None
+
+        return members
+
+    def set_members(self, role: str, user_ids: Iterable[int]):
+        self._members[role] = (set(user_ids), time.monotonic() + self.ttl)
+
+    def clear(self):
+        self._roles.clear()
+        self._members.clear()
@@ -0,0 +1,1012 @@
+import asyncio
+import json
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+from clustering import DUPLICATE_RADIUS_M, DUPLICATE_WINDOW, find_duplicate
+from geo import bounding_box, haversine
+from metrics import DB_ERRORS, DB_SECONDS, DB_WRITE_BATCH
+from migrations import REPORT_COLUMNS, migrate
+from photo_index import PhotoIndex, from_db, to_db
+from role_cache import MISSING, RoleCache
+from subscriptions import Subscription, SubscriptionIndex
+
+DB_PATH = 'signal_kz.db'
+
+# Сколько подготовленных (скомпилированных) SQL-выражений держит каждое соединение:
+# модуль sqlite3 переиспользует их по тексту запроса, а запросов с разным текстом у нас больше 128
+STATEMENT_CACHE_SIZE = 512
+
+# Статусы закрытых обращений, которые переносятся в архив (см. Storage.archive_reports)
+ARCHIVE_STATUSES = ('Решено', 'Отклонено', 'Отклонено модератором')
+
+
+# Условие keyset-пагинации: обращения старше обращения older_than по (created_at, report_id)
+def _keyset_before(older_than: Optional[int]) -> str:
+    if older_than is None:
+        return ''
+    return 'AND (created_at, report_id) < (SELECT created_at, report_id FROM reports WHERE report_id = ?)'
+
+
+def _keyset_params(older_than: Optional[int], limit: int) -> tuple:
+    if older_than is None:
+        return (limit,)
+    return (older_than, limit)
+
+
+# Смена статуса обращения и присоединенных к нему дубликатов (внутри уже открытой транзакции).
+# Возвращает report_id и user_id всех обновленных обращений
+def _set_cluster_status(conn, report_id: int, status: str, now: Optional[datetime] = None) -> List[sqlite3.Row]:
+    members = conn.execute(
+        'SELECT report_id, user_id FROM reports WHERE report_id = ? OR cluster_id = ?',
+        (report_id, report_id)
+    ).fetchall()
+    conn.execute('UPDATE reports SET status = ?, updated_at = ? WHERE report_id = ? OR cluster_id = ?',
+                 (status, now or datetime.now(), report_id, report_id))
+    return members
+
+
+# Постановка оповещения в outbox (внутри уже открытой транзакции)
+def _enqueue(conn, kind: str, chat_id: int, report_id: int, ref: int = 0, payload: Optional[dict] = None):
+    conn.execute('''
+        INSERT OR IGNORE INTO outbox (kind, chat_id, report_id, ref, payload, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (kind, chat_id, report_id, ref, json.dumps(payload) if payload else None, datetime.now()))
+
+
+# Постановка оповещения всем пользователям с указанной ролью
+def _enqueue_role(conn, kind: str, role: str, report_id: int):
+    conn.execute('''
+        INSERT OR IGNORE INTO outbox (kind, chat_id, report_id, next_attempt_at)
+        SELECT ?, user_id, ?, ? FROM users WHERE role = ?
+    ''', (kind, report_id, datetime.now(), role))
+
+
+# Окончания, которые отбрасываются у слов поискового запроса, чтобы "свалки" находило и "свалка"
+FTS_ENDINGS = 'аеёиоуыэюяьй'
+
+
+# Запрос FTS5 из текста пользователя: все слова (как префиксы без окончания) должны встретиться.
+# Короткие слова (предлоги) пропускаются, если есть другие. Слова берутся в кавычки,
+# поэтому синтаксис FTS5 в тексте пользователя не интерпретируется
+def _fts_query(text: str) -> Optional[str]:
+    words = re.findall(r'\w+', text.lower())
+    words = [word for word in words if len(word) >= 3] or words
+
+    terms = []
+    for word in words:
+        stem = word
+        while len(stem) > 3 and stem[-1] in FTS_ENDINGS and len(word) - len(stem) < 2:
+            stem = stem[:-1]
+        terms.append(f'"{stem}"*')
+    return ' '.join(terms) or None
+
+
+# Имя операции хранилища для метрик: метод Storage, в котором объявлен запрос
+def _operation_name(fn) -> str:
+    parts = fn.__qualname__.split('.')
+    if len(parts) >= 3 and parts[-2] == '<locals>':
+        return parts[-3]
+    return parts[-1]
+
+
+# Асинхронный слой хранения - интерфейс, от которого зависят обработчики.
+# Чтение выполняется в отдельном пуле потоков на небольшом наборе долгоживущих
+# соединений, чтобы не блокировать event loop. Вся запись идет через один поток-писатель
+# (см. _write). Реализации (SQLiteStorage, MemoryStorage) отличаются только тем,
+# как открываются и настраиваются соединения
+class Storage:
+    def __init__(self, path: str = DB_PATH, pool_size: int = 4, role_cache_size: int = 10000,
+                 role_cache_ttl: float = 300, users_flush_delay: float = 0.2, write_window: float = 0.002,
+                 write_batch_size: int = 256):
+        self.path = path
+        self.pool_size = pool_size
+        self.roles = RoleCache(role_cache_size, role_cache_ttl)
+        self.subscriptions = SubscriptionIndex()
+        self.photos = PhotoIndex()
+        self.users_flush_delay = users_flush_delay
+        self.write_window = write_window
+        self.write_batch_size = write_batch_size
+        self._pool = queue.Queue()
+        self._executor = None
+
+        # Очередь операций записи (функция, аргументы, Future) для потока-писателя
+        # и соединения, на которых он пишет
+        self._writes = queue.Queue()
+        self._write_pool = None
+        self._writer = None
+
+        # Известные пользователи (user_id -> отпечаток профиля) и буфер регистраций,
+        # ожидающих записи в БД
+        self._known_users: Dict[int, int] = {}
+        self._pending_users: Dict[int, Tuple[Optional[str], Optional[str], Optional[str]]] = {}
+        self._users_flush = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # Применение миграций схемы и создание пула соединений (вызывается один раз при старте)
+    def setup(self):
+        conn = self._connect()
+        migrate(conn)
+        self.subscriptions.load(
+            Subscription(*row) for row in conn.execute('''
+                SELECT subscription_id, official_id, category, latitude, longitude, radius_m FROM subscriptions
+            ''')
+        )
+        self.photos.load(
+            (from_db(row[0]), row[1])
+            for row in conn.execute('SELECT hash, report_id FROM photo_hashes WHERE hash IS NOT NULL')
+        )
+        self._known_users = {
+            row[0]: hash(tuple(row[1:]))
+            for row in conn.execute('SELECT user_id, username, first_name, last_name FROM users')
+        }
+        self._pool.put(conn)
+
+        for _ in range(self.pool_size - 1):
+            self._pool.put(self._connect())
+
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='storage')
+        self._write_pool = self._open_writer()
+        self._writer = threading.Thread(target=self._write_loop, name='storage-writer', daemon=True)
+        self._writer.start()
+
+    # Соединение потока-писателя (в очереди из одного элемента, как и соединения пула)
+    def _open_writer(self) -> queue.Queue:
+        write_pool = queue.Queue()
+        write_pool.put(self._connect())
+        return write_pool
+
+    # Функция, вызываемая с текстом каждого выполняемого SQL-выражения (для замеров и отладки).
+    # Вызывается после setup, пока все соединения находятся в пуле
+    def set_trace_callback(self, callback):
+        for conn in {*self._pool.queue, *self._write_pool.queue}:
+            conn.set_trace_callback(callback)
+
+    def close(self):
+        if self._users_flush is not None:
+            self._users_flush.cancel()
+            self._users_flush = None
+
+        # Писатель выполняет уже поставленные в очередь записи и завершается
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+        # Дописываем регистрации, которые не успели попасть в БД
+        if self._pending_users:
+            pending, self._pending_users = self._pending_users, {}
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self._commit_writes([(self._write_users, (pending,), future)])
+            future.result()
+
+        # Обновляем статистику планировщика запросов там, где она устарела
+        connections = list(self._pool.queue)
+        if self._write_pool is not None:
+            connections += [conn for conn in self._write_pool.queue if conn not in connections]
+        for conn in connections:
+            conn.execute('PRAGMA optimize')
+            conn.close()
+        self._pool = queue.Queue()
+        self._write_pool = None
+
+    # Выполнение функции на соединении из пула в рамках одной транзакции
+    def _execute(self, fn, *args):
+        operation = _operation_name(fn)
+        start = time.perf_counter()
+        conn = self._pool.get()
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            DB_ERRORS.inc(operation)
+            raise
+        finally:
+            self._pool.put(conn)
+            DB_SECONDS.observe(time.perf_counter() - start, operation)
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._execute, fn, *args)
+
+    # Запись: функция ставится в очередь потока-писателя и выполняется в общей транзакции
+    # с другими записями, пришедшими за write_window секунд (групповой коммит: одна блокировка
+    # и одна синхронизация журнала на всю группу вместо конкуренции соединений за блокировку).
+    # Каждая функция выполняется в своей точке сохранения, поэтому ошибка одной записи
+    # откатывает только ее. Результат возвращается после коммита всей группы
+    async def _write(self, fn, *args):
+        future = Future()
+        self._writes.put((fn, args, future))
+        return await asyncio.wrap_future(future)
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            intent = self._writes.get()
+            if intent is None:
+                break
+
+            batch = [intent]
+            deadline = time.monotonic() + self.write_window
+            while len(batch) < self.write_batch_size:
+                try:
+                    intent = self._writes.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if intent is None:
+                    stopping = True
+                    break
+                batch.append(intent)
+
+            # Записи, вызывающий код которых уже отменил ожидание, не выполняются
+            batch = [intent for intent in batch if intent[2].set_running_or_notify_cancel()]
+            if batch:
+                self._commit_writes(batch)
+
+    def _commit_writes(self, batch: List[Tuple]):
+        DB_WRITE_BATCH.observe(len(batch))
+        results = []
+        conn = self._write_pool.get()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for fn, args, future in batch:
+                operation = _operation_name(fn)
+                start = time.perf_counter()
+                conn.execute('SAVEPOINT write')
+                try:
+                    result = fn(conn, *args)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write')
+                    conn.execute('RELEASE write')
+                    DB_ERRORS.inc(operation)
+                    results.append((future, None, e))
+                else:
+                    conn.execute('RELEASE write')
+                    results.append((future, result, None))
+                DB_SECONDS.observe(time.perf_counter() - start, operation)
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка групповой записи в БД ({len(batch)} операций): {e}")
+            conn.rollback()
+            for fn, _, _ in batch:
+                DB_ERRORS.inc(_operation_name(fn))
+            results = [(future, None, e) for _, _, future in batch]
+        finally:
+            self._write_pool.put(conn)
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    # Пользователи
+
+    # Регистрация пользователя. Для известного пользователя с неизменным профилем
+    # к БД не обращается; новые пользователи и изменения профиля накапливаются
+    # в буфере и записываются одной транзакцией через users_flush_delay секунд
+    async def register_user(self, user_id: int, username: Optional[str], first_name: Optional[str],
+                            last_name: Optional[str]):
+        profile = (username, first_name, last_name)
+        fingerprint = hash(profile)
+        known = self._known_users.get(user_id)
+        if known == fingerprint:
+            return
+
+        # Пользователь мог быть зарегистрирован (и получить роль) другим процессом бота, поэтому
+        # роль не угадывается, а перечитывается из БД
+        if known is None:
+            self.roles.invalidate(user_id)
+        self._known_users[user_id] = fingerprint
+        self._pending_users[user_id] = profile
+
+        if self._users_flush is None:
+            self._users_flush = asyncio.create_task(self._flush_users())
+
+    async def _flush_users(self):
+        await asyncio.sleep(self.users_flush_delay)
+        self._users_flush = None
+        pending, self._pending_users = self._pending_users, {}
+
+        try:
+            await self._write(self._write_users, pending)
+        except Exception as e:
+            logging.error(f"Ошибка записи пользователей в БД: {e}")
+            # Возвращаем записи в буфер (если за это время не появились более свежие)
+            for user_id, profile in pending.items():
+                self._pending_users.setdefault(user_id, profile)
+            if self._users_flush is None:
+                self._users_flush = asyncio.create_task(self._flush_users())
+
+    @staticmethod
+    def _write_users(conn, pending: Dict[int, Tuple[Optional[str], Optional[str], Optional[str]]]):
+        now = datetime.now()
+        conn.executemany('''
+            INSERT INTO users (user_id, username, first_name, last_name, role, reg_date)
+            VALUES (?, ?, ?, ?, 'user', ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name
+        ''', [(user_id, *profile, now) for user_id, profile in pending.items()])
+
+    # Роль пользователя (из кэша, при промахе - из БД); None, если пользователь не зарегистрирован.
+    # Отсутствие пользователя тоже кэшируется на время жизни записи: пользователя могли
+    # зарегистрировать или сменить ему роль в другом процессе бота
+    async def get_role(self, user_id: int) -> Optional[str]:
+        role = self.roles.get(user_id)
+        if role is not MISSING:
+            return role
+
+        def query(conn):
+            row = conn.execute('SELECT role FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            return row[0] if row else None
+
+        role = await self._run(query)
+        # Зарегистрирован этим процессом, но пакетная запись еще не дошла до БД:
+        # роль по умолчанию, без кэширования
+        if role is None and user_id in self._known_users:
+            return 'user'
+        self.roles.set(user_id, role)
+        return role
+
+    # Возвращает False, если пользователь не найден
+    async def set_role(self, user_id: int, role: str) -> bool:
+        # Регистрация пользователя могла еще не попасть в БД - записываем ее в той же транзакции
+        pending = self._pending_users.pop(user_id, None)
+
+        def query(conn):
+            if pending is not None:
+                self._write_users(conn, {user_id: pending})
+            cursor = conn.execute('UPDATE users SET role = ? WHERE user_id = ?', (role, user_id))
+            return cursor.rowcount > 0
+
+        updated = await self._write(query)
+        if updated:
+            self.roles.set(user_id, role)
+        else:
+            self.roles.invalidate(user_id)
+
+        return updated
+
+    async def get_user_ids_by_role(self, role: str) -> List[int]:
+        members = self.roles.members(role)
+        if members is not None:
+            return list(members)
+
+        def query(conn):
+            rows = conn.execute('SELECT user_id FROM users WHERE role = ?', (role,)).fetchall()
+            return [row[0] for row in rows]
+
+        user_ids = await self._run(query)
+        self.roles.set_members(role, user_ids)
+        return user_ids
+
+    # Обращения
+
+    # Создание обращения. Если это дубликат открытого обращения (см. clustering), оно присоединяется
+    # к кластеру и получает его статус, иначе оповещения модераторам ставятся в очередь в той же транзакции.
+    # Почти такое же фото (см. photo_index) присоединяет обращение к кластеру, только если совпадают
+    # категория, место и время (как у дубликатов) и обращение-лидер еще на модерации; в остальных
+    # случаях обращение идет на модерацию с пометкой о похожем фото (similar_photo_id).
+    # Возвращает (report_id, report_id обращения-лидера кластера или None)
+    async def create_report(self, user_id: int, category: str, description: str, latitude: float,
+                            longitude: float, photo_id: str,
+                            photo_hash: Optional[int] = None) -> Tuple[int, Optional[int]]:
+        min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, DUPLICATE_RADIUS_M)
+        similar_photos = self.photos.search(photo_hash) if photo_hash is not None else []
+
+        def query(conn):
+            now = datetime.now()
+            candidates = conn.execute('''
+                SELECT r.report_id, r.description, r.latitude, r.longitude, r.status
+                FROM reports_rtree t
+                CROSS JOIN reports r ON r.report_id = t.report_id
+                WHERE t.max_lat >= ? AND t.min_lat <= ? AND t.max_lon >= ? AND t.min_lon <= ?
+                  AND r.category = ? AND r.cluster_id IS NULL AND r.created_at >= ?
+                  AND r.status NOT IN ('Решено', 'Отклонено', 'Отклонено модератором')
+            ''', (min_lat, max_lat, min_lon, max_lon, category, now - DUPLICATE_WINDOW)).fetchall()
+
+            cluster_id = find_duplicate(description, latitude, longitude, candidates)
+            status = 'На модерации'
+            similar_photo_id = None
+            if cluster_id is not None:
+                status = next(row['status'] for row in candidates if row['report_id'] == cluster_id)
+            elif similar_photos:
+                # Ближайшее по хешу открытое обращение
+                ids = [report_id for report_id, _ in similar_photos]
+                rows = conn.execute(f'''
+                    SELECT report_id, COALESCE(cluster_id, report_id) AS root, status, category,
+                           latitude, longitude, created_at >= ? AS recent
+                    FROM reports
+                    WHERE report_id IN ({', '.join('?' * len(ids))})
+                      AND status NOT IN ('Решено', 'Отклонено', 'Отклонено модератором')
+                ''', (now - DUPLICATE_WINDOW, *ids)).fetchall()
+                by_id = {row['report_id']: row for row in rows}
+                match = next((by_id[report_id] for report_id in ids if report_id in by_id), None)
+                if match is not None:
+                    same_incident = (
+                        match['category'] == category and match['recent'] and match['status'] == 'На модерации'
+                        and match['latitude'] is not None and match['longitude'] is not None
+                        and haversine(latitude, longitude, match['latitude'], match['longitude']) <= DUPLICATE_RADIUS_M
+                    )
+                    if same_incident:
+                        cluster_id = match['root']
+                    else:
+                        similar_photo_id = match['root']
+
+            cursor = conn.execute('''
+                INSERT INTO reports
+                (user_id, category, description, latitude, longitude, photo_id, status, created_at, updated_at,
+                 cluster_id, similar_photo_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, category, description, latitude, longitude, photo_id, status, now, now, cluster_id,
+                  similar_photo_id))
+            report_id = cursor.lastrowid
+
+            if photo_hash is not None:
+                conn.execute('INSERT INTO photo_hashes (report_id, hash, created_at) VALUES (?, ?, ?)',
+                             (report_id, to_db(photo_hash), now))
+            if cluster_id is None:
+                _enqueue_role(conn, 'moderation', 'moderator', report_id)
+            return report_id, cluster_id
+
+        report_id, cluster_id = await self._write(query)
+        if photo_hash is not None:
+            self.photos.add(photo_hash, report_id)
+        return report_id, cluster_id
+
+    # Хеш фото обращения, вычисленный после его создания (None - фото не удалось обработать)
+    async def add_photo_hash(self, report_id: int, photo_hash: Optional[int]):
+        def query(conn):
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO photo_hashes (report_id, hash, created_at) VALUES (?, ?, ?)
+            ''', (report_id, None if photo_hash is None else to_db(photo_hash), datetime.now()))
+            return cursor.rowcount > 0
+
+        if await self._write(query) and photo_hash is not None:
+            self.photos.add(photo_hash, report_id)
+
+    # Обращения с фото, для которых хеш еще не вычислялся (сначала новые); older_than - report_id,
+    # после которого продолжить (чтобы пропустить обращения, фото которых не удалось загрузить)
+    async def get_reports_without_photo_hash(self, limit: int, older_than: Optional[int] = None) -> List[sqlite3.Row]:
+        def query(conn):
+            return conn.execute('''
+                SELECT r.report_id, r.photo_id
+                FROM reports r
+                WHERE r.photo_id IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM photo_hashes p WHERE p.report_id = r.report_id)
+                  AND (? IS NULL OR r.report_id < ?)
+                ORDER BY r.report_id DESC
+                LIMIT ?
+            ''', (older_than, older_than, limit)).fetchall()
+
+        return await self._run(query)
+
+    async def get_report(self, report_id: int) -> Optional[sqlite3.Row]:
+        def query(conn):
+            return conn.execute('SELECT * FROM reports_all WHERE report_id = ?', (report_id,)).fetchone()
+
+        return await self._run(query)
+
+    # Госслужащие, которым нужно отправить обращение: с подходящей подпиской
+    # и все, кто еще не настроил подписки (они получают все обращения)
+    async def get_report_officials(self, report) -> Set[int]:
+        officials = set(await self.get_user_ids_by_role('official'))
+        matched = self.subscriptions.match(report['category'], report['latitude'], report['longitude'])
+        return (officials - self.subscriptions.subscribers()) | (matched & officials)
+
+    # Одобрение модератором: статус "Новое" для обращения и его дубликатов,
+    # оповещения подходящим госслужащим (одно на кластер) и авторам.
+    # Возвращает обновлённое обращение или None, если оно не найдено
+    async def approve_report(self, report_id: int) -> Optional[sqlite3.Row]:
+        report = await self.get_report(report_id)
+        if not report:
+            return None
+
+        officials = await self.get_report_officials(report)
+
+        def query(conn):
+            members = _set_cluster_status(conn, report_id, 'Новое')
+            if members:
+                for official_id in officials:
+                    _enqueue(conn, 'official', official_id, report_id)
+                for member in members:
+                    _enqueue(conn, 'approved', member['user_id'], member['report_id'])
+            return conn.execute('SELECT * FROM reports WHERE report_id = ?', (report_id,)).fetchone()
+
+        return await self._write(query)
+
+    # Отклонение модератором обращения и его дубликатов с оповещением авторов.
+    # Возвращает обновлённое обращение или None, если оно не найдено
+    async def reject_report(self, report_id: int) -> Optional[sqlite3.Row]:
+        def query(conn):
+            for member in _set_cluster_status(conn, report_id, 'Отклонено модератором'):
+                _enqueue(conn, 'rejected', member['user_id'], member['report_id'])
+            return conn.execute('SELECT * FROM reports WHERE report_id = ?', (report_id,)).fetchone()
+
+        return await self._write(query)
+
+    # Смена статуса госслужащим (для обращения и его дубликатов) с записью в историю
+    # и оповещением авторов. Возвращает user_id автора обращения или None, если оно не найдено
+    async def update_report_status(self, report_id: int, official_id: int, status: str,
+                                   comment: str) -> Optional[int]:
+        def query(conn):
+            now = datetime.now()
+            author_id = None
+
+            for member in _set_cluster_status(conn, report_id, status, now):
+                cursor = conn.execute('''
+                    INSERT INTO status_updates (report_id, official_id, status, comment, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (member['report_id'], official_id, status, comment, now))
+                _enqueue(conn, 'status', member['user_id'], member['report_id'], cursor.lastrowid,
+                         {'status': status, 'comment': comment})
+
+                if member['report_id'] == report_id:
+                    author_id = member['user_id']
+
+            return author_id
+
+        return await self._write(query)
+
+    # Страница обращений пользователя (от новых к старым, включая архивные) с keyset-пагинацией
+    # по (created_at, report_id). older_than/newer_than - report_id границы предыдущей страницы.
+    # Возвращает (обращения, есть_новее, есть_старше)
+    async def get_user_reports_page(self, user_id: int, limit: int, older_than: Optional[int] = None,
+                                    newer_than: Optional[int] = None) -> Tuple[List[sqlite3.Row], bool, bool]:
+        def query(conn):
+            if newer_than is not None:
+                rows = conn.execute('''
+                    SELECT report_id, category, description, status, created_at
+                    FROM reports_all
+                    WHERE user_id = ?
+                      AND (created_at, report_id) > (SELECT created_at, report_id FROM reports_all WHERE report_id = ?)
+                    ORDER BY created_at, report_id
+                    LIMIT ?
+                ''', (user_id, newer_than, limit + 1)).fetchall()
+                has_newer = len(rows) > limit
+                return list(reversed(rows[:limit])), has_newer, True
+
+            if older_than is not None:
+                rows = conn.execute('''
+                    SELECT report_id, category, description, status, created_at
+                    FROM reports_all
+                    WHERE user_id = ?
+                      AND (created_at, report_id) < (SELECT created_at, report_id FROM reports_all WHERE report_id = ?)
+                    ORDER BY created_at DESC, report_id DESC
+                    LIMIT ?
+                ''', (user_id, older_than, limit + 1)).fetchall()
+                return rows[:limit], True, len(rows) > limit
+
+            rows = conn.execute('''
+                SELECT report_id, category, description, status, created_at
+                FROM reports_all
+                WHERE user_id = ?
+                ORDER BY created_at DESC, report_id DESC
+                LIMIT ?
+            ''', (user_id, limit + 1)).fetchall()
+            return rows[:limit], False, len(rows) > limit
+
+        return await self._run(query)
+
+    # Страница обращений на модерации (от новых к старым), older_than - последний report_id
+    # предыдущей страницы. Возвращает (обращения, есть_следующая_страница)
+    async def get_pending_reports(self, limit: int,
+                                  older_than: Optional[int] = None) -> Tuple[List[sqlite3.Row], bool]:
+        def query(conn):
+            rows = conn.execute(f'''
+                SELECT report_id, category, description, created_at, updated_at, photo_id, latitude, longitude,
+                       similar_photo_id,
+                       (SELECT COUNT(*) FROM reports d WHERE d.cluster_id = reports.report_id) AS duplicates
+                FROM reports
+                WHERE status = 'На модерации' AND cluster_id IS NULL {_keyset_before(older_than)}
+                ORDER BY created_at DESC, report_id DESC
+                LIMIT ?
+            ''', _keyset_params(older_than, limit + 1)).fetchall()
+            return rows[:limit], len(rows) > limit
+
+        return await self._run(query)
+
+    # Страница активных обращений для госслужащих, аналогично get_pending_reports
+    async def get_active_reports(self, limit: int,
+                                 older_than: Optional[int] = None) -> Tuple[List[sqlite3.Row], bool]:
+        def query(conn):
+            rows = conn.execute(f'''
+                SELECT report_id, category, description, status, created_at, updated_at, photo_id,
+                       latitude, longitude,
+                       (SELECT COUNT(*) FROM reports d WHERE d.cluster_id = reports.report_id) AS duplicates
+                FROM reports
+                WHERE status != 'На модерации' AND status != 'Отклонено модератором' AND status != 'Решено'
+                      AND cluster_id IS NULL {_keyset_before(older_than)}
+                ORDER BY created_at DESC, report_id DESC
+                LIMIT ?
+            ''', _keyset_params(older_than, limit + 1)).fetchall()
+            return rows[:limit], len(rows) > limit
+
+        return await self._run(query)
+
+    # Обращения (включая архивные) для выгрузки с фильтрами по статусу, категории и дате создания
+    # [since, until), пачками по batch_size в порядке report_id. Каждая пачка читается отдельной короткой транзакцией
+    # (keyset-пагинация), поэтому длинная выгрузка не держит соединение и блокировку БД
+    async def iter_reports(self, status: Optional[str] = None, category: Optional[str] = None,
+                           since: Optional[datetime] = None, until: Optional[datetime] = None,
+                           batch_size: int = 1000) -> AsyncIterator[List[sqlite3.Row]]:
+        conditions = ['report_id > ?']
+        params = []
+        for condition, value in (('status = ?', status), ('category = ?', category),
+                                 ('created_at >= ?', since), ('created_at < ?', until)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+
+        sql = f'''
+            SELECT report_id, created_at, updated_at, category, status, description,
+                   latitude, longitude, cluster_id, photo_id
+            FROM reports_all
+            WHERE {' AND '.join(conditions)}
+            ORDER BY report_id
+            LIMIT ?
+        '''
+
+        def query(conn, after):
+            return conn.execute(sql, [after, *params, batch_size]).fetchall()
+
+        after = 0
+        while True:
+            rows = await self._run(query, after)
+            if not rows:
+                return
+            yield rows
+            if len(rows) < batch_size:
+                return
+            after = rows[-1]['report_id']
+
+    # Обращения в радиусе radius_m метров от точки, от ближайших к дальним.
+    # Сначала отбор по ограничивающему прямоугольнику через R*Tree, затем точная проверка расстояния.
+    # Возвращает список пар (обращение, расстояние в метрах)
+    async def find_reports_within(self, lat: float, lon: float, radius_m: float, limit: int = 10,
+                                  exclude_statuses: Iterable[str] = ()) -> List[Tuple[sqlite3.Row, float]]:
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_m)
+        exclude_statuses = list(exclude_statuses)
+
+        def query(conn):
+            return conn.execute(f'''
+                SELECT r.report_id, r.category, r.description, r.status, r.created_at, r.latitude, r.longitude
+                FROM reports_rtree t
+                CROSS JOIN reports r ON r.report_id = t.report_id
+                WHERE t.max_lat >= ? AND t.min_lat <= ? AND t.max_lon >= ? AND t.min_lon <= ?
+                  AND r.cluster_id IS NULL AND r.status NOT IN ({', '.join('?' * len(exclude_statuses))})
+            ''', (min_lat, max_lat, min_lon, max_lon, *exclude_statuses)).fetchall()
+
+        candidates = await self._run(query)
+
+        found = []
+        for row in candidates:
+            distance = haversine(lat, lon, row['latitude'], row['longitude'])
+            if distance <= radius_m:
+                found.append((row, distance))
+
+        found.sort(key=lambda item: item[1])
+        return found[:limit]
+
+    # Полнотекстовый поиск по описаниям обращений и комментариям к смене статуса (FTS5),
+    # от более релевантных к менее (bm25, совпадение в описании весит вдвое больше),
+    # с необязательными фильтрами по статусу и категории. Ищет и среди архивных обращений:
+    # найденные строки индекса соединяются с reports и reports_archive по ключу
+    # (соединение с представлением reports_all материализовало бы его целиком).
+    # Возвращает (страница обращений со фрагментом найденного текста, есть_еще)
+    async def search_reports(self, text: str, limit: int, offset: int = 0, status: Optional[str] = None,
+                             category: Optional[str] = None) -> Tuple[List[sqlite3.Row], bool]:
+        match = _fts_query(text)
+        if match is None:
+            return [], False
+
+        conditions = ''
+        params = [match]
+        for condition, value in (('IFNULL(r.status, a.status) = ?', status),
+                                 ('IFNULL(r.category, a.category) = ?', category)):
+            if value is not None:
+                conditions += f' AND {condition}'
+                params.append(value)
+
+        def query(conn):
+            rows = conn.execute(f'''
+                SELECT reports_fts.rowid AS report_id, IFNULL(r.category, a.category) AS category,
+                       IFNULL(r.status, a.status) AS status, IFNULL(r.created_at, a.created_at) AS created_at,
+                       snippet(reports_fts, -1, '', '', '…', 16) AS snippet
+                FROM reports_fts
+                LEFT JOIN reports r ON r.report_id = reports_fts.rowid
+                LEFT JOIN reports_archive a ON a.report_id = reports_fts.rowid
+                WHERE reports_fts MATCH ? AND (r.report_id IS NOT NULL OR a.report_id IS NOT NULL) {conditions}
+                ORDER BY bm25(reports_fts, 2.0, 1.0)
+                LIMIT ? OFFSET ?
+            ''', (*params, limit + 1, offset)).fetchall()
+            return rows[:limit], len(rows) > limit
+
+        return await self._run(query)
+
+    # История статусов обращения (для архивного - из status_updates_archive), от новых к старым
+    async def get_status_history(self, report_id: int) -> List[sqlite3.Row]:
+        def query(conn):
+            return conn.execute('''
+                SELECT s.status, s.comment, s.created_at, u.first_name, u.last_name
+                FROM (
+                    SELECT official_id, status, comment, created_at FROM status_updates WHERE report_id = ?
+                    UNION ALL
+                    SELECT official_id, status, comment, created_at FROM status_updates_archive WHERE report_id = ?
+                ) s
+                JOIN users u ON s.official_id = u.user_id
+                ORDER BY s.created_at DESC
+            ''', (report_id, report_id)).fetchall()
+
+        return await self._run(query)
+
+    # Перенос в архив закрытых обращений, последнее изменение которых было раньше older_than назад,
+    # вместе с историей статусов: не больше batch_size обращений за короткую транзакцию.
+    # Обращения с неотправленными оповещениями пропускаются до их отправки.
+    # Возвращает число перенесенных обращений
+    async def archive_reports(self, older_than: timedelta, batch_size: int) -> int:
+        def query(conn):
+            now = datetime.now()
+            ids = [row[0] for row in conn.execute(f'''
+                SELECT r.report_id
+                FROM reports r
+                WHERE r.status IN ({', '.join('?' * len(ARCHIVE_STATUSES))})
+                  AND COALESCE(r.updated_at, r.created_at) < ?
+                  AND NOT EXISTS (SELECT 1 FROM outbox o
+                                  WHERE o.report_id = r.report_id AND o.status IN ('pending', 'sending'))
+                LIMIT ?
+            ''', (*ARCHIVE_STATUSES, now - older_than, batch_size))]
+            if not ids:
+                return 0
+
+            # Строки архива вставляются до удаления: по ним триггеры reports и status_updates
+            # отличают перенос в архив от удаления
+            placeholders = ', '.join('?' * len(ids))
+            conn.execute(f'''
+                INSERT INTO reports_archive ({REPORT_COLUMNS}, archived_at)
+                SELECT {REPORT_COLUMNS}, ? FROM reports WHERE report_id IN ({placeholders})
+            ''', (now, *ids))
+            conn.execute(f'''
+                INSERT INTO status_updates_archive (update_id, report_id, official_id, status, comment, created_at)
+                SELECT update_id, report_id, official_id, status, comment, created_at
+                FROM status_updates WHERE report_id IN ({placeholders})
+            ''', ids)
+            conn.execute(f'DELETE FROM status_updates WHERE report_id IN ({placeholders})', ids)
+            conn.execute(f'DELETE FROM reports WHERE report_id IN ({placeholders})', ids)
+            return len(ids)
+
+        return await self._write(query)
+
+    # Подписки госслужащих
+
+    async def add_subscription(self, official_id: int, category: Optional[str], latitude: Optional[float],
+                               longitude: Optional[float], radius_m: Optional[float]) -> Subscription:
+        def query(conn):
+            cursor = conn.execute('''
+                INSERT INTO subscriptions (official_id, category, latitude, longitude, radius_m, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (official_id, category, latitude, longitude, radius_m, datetime.now()))
+            return cursor.lastrowid
+
+        subscription = Subscription(await self._write(query), official_id, category, latitude, longitude, radius_m)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    # Возвращает False, если подписка не найдена или принадлежит другому пользователю
+    async def delete_subscription(self, official_id: int, subscription_id: int) -> bool:
+        def query(conn):
+            cursor = conn.execute('DELETE FROM subscriptions WHERE subscription_id = ? AND official_id = ?',
+                                  (subscription_id, official_id))
+            return cursor.rowcount > 0
+
+        deleted = await self._write(query)
+        if deleted:
+            self.subscriptions.remove(subscription_id)
+        return deleted
+
+    def get_subscriptions(self, official_id: int) -> List[Subscription]:
+        return self.subscriptions.of_official(official_id)
+
+    # Очередь оповещений (outbox)
+
+    # Захват пачки готовых к отправке сообщений. Захваченные сообщения переходят
+    # в статус 'sending' на lease секунд; если процесс упадет, они вернутся в работу
+    async def claim_outbox(self, limit: int, lease: float) -> List[sqlite3.Row]:
+        def query(conn):
+            now = datetime.now()
+            rows = conn.execute('''
+                SELECT o.message_id, o.kind, o.chat_id, o.report_id, o.payload, o.attempts,
+                       r.user_id, r.category, r.description, r.latitude, r.longitude, r.photo_id, r.status,
+                       r.updated_at, r.similar_photo_id,
+                       (SELECT COUNT(*) FROM reports d WHERE d.cluster_id = o.report_id) AS duplicates
+                FROM outbox o
+                LEFT JOIN reports r ON r.report_id = o.report_id
+                WHERE o.status IN ('pending', 'sending') AND o.next_attempt_at <= ?
+                ORDER BY o.next_attempt_at
+                LIMIT ?
+            ''', (now, limit)).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET status = 'sending', next_attempt_at = ? WHERE message_id = ?",
+                [(now + timedelta(seconds=lease), row['message_id']) for row in rows]
+            )
+            return rows
+
+        return await self._write(query)
+
+    # Фиксация результатов отправки: failures - список (message_id, ошибка, следующая попытка или None).
+    # Сообщения без следующей попытки переходят в статус 'dead'
+    async def complete_outbox(self, sent_ids: Iterable[int],
+                              failures: Iterable[Tuple[int, str, Optional[datetime]]]):
+        def query(conn):
+            now = datetime.now()
+            conn.executemany(
+                "UPDATE outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1 WHERE message_id = ?",
+                [(now, message_id) for message_id in sent_ids]
+            )
+            conn.executemany('''
+                UPDATE outbox
+                SET status = CASE WHEN ? IS NULL THEN 'dead' ELSE 'pending' END,
+                    next_attempt_at = COALESCE(?, next_attempt_at),
+                    attempts = attempts + 1,
+                    last_error = ?
+                WHERE message_id = ?
+            ''', [(retry_at, retry_at, error, message_id) for message_id, error, retry_at in failures])
+
+        await self._write(query)
+
+    # Размер очереди по статусам
+    async def get_outbox_depth(self) -> Dict[str, int]:
+        def query(conn):
+            rows = conn.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall()
+            return {row[0]: row[1] for row in rows}
+
+        return await self._run(query)
+
+    # Удаление доставленных сообщений старше указанного возраста
+    async def prune_outbox(self, older_than: timedelta) -> int:
+        def query(conn):
+            cursor = conn.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?",
+                                  (datetime.now() - older_than,))
+            return cursor.rowcount
+
+        return await self._write(query)
+
+    # Статистика по агрегатам, которые поддерживают триггеры (время ответа не зависит от числа обращений):
+    # totals - {(категория, статус): число}, daily - [(день, новых обращений)] за последние days дней,
+    # median_resolution_hours - медиана времени решения в часах (None, если решенных нет)
+    async def get_stats(self, days: int = 7) -> dict:
+        def query(conn):
+            totals = conn.execute(
+                'SELECT category, status, reports FROM report_stats_totals WHERE reports > 0'
+            ).fetchall()
+            daily = conn.execute('''
+                SELECT day, SUM(reports) FROM report_stats_daily
+                WHERE day >= ?
+                GROUP BY day
+                HAVING SUM(reports) > 0
+                ORDER BY day
+            ''', ((datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d'),)).fetchall()
+            resolution = conn.execute(
+                'SELECT hours, reports FROM report_resolution_hours WHERE reports > 0 ORDER BY hours'
+            ).fetchall()
+            return totals, daily, resolution
+
+        totals, daily, resolution = await self._run(query)
+
+        median = None
+        resolved = sum(count for _, count in resolution)
+        seen = 0
+        for hours, count in resolution:
+            seen += count
+            if seen * 2 >= resolved:
+                median = hours
+                break
+
+        return {
+            'totals': {(row[0], row[1]): row[2] for row in totals},
+            'daily': [(row[0], row[1]) for row in daily],
+            'median_resolution_hours': median,
+        }
+
+    # Сохраненное состояние бота (user_data и диалоги)
+
+    async def get_persisted_user_data(self) -> Dict[int, str]:
+        def query(conn):
+            rows = conn.execute('SELECT user_id, data FROM persisted_user_data').fetchall()
+            return {row['user_id']: row['data'] for row in rows}
+
+        return await self._run(query)
+
+    async def get_persisted_conversations(self, name: str) -> Dict[str, str]:
+        def query(conn):
+            rows = conn.execute('SELECT key, state FROM persisted_conversations WHERE name = ?',
+                                (name,)).fetchall()
+            return {row['key']: row['state'] for row in rows}
+
+        return await self._run(query)
+
+    # Запись накопленных изменений одной транзакцией. Значения - JSON, None означает удаление:
+    # user_data - {user_id: data}, conversations - {(name, key): state}
+    async def save_persisted_state(self, user_data: Dict[int, Optional[str]],
+                                   conversations: Dict[Tuple[str, str], Optional[str]]):
+        def query(conn):
+            conn.executemany(
+                'INSERT OR REPLACE INTO persisted_user_data (user_id, data) VALUES (?, ?)',
+                [(user_id, data) for user_id, data in user_data.items() if data is not None]
+            )
+            conn.executemany(
+                'DELETE FROM persisted_user_data WHERE user_id = ?',
+                [(user_id,) for user_id, data in user_data.items() if data is None]
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO persisted_conversations (name, key, state) VALUES (?, ?, ?)',
+                [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+            )
+            conn.executemany(
+                'DELETE FROM persisted_conversations WHERE name = ? AND key = ?',
+                [(name, key) for (name, key), state in conversations.items() if state is None]
+            )
+
+        await self._write(query)
+
+
+# Рабочее хранилище: файл SQLite в режиме WAL. Читатели не блокируют запись и наоборот,
+# а synchronous=NORMAL в WAL делает fsync только при контрольной точке, не на каждый коммит
+# (после сбоя питания могут потеряться последние транзакции, но не целостность БД)
+class SQLiteStorage(Storage):
+    def __init__(self, path: str = DB_PATH, cache_size_kb: int = 16384, mmap_size: int = 256 * 1024 * 1024,
+                 journal_size_limit: int = 64 * 1024 * 1024, **kwargs):
+        super().__init__(path, **kwargs)
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.journal_size_limit = journal_size_limit
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = super()._connect()
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA journal_size_limit = {int(self.journal_size_limit)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+
+# Хранилище в памяти для нагрузочных прогонов и проверок: та же схема и те же запросы,
+# но БД SQLite в памяти процесса. База живет, пока открыто ее единственное соединение,
+# поэтому пул состоит из одного соединения, и писатель берет его из того же пула
+class MemoryStorage(Storage):
+    def __init__(self, **kwargs):
+        kwargs['pool_size'] = 1
+        super().__init__(':memory:', **kwargs)
+
+    def _open_writer(self) -> queue.Queue:
+        return self._pool
+
+
+# Хранилище по адресу БД: ':memory:' - в памяти, иначе файл SQLite
+def open_storage(path: str = DB_PATH) -> Storage:
+    if path == ':memory:':
+        return MemoryStorage()
+    return SQLiteStorage(path)
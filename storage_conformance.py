@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import traceback
+from datetime import datetime, timedelta
+
+from storage import MemoryStorage, SQLiteStorage, Storage
+
+# Проверка того, что реализации хранилища ведут себя одинаково: каждый сценарий
+# выполняется на каждой реализации с чистой БД. Пример:
+#   python storage_conformance.py --backend memory
+# Код возврата 1, если хотя бы один сценарий не прошел
+
+SCENARIOS = []
+
+# Точка, рядом с которой создаются обращения в сценариях (Алматы)
+LAT, LON = 43.25, 76.95
+
+
+def scenario(fn):
+    SCENARIOS.append(fn)
+    return fn
+
+
+def expect(condition, message: str):
+    if not condition:
+        raise AssertionError(message)
+
+
+# Захват всех готовых сообщений outbox с отметкой об отправке; возвращает пары (kind, chat_id)
+async def drain_outbox(storage: Storage) -> set:
+    messages = await storage.claim_outbox(100, 60)
+    await storage.complete_outbox([message['message_id'] for message in messages], [])
+    return {(message['kind'], message['chat_id']) for message in messages}
+
+
+@scenario
+async def users_and_roles(storage: Storage):
+    await storage.register_user(1, 'user1', 'Айдар', 'Сапаров')
+    expect(await storage.get_role(1) == 'user', "новый пользователь должен получить роль user")
+    expect(await storage.set_role(1, 'moderator'), "set_role для зарегистрированного пользователя")
+    expect(await storage.get_role(1) == 'moderator', "роль должна смениться")
+    expect(await storage.get_user_ids_by_role('moderator') == [1], "список модераторов")
+    expect(not await storage.set_role(999, 'admin'), "set_role для неизвестного пользователя")
+    expect(await storage.get_role(999) is None, "роль неизвестного пользователя")
+
+
+@scenario
+async def moderation_and_outbox(storage: Storage):
+    for user_id, role in ((10, 'moderator'), (20, 'official'), (30, 'user'), (31, 'user')):
+        await storage.register_user(user_id, None, f'Имя{user_id}', None)
+        await storage.set_role(user_id, role)
+
+    report_id, cluster_id = await storage.create_report(30, 'Пожар', 'Горит сухая трава у реки', LAT, LON, 'p1')
+    expect(cluster_id is None, "первое обращение не должно быть дубликатом")
+    expect(await drain_outbox(storage) == {('moderation', 10)}, "оповещение модератора о новом обращении")
+
+    duplicate_id, cluster_id = await storage.create_report(31, 'Пожар', 'Горит трава у реки',
+                                                           LAT + 0.0001, LON + 0.0001, 'p2')
+    expect(cluster_id == report_id, "обращение рядом с той же проблемой должно войти в кластер")
+    expect(await drain_outbox(storage) == set(), "дубликат не отправляется модераторам")
+
+    approved = await storage.approve_report(report_id)
+    expect(approved['status'] == 'Новое', "одобренное обращение получает статус 'Новое'")
+    expect((await storage.get_report(duplicate_id))['status'] == 'Новое', "статус переходит на дубликаты")
+    expect(await drain_outbox(storage) == {('official', 20), ('approved', 30), ('approved', 31)},
+           "оповещения госслужащему и авторам после одобрения")
+
+    author_id = await storage.update_report_status(report_id, 20, 'Решено', 'Потушено')
+    expect(author_id == 30, "update_report_status возвращает автора обращения")
+    history = await storage.get_status_history(report_id)
+    expect([(row['status'], row['comment']) for row in history] == [('Решено', 'Потушено')],
+           "история изменений статуса")
+    expect(await drain_outbox(storage) == {('status', 30), ('status', 31)}, "оповещения авторов о статусе")
+    expect(await storage.get_outbox_depth() == {'sent': 6}, "все сообщения outbox отмечены отправленными")
+
+    rejected_id, _ = await storage.create_report(30, 'Мусор', 'Свалка во дворе', LAT + 1, LON, 'p3')
+    rejected = await storage.reject_report(rejected_id)
+    expect(rejected['status'] == 'Отклонено модератором', "отклонение модератором")
+    expect(await storage.approve_report(10 ** 9) is None, "одобрение несуществующего обращения")
+
+
+@scenario
+async def report_pages(storage: Storage):
+    await storage.register_user(40, None, None, None)
+    ids = []
+    for number in range(7):
+        report_id, _ = await storage.create_report(40, 'Дороги', f'Яма на дороге {number}',
+                                                   LAT + number * 0.1, LON, f'p{number}')
+        ids.append(report_id)
+
+    page, has_newer, has_older = await storage.get_user_reports_page(40, 5)
+    expect([row['report_id'] for row in page] == ids[:1:-1] and not has_newer and has_older,
+           "первая страница обращений пользователя")
+    page, has_newer, has_older = await storage.get_user_reports_page(40, 5, older_than=page[-1]['report_id'])
+    expect([row['report_id'] for row in page] == ids[1::-1] and has_newer and not has_older,
+           "вторая страница обращений пользователя")
+
+    pending, has_more = await storage.get_pending_reports(5)
+    expect(len(pending) == 5 and has_more, "страница обращений на модерации")
+    pending, has_more = await storage.get_pending_reports(5, older_than=pending[-1]['report_id'])
+    expect(len(pending) == 2 and not has_more, "последняя страница обращений на модерации")
+
+    await storage.approve_report(ids[0])
+    active, has_more = await storage.get_active_reports(5)
+    expect([row['report_id'] for row in active] == [ids[0]] and not has_more, "страница активных обращений")
+
+
+@scenario
+async def geo_search_and_export(storage: Storage):
+    near_id, _ = await storage.create_report(50, 'Освещение', 'Не горят фонари в парке', LAT, LON, 'p1')
+    far_id, _ = await storage.create_report(50, 'Освещение', 'Не горят фонари на остановке', LAT + 1, LON, 'p2')
+    await storage.update_report_status(far_id, 20, 'Решено', 'Заменили лампы')
+
+    found = await storage.find_reports_within(LAT + 0.001, LON, 500)
+    expect([report['report_id'] for report, _ in found] == [near_id], "поиск обращений в радиусе")
+    expect(100 < found[0][1] < 120, "расстояние до найденного обращения")
+
+    rows, has_more = await storage.search_reports('фонарей', 10)
+    expect({row['report_id'] for row in rows} == {near_id, far_id} and not has_more,
+           "полнотекстовый поиск по описанию")
+    rows, _ = await storage.search_reports('лампы', 10)
+    expect([row['report_id'] for row in rows] == [far_id], "полнотекстовый поиск по комментариям")
+    rows, _ = await storage.search_reports('фонари', 10, status='Решено')
+    expect([row['report_id'] for row in rows] == [far_id], "поиск с фильтром по статусу")
+    expect(await storage.search_reports('!!', 10) == ([], False), "запрос без слов")
+
+    stats = await storage.get_stats()
+    expect(stats['totals'] == {('Освещение', 'На модерации'): 1, ('Освещение', 'Решено'): 1},
+           "статистика по категориям и статусам")
+    expect(sum(count for _, count in stats['daily']) == 2, "статистика по дням")
+
+    batches = [batch async for batch in storage.iter_reports(batch_size=1)]
+    expect([[row['report_id'] for row in batch] for batch in batches] == [[near_id], [far_id]],
+           "выгрузка пачками")
+    batches = [batch async for batch in storage.iter_reports(status='Решено', since=datetime.now() - timedelta(1))]
+    expect([row['report_id'] for batch in batches for row in batch] == [far_id], "выгрузка с фильтрами")
+
+
+@scenario
+async def resolution_stats(storage: Storage):
+    report_id, _ = await storage.create_report(90, 'Вода', 'Течет труба', LAT, LON, 'p1')
+    await storage.approve_report(report_id)
+    await storage.update_report_status(report_id, 20, 'Решено', 'Заменили')
+    await storage.update_report_status(report_id, 20, 'Решено', 'Проверили еще раз')
+    expect((await storage.get_stats())['median_resolution_hours'] == 0, "решенное обращение учтено один раз")
+
+    await storage.update_report_status(report_id, 20, 'В работе', 'Снова течет')
+    stats = await storage.get_stats()
+    expect(stats['median_resolution_hours'] is None, "переоткрытое обращение убрано из времени решения")
+    expect(stats['totals'] == {('Вода', 'В работе'): 1}, "статистика после переоткрытия")
+
+    await storage.update_report_status(report_id, 20, 'Решено', 'Заменили трубу')
+    expect((await storage.get_stats())['median_resolution_hours'] == 0, "повторно решенное обращение")
+
+
+@scenario
+async def photo_duplicates(storage: Storage):
+    photo_hash = 0x0F0F0F0F0F0F0F0F
+    first_id, _ = await storage.create_report(60, 'Мусор', 'Свалка', LAT, LON, 'p1', photo_hash=photo_hash)
+
+    # Та же категория в 200 м, описание другое: присоединяется по фото, статус остается "На модерации"
+    near_id, cluster_id = await storage.create_report(61, 'Мусор', 'Совсем другое описание', LAT + 0.002, LON,
+                                                      'p2', photo_hash=photo_hash ^ 1)
+    expect(cluster_id == first_id, "обращение с почти тем же фото рядом должно войти в кластер")
+    expect((await storage.get_report(near_id))['status'] == 'На модерации', "статус обращения в кластере")
+
+    # Другая категория в 111 км: не присоединяется, модератор видит пометку о похожем фото
+    far_id, cluster_id = await storage.create_report(62, 'Дороги', 'Яма', LAT + 1, LON, 'p3',
+                                                     photo_hash=photo_hash ^ 2)
+    expect(cluster_id is None, "похожее фото другой категории далеко не должно присоединять к кластеру")
+    pending = {row['report_id']: row for row in (await storage.get_pending_reports(10))[0]}
+    expect(pending[far_id]['similar_photo_id'] == first_id, "пометка о похожем фото")
+
+    # Лидер уже одобрен: статус не копируется, обращение идет на модерацию с пометкой
+    await storage.approve_report(first_id)
+    late_id, cluster_id = await storage.create_report(63, 'Мусор', 'Еще одно описание', LAT + 0.002, LON,
+                                                      'p4', photo_hash=photo_hash ^ 4)
+    late = await storage.get_report(late_id)
+    expect(cluster_id is None and late['status'] == 'На модерации', "фото не пропускает модерацию")
+    pending = {row['report_id']: row for row in (await storage.get_pending_reports(10))[0]}
+    expect(pending[late_id]['similar_photo_id'] == first_id, "пометка о похожем фото одобренного обращения")
+
+    # Однотонные фото (хеш из нулей) не сравниваются
+    dark_id, _ = await storage.create_report(64, 'Пожар', 'Дым', LAT + 2, LON, 'p5', photo_hash=0)
+    sky_id, cluster_id = await storage.create_report(65, 'Пожар', 'Дым', LAT + 2, LON, 'p6', photo_hash=0)
+    pending = {row['report_id']: row for row in (await storage.get_pending_reports(10))[0]}
+    expect(cluster_id in (None, dark_id) and pending.get(sky_id, {'similar_photo_id': None})['similar_photo_id'] is None,
+           "неинформативный хеш не дает совпадений по фото")
+    expect(await storage.get_reports_without_photo_hash(10) == [], "хеши фото сохранены")
+
+
+@scenario
+async def archive(storage: Storage):
+    await storage.register_user(20, None, 'Госслужащий', None)
+    await storage.set_role(20, 'official')
+    closed_id, _ = await storage.create_report(80, 'Мусор', 'Переполнены контейнеры', LAT, LON, 'p1')
+    open_id, _ = await storage.create_report(80, 'Мусор', 'Свалка у школы', LAT + 1, LON, 'p2')
+    await storage.update_report_status(closed_id, 20, 'Решено', 'Контейнеры вывезли')
+    stats = await storage.get_stats()
+
+    expect(await storage.archive_reports(timedelta(days=1), 10) == 0, "недавно закрытые обращения не архивируются")
+    await drain_outbox(storage)
+    expect(await storage.archive_reports(timedelta(0), 10) == 1, "перенос закрытого обращения в архив")
+    expect(await storage.archive_reports(timedelta(0), 10) == 0, "повторный перенос")
+
+    expect((await storage.get_report(closed_id))['status'] == 'Решено', "архивное обращение находится по номеру")
+    expect([row['comment'] for row in await storage.get_status_history(closed_id)] == ['Контейнеры вывезли'],
+           "история статусов архивного обращения")
+    page, _, _ = await storage.get_user_reports_page(80, 5)
+    expect([row['report_id'] for row in page] == [open_id, closed_id], "архивные обращения в списке пользователя")
+    rows, _ = await storage.search_reports('контейнеры', 10)
+    expect([row['report_id'] for row in rows] == [closed_id], "поиск по архивным обращениям")
+    batches = [batch async for batch in storage.iter_reports()]
+    expect([row['report_id'] for batch in batches for row in batch] == [closed_id, open_id],
+           "выгрузка архивных обращений")
+    expect(await storage.get_stats() == stats, "перенос в архив не меняет статистику")
+    expect(await storage.find_reports_within(LAT, LON, 100) == [], "архивные обращения не ищутся по месту")
+
+
+@scenario
+async def subscriptions_and_state(storage: Storage):
+    subscription = await storage.add_subscription(70, 'Пожар', LAT, LON, 1000)
+    expect(storage.get_subscriptions(70) == [subscription], "подписка госслужащего")
+    expect(not await storage.delete_subscription(71, subscription.subscription_id),
+           "удаление чужой подписки")
+    expect(await storage.delete_subscription(70, subscription.subscription_id), "удаление подписки")
+    expect(storage.get_subscriptions(70) == [], "подписка удалена")
+
+    await storage.save_persisted_state({1: '{"a": 1}', 2: '{}'}, {('report', '1'): '"CATEGORY"'})
+    await storage.save_persisted_state({2: None}, {})
+    expect(await storage.get_persisted_user_data() == {1: '{"a": 1}'}, "сохраненные данные пользователей")
+    expect(await storage.get_persisted_conversations('report') == {'1': '"CATEGORY"'},
+           "сохраненные состояния диалогов")
+
+
+# Выполнение всех сценариев на чистых хранилищах, созданных factory. Возвращает число ошибок
+async def run_backend(name: str, factory) -> int:
+    failures = 0
+    for fn in SCENARIOS:
+        storage = factory()
+        storage.setup()
+        try:
+            await fn(storage)
+            print(f"{name}: {fn.__name__} ok")
+        except Exception:
+            failures += 1
+            print(f"{name}: {fn.__name__} FAILED")
+            traceback.print_exc()
+        finally:
+            storage.close()
+    return failures
+
+
+async def run(backends) -> int:
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        counter = iter(range(len(SCENARIOS)))
+
+        def sqlite_storage():
+            storage = SQLiteStorage(os.path.join(directory, f'conformance-{next(counter)}.db'))
+            conn = storage._connect()
+            try:
+                expect(conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal', "SQLiteStorage работает в WAL")
+            finally:
+                conn.close()
+            return storage
+
+        factories = {'sqlite': sqlite_storage, 'memory': MemoryStorage}
+        for name in backends:
+            failures += await run_backend(name, factories[name])
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка реализаций хранилища")
+    parser.add_argument('--backend', choices=['sqlite', 'memory', 'all'], default='all')
+    args = parser.parse_args()
+
+    backends = ['sqlite', 'memory'] if args.backend == 'all' else [args.backend]
+    failures = asyncio.run(run(backends))
+    print(f"Ошибок: {failures}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
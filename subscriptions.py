@@ -0,0 +1,107 @@
+import math
+from collections import Counter, defaultdict, namedtuple
+from typing import Iterable, List, Optional, Set
+
+from geo import bounding_box, haversine
+
+# Подписка госслужащего: category None - все категории, latitude/longitude/radius_m None - вся страна
+Subscription = namedtuple(
+    'Subscription',
+    ['subscription_id', 'official_id', 'category', 'latitude', 'longitude', 'radius_m']
+)
+
+# Размер ячейки пространственной сетки индекса, в градусах
+CELL_SIZE = 1.0
+
+
+def _cell(latitude: float, longitude: float):
+    return math.floor(latitude / CELL_SIZE), math.floor(longitude / CELL_SIZE)
+
+
+# Индекс подписок в памяти: подписки без области хранятся отдельно, подписки с областью
+# раскладываются по ячейкам сетки, которые пересекает их ограничивающий прямоугольник.
+# Подбор получателей проверяет только подписки ячейки, в которую попало обращение.
+# Используется только из event loop, поэтому блокировки не нужны
+class SubscriptionIndex:
+    def __init__(self):
+        self._subscriptions = {}
+        self._everywhere: Set[int] = set()
+        self._cells = defaultdict(set)
+        self._officials = Counter()
+
+    def _cells_of(self, subscription: Subscription):
+        min_lat, max_lat, min_lon, max_lon = bounding_box(
+            subscription.latitude, subscription.longitude, subscription.radius_m
+        )
+        min_row, min_col = _cell(min_lat, min_lon)
+        max_row, max_col = _cell(max_lat, max_lon)
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                yield row, col
+
+    def add(self, subscription: Subscription):
+        self._subscriptions[subscription.subscription_id] = subscription
+        self._officials[subscription.official_id] += 1
+
+        if subscription.radius_m is None:
+            self._everywhere.add(subscription.subscription_id)
+        else:
+            for cell in self._cells_of(subscription):
+                self._cells[cell].add(subscription.subscription_id)
+
+    def remove(self, subscription_id: int):
+        subscription = self._subscriptions.pop(subscription_id, None)
+        if subscription is None:
+            return
+
+        self._officials[subscription.official_id] -= 1
+        if not self._officials[subscription.official_id]:
+            del self._officials[subscription.official_id]
+
+        if subscription.radius_m is None:
+            self._everywhere.discard(subscription_id)
+        else:
+            for cell in self._cells_of(subscription):
+                self._cells[cell].discard(subscription_id)
+                if not self._cells[cell]:
+                    del self._cells[cell]
+
+    def load(self, subscriptions: Iterable[Subscription]):
+        self.__init__()
+        for subscription in subscriptions:
+            self.add(subscription)
+
+    def get(self, subscription_id: int) -> Optional[Subscription]:
+        return self._subscriptions.get(subscription_id)
+
+    def of_official(self, official_id: int) -> List[Subscription]:
+        return sorted(
+            (s for s in self._subscriptions.values() if s.official_id == official_id),
+            key=lambda s: s.subscription_id
+        )
+
+    # Госслужащие, у которых есть хотя бы одна подписка
+    def subscribers(self) -> Set[int]:
+        return set(self._officials)
+
+    # Госслужащие, подписки которых подходят под категорию и место обращения
+    def match(self, category: str, latitude: Optional[float], longitude: Optional[float]) -> Set[int]:
+        candidates = set(self._everywhere)
+        if latitude is not None and longitude is not None:
+            candidates |= self._cells.get(_cell(latitude, longitude), set())
+
+        officials = set()
+        for subscription_id in candidates:
+            subscription = self._subscriptions[subscription_id]
+            if subscription.official_id in officials:
+                continue
+            if subscription.category is not None and subscription.category != category:
+                continue
+            if subscription.radius_m is not None and (
+                    latitude is None or longitude is None or
+                    haversine(latitude, longitude, subscription.latitude, subscription.longitude) >
+                    subscription.radius_m):
+                continue
+            officials.add(subscription.official_id)
+
+        return officials
@@ -0,0 +1,93 @@
+import contextlib
+from typing import Dict, Optional, Set, Tuple
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from metrics import THROTTLED_UPDATES
+from notifications import TokenBucket
+from storage import Storage
+
+# Лимиты по ролям: (обновлений в секунду, запас подряд). Обновление - команда, сообщение
+# или нажатие кнопки; /report целиком - около 6 обновлений. Роли без лимита (admin) не ограничиваются
+DEFAULT_LIMITS: Dict[str, Tuple[float, float]] = {
+    'user': (0.5, 12),
+    'moderator': (5, 60),
+    'official': (5, 60),
+}
+
+THROTTLED_TEXT = "Слишком много запросов. Подождите немного и попробуйте снова."
+
+
+# Лимиты из строки вида "user=0.5/12,moderator=5/60" (запас по умолчанию равен скорости)
+def parse_limits(text: str) -> Dict[str, Tuple[float, float]]:
+    limits = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        role, _, value = item.partition('=')
+        rate, _, capacity = value.partition('/')
+        limits[role.strip()] = (float(rate), float(capacity or rate))
+    return limits
+
+
+# Ограничение частоты обновлений от одного пользователя (token bucket на пользователя,
+# лимит по роли). Проверка выполняется обработчиком throttle в группе -1, до диалогов
+# и обработчиков кнопок, поэтому отброшенное обновление не доходит до БД и рассылок.
+# Полные (неактивные) бакеты удаляются, когда их становится больше max_idle_buckets.
+# Используется только из event loop, поэтому блокировки не нужны
+class UserThrottle:
+    def __init__(self, storage: Storage, limits: Dict[str, Tuple[float, float]] = DEFAULT_LIMITS,
+                 max_idle_buckets: int = 10000):
+        self.storage = storage
+        self.limits = limits
+        self.max_idle_buckets = max_idle_buckets
+        self._buckets: Dict[int, TokenBucket] = {}
+        # Пользователи, которым уже ответили об ограничении (до следующего пропущенного обновления)
+        self._warned: Set[int] = set()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _bucket(self, user_id: int, rate: float, capacity: float) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        # Бакет создается заново и при смене роли пользователя
+        if bucket is None or (bucket.rate, bucket.capacity) != (rate, capacity):
+            if len(self._buckets) >= self.max_idle_buckets:
+                self._buckets = {key: value for key, value in self._buckets.items() if not value.is_idle()}
+                self._warned &= self._buckets.keys()
+            bucket = TokenBucket(rate, capacity)
+            self._buckets[user_id] = bucket
+        return bucket
+
+    # Списание токена пользователя; False - обновление нужно отбросить
+    def allow(self, user_id: int, role: Optional[str]) -> bool:
+        limit = self.limits.get(role or 'user')
+        if limit is None:
+            return True
+
+        if self._bucket(user_id, *limit).try_acquire():
+            self._warned.discard(user_id)
+            return True
+        return False
+
+    # Обработчик всех обновлений (TypeHandler в группе -1). Отброшенное нажатие кнопки получает
+    # всплывающий ответ, сообщение - один ответ на серию отброшенных, без обращений к БД
+    async def throttle(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return
+
+        role = await self.storage.get_role(user.id)
+        if self.allow(user.id, role):
+            return
+
+        THROTTLED_UPDATES.inc(role or 'user')
+        with contextlib.suppress(TelegramError):
+            if update.callback_query:
+                await update.callback_query.answer(THROTTLED_TEXT)
+            elif update.effective_message and user.id not in self._warned:
+                self._warned.add(user.id)
+                await update.effective_message.reply_text(THROTTLED_TEXT)
+        raise ApplicationHandlerStop
@@ -0,0 +1,172 @@
+import asyncio
+import contextlib
+import hmac
+import json
+import logging
+import signal
+from http import HTTPStatus
+from typing import Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+
+# Максимальный размер тела запроса и время ожидания следующего запроса в keep-alive соединении
+MAX_BODY_SIZE = 1024 * 1024
+KEEP_ALIVE_TIMEOUT = 75
+
+
+# Встроенный асинхронный HTTP-сервер для приема обновлений Telegram через webhook.
+# POST на path проверяет секретный токен и кладет обновление в ограниченную очередь
+# приложения; если очередь переполнена, отвечает 503, и Telegram повторит доставку позже.
+# Секретный токен обязателен: без него обновления от имени Telegram мог бы прислать кто угодно.
+# GET /healthz - процесс жив, GET /readyz - бот запущен и готов принимать обновления
+class WebhookServer:
+    def __init__(self, application: Application, listen: str, port: int, path: str,
+                 secret_token: str):
+        if not secret_token:
+            raise ValueError("Для webhook нужен секретный токен")
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        logging.info(f"Webhook-сервер слушает {self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @property
+    def sockets(self):
+        return self._server.sockets if self._server else []
+
+    def is_ready(self) -> bool:
+        queue = self.application.update_queue
+        return self.application.running and not queue.full()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                if not request_line:
+                    break
+
+                method, target, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, keep_alive=False)
+                    break
+
+                body = await reader.readexactly(length) if length else b''
+                status, text = self._route(method, target.split('?', 1)[0], headers, body)
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, text, keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    def _route(self, method: str, path: str, headers: dict, body: bytes) -> Tuple[HTTPStatus, str]:
+        if path == '/healthz' and method == 'GET':
+            return HTTPStatus.OK, 'ok'
+
+        if path == '/readyz' and method == 'GET':
+            if self.is_ready():
+                return HTTPStatus.OK, 'ready'
+            return HTTPStatus.SERVICE_UNAVAILABLE, 'not ready'
+
+        if path != self.path:
+            return HTTPStatus.NOT_FOUND, 'not found'
+
+        if method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED, 'method not allowed'
+
+        if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', ''), self.secret_token):
+            return HTTPStatus.FORBIDDEN, 'forbidden'
+
+        try:
+            data = json.loads(body)
+            # Обновление - JSON-объект; de_json на другом значении (списке, числе) падает с AttributeError
+            if not isinstance(data, dict):
+                return HTTPStatus.BAD_REQUEST, 'bad request'
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            return HTTPStatus.BAD_REQUEST, 'bad request'
+
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logging.warning("Очередь обновлений переполнена, обновление отклонено")
+            return HTTPStatus.SERVICE_UNAVAILABLE, 'queue full'
+
+        return HTTPStatus.OK, 'ok'
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: HTTPStatus, text: str = '',
+                       keep_alive: bool = True):
+        body = text.encode()
+        writer.write(
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+
+
+# Запуск бота в режиме webhook: инициализация приложения, регистрация webhook в Telegram
+# (если задан webhook_url), прием обновлений до SIGINT/SIGTERM и корректная остановка
+async def run_webhook(application: Application, listen: str, port: int, path: str,
+                      webhook_url: Optional[str], secret_token: str):
+    server = WebhookServer(application, listen, port, path, secret_token)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+
+    try:
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+
+        await application.start()
+        await server.start()
+
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+DB_DIR = tempfile.mkdtemp(prefix='signal-kz-webhook-')
+os.environ.setdefault("BOT_TOKEN", "123456:WEBHOOK")
+os.environ["METRICS_PORT"] = ""
+os.environ["DB_PATH"] = os.path.join(DB_DIR, 'webhook.db')
+
+from telegram.ext import Application
+
+import main as bot
+from fake_bot_api import FakeBotApi, FakeBotApiServer
+from webhook import run_webhook
+
+# Проверка режима webhook целиком: приложение из main.py запускается через run_webhook,
+# fake_bot_api.py получает setWebhook и доставляет обновление POST-запросом с секретным
+# токеном, обработчик /start отвечает пользователю. Также проверяются отказы webhook-сервера
+# (неверный токен, тело не JSON-объект) и остановка по SIGINT. Пример:
+#   python webhook_check.py
+# Код возврата 1, если проверка не прошла
+
+TOKEN = "123456:WEBHOOK"
+SECRET = "webhook-check-secret"
+PATH = '/telegram'
+USER_ID = 42
+TIMEOUT = 10
+
+
+def expect(condition, message: str):
+    if not condition:
+        raise AssertionError(message)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# HTTP-запрос к webhook-серверу; возвращает код ответа
+async def request(port: int, method: str, path: str, body: bytes = b'', headers: dict = None) -> int:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        lines = [f"{method} {path} HTTP/1.1", f"Content-Length: {len(body)}", "Connection: close"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+        return int((await reader.readline()).split()[1])
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def wait_for(condition, message: str):
+    deadline = time.monotonic() + TIMEOUT
+    while not await condition():
+        expect(time.monotonic() < deadline, message)
+        await asyncio.sleep(0.05)
+
+
+async def check(api: FakeBotApi, api_server: FakeBotApiServer, replies: list):
+    port = free_port()
+    application = bot.build_application(
+        Application.builder().token(TOKEN)
+        .base_url(f"{api_server.url}/bot").base_file_url(f"{api_server.url}/file/bot")
+    )
+    bot.storage.setup()
+    webhook = asyncio.create_task(run_webhook(
+        application, '127.0.0.1', port, PATH, webhook_url=f"http://127.0.0.1:{port}{PATH}", secret_token=SECRET
+    ))
+
+    async def ready():
+        if webhook.done():
+            webhook.result()
+        try:
+            return await request(port, 'GET', '/readyz') == 200
+        except OSError:
+            return False
+
+    async def replied():
+        return bool(replies)
+
+    try:
+        await wait_for(ready, "webhook-сервер не стал готов")
+        expect(api.webhook == {'url': f"http://127.0.0.1:{port}{PATH}", 'secret_token': SECRET},
+               "webhook зарегистрирован в Bot API с секретным токеном")
+
+        # Обновление от "Telegram": POST на webhook, обработка, ответ пользователю через Bot API
+        api.push_update({'message': {
+            'message_id': 1, 'date': int(time.time()), 'chat': {'id': USER_ID, 'type': 'private'},
+            'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'Айдар'},
+            'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+        }})
+
+        await wait_for(replied, "бот не ответил на /start, доставленный через webhook")
+        await api.drain_webhook()
+        expect(api.webhook_responses == {200: 1}, f"ответы webhook: {dict(api.webhook_responses)}")
+        expect(replies[0][0] == USER_ID, "ответ отправлен в чат пользователя")
+        expect(await bot.storage.get_role(USER_ID) == 'user', "пользователь зарегистрирован")
+
+        secret = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+        expect(await request(port, 'POST', PATH, b'{}', {'X-Telegram-Bot-Api-Secret-Token': 'wrong'}) == 403,
+               "обновление с неверным токеном отклоняется")
+        expect(await request(port, 'POST', PATH, b'{}') == 403, "обновление без токена отклоняется")
+        expect(await request(port, 'POST', PATH, b'[1]', secret) == 400, "тело-список отклоняется")
+        expect(await request(port, 'POST', PATH, b'{', secret) == 400, "некорректный JSON отклоняется")
+        expect(await request(port, 'GET', PATH) == 405, "GET на адрес webhook")
+        expect(await request(port, 'GET', '/healthz') == 200, "healthz")
+
+        # Остановка так же, как в работе: по сигналу
+        os.kill(os.getpid(), signal.SIGINT)
+        await asyncio.wait_for(webhook, TIMEOUT)
+        expect(not application.running, "приложение остановлено")
+    finally:
+        if not webhook.done():
+            webhook.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await webhook
+
+
+async def run() -> int:
+    replies = []
+    api = FakeBotApi(on_message=lambda chat_id, message: replies.append((chat_id, message)))
+    api_server = FakeBotApiServer(api, port=0)
+    await api_server.start()
+    try:
+        await check(api, api_server, replies)
+        print("webhook: ok")
+        return 0
+    except Exception:
+        print("webhook: FAILED")
+        traceback.print_exc()
+        return 1
+    finally:
+        await api_server.stop()
+        shutil.rmtree(DB_DIR, ignore_errors=True)
+
+
+def main():
+    sys.exit(asyncio.run(run()))
+
+
+if __name__ == "__main__":
+    main()